@@ -0,0 +1,83 @@
+"""
+启动时配置加载基准: 对比旧版(config.json里带着全部对话记录, 读取解析两次再整体写回)
+与 Config.load()(只解析一次, 对话记录在memory.jsonl里按需解析) 的耗时和内存分配峰值
+
+python benchmarks/bench_config.py [对话条数]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+#  导入main时就会在当前目录下建立日志写入线程, 先切到临时目录, 不在源码目录里留下log/
+WORKDIR = tempfile.TemporaryDirectory()
+os.chdir(WORKDIR.name)
+
+from PyQt5.QtWidgets import QApplication  # noqa: E402
+
+from main import Config  # noqa: E402
+
+
+def makeHistory(count):
+    history = [{"role": "system", "content": "系统提示词" * 50}]
+    for i in range(count):
+        history.append({"role": "user", "content": [{"type": "text", "text": f"第{i}条消息,随便聊聊" * 5}]})
+        history.append({"role": "assistant", "content": f"<think>想一想{i}</think><content>回复{i}</content>" * 3})
+    return history
+
+
+def legacyLoad(filePath: Path):
+    """改造前 Config.__init__ 的读取流程: read() 一次, json.loads 再一次, 然后整体写回"""
+    kwargs = json.loads(filePath.read_text("utf-8"))
+    if filePath.exists():
+        kwargs = json.loads(filePath.read_text("utf-8"))
+    filePath.write_text(json.dumps(kwargs, ensure_ascii=False, indent=4), encoding="utf-8")
+    return kwargs
+
+
+def measure(function):
+    tracemalloc.start()
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def run(count=2000):
+    app = QApplication.instance() or QApplication([])
+    history = makeHistory(count)
+    cwd = os.getcwd()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            Path("config").mkdir()
+            legacyFile = Path("legacy.json")
+            legacyFile.write_text(json.dumps({"memory": history, "prompt": ""}, ensure_ascii=False, indent=4),
+                                  encoding="utf-8")
+            results["legacy"] = measure(lambda: legacyLoad(legacyFile))
+
+            Path("config/config.json").write_text(json.dumps({"prompt": ""}), encoding="utf-8")
+            Path("config/memory.jsonl").write_text(
+                "".join(json.dumps(i, ensure_ascii=False) + "\n" for i in history), encoding="utf-8")
+            holder = {}
+            results["load"] = measure(lambda: holder.setdefault("config", Config.load()))
+            results["load+memory"] = measure(lambda: len(holder["config"].memory))
+            holder["config"].flush()
+        finally:
+            os.chdir(cwd)
+    del app
+    return results
+
+
+if __name__ == '__main__':
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for name, (elapsed, peak) in run(count).items():
+        print(f"{name:>12}: {elapsed * 1000:>9.2f} ms  峰值分配 {peak / 1024:>10.1f} KiB")
@@ -0,0 +1,66 @@
+"""
+日志吞吐基准: 对比旧版每次调用都 print + 打开/关闭文件的 log() 与队列化的 LogWriter
+
+python benchmarks/bench_log.py [行数]
+"""
+import contextlib
+import datetime as dt
+import io
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+#  导入main时就会在当前目录下建立日志写入线程, 先切到临时目录, 不在源码目录里留下log/
+WORKDIR = tempfile.TemporaryDirectory()
+os.chdir(WORKDIR.name)
+
+from main import LogWriter  # noqa: E402
+
+
+def legacyLog(logDir: Path, content, level):
+    """改造前 main.log 的原样实现(只把目录换成临时目录)"""
+    today = dt.datetime.today()
+    system_time = f"{today.year}年-{today.month}月-{today.day}日-{today.hour}时-{today.minute}分-{today.second}秒"
+    outputContent = f"[{system_time}][{level}]: {content}"
+    print(outputContent)
+    filePath = logDir / f"{today.year}年-{today.month}月-{today.day}日.log"
+    if not filePath.parent.exists():
+        filePath.parent.mkdir(exist_ok=True, parents=True)
+    notInit = filePath.exists()
+    with open(filePath, "a+", encoding='utf-8') as writer:
+        if notInit:
+            writer.write(f"\n{outputContent}")
+        else:
+            writer.write(f"日志开始于 {today.year}年-{today.month}月-{today.day}日.log")
+        writer.close()
+
+
+def run(lines=20000):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+        legacyDir = Path(tmp) / "legacy"
+        start = time.perf_counter()
+        for i in range(lines):
+            legacyLog(legacyDir, f"读取到: arm{i} 值 0.0", "INFO")
+        results["legacy"] = {"caller": lines / (time.perf_counter() - start)}
+        results["legacy"]["total"] = results["legacy"]["caller"]
+
+        writer = LogWriter(logDir=Path(tmp) / "queued")
+        start = time.perf_counter()
+        for i in range(lines):
+            writer.put(f"读取到: arm{i} 值 0.0", "INFO")
+        callerTime = time.perf_counter() - start
+        writer.flush(timeout=60)
+        totalTime = time.perf_counter() - start
+        writer.close()
+        results["queued"] = {"caller": lines / callerTime, "total": lines / totalTime}
+    return results
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    for name, result in run(count).items():
+        print(f"{name:>7}: 调用方 {result['caller']:>12,.0f} 行/秒  落盘 {result['total']:>12,.0f} 行/秒")
@@ -0,0 +1,97 @@
+"""
+不需要显卡和真实 Live2D 模型的 LAppModel 替身, 给基准测试用
+
+FakeLAppModel 有和 live2d.v3.LAppModel 一样的参数接口, 只把 SetParameterValue / SetIndexParamValue
+的调用记下来(次数和最后写入的值); 没有安装 live2d-py 时 install() 把它注册成 live2d.v3 模块
+"""
+import json
+import sys
+import types
+from pathlib import Path
+
+
+class FakeParameter:
+    __slots__ = ("id", "type", "value", "max", "min", "default")
+
+    def __init__(self, id, value=0.0, minimum=0.0, maximum=1.0, default=0.0, type=0):
+        self.id = id
+        self.type = type
+        self.value = value
+        self.max = maximum
+        self.min = minimum
+        self.default = default
+
+
+class FakeLAppModel:
+    """indexSetter为False时不提供SetIndexParamValue, 模拟旧版本的live2d-py"""
+
+    def __init__(self, parameterCount=200, ids=None, indexSetter=True):
+        ids = list(ids or []) + [f"Param{i:03d}" for i in range(parameterCount - len(ids or []))]
+        self.parameters = [FakeParameter(id) for id in ids]
+        self.index = {parameter.id: i for i, parameter in enumerate(self.parameters)}
+        self.calls = 0
+        self.written: dict[str, float] = {}
+        if not indexSetter:
+            self.SetIndexParamValue = None
+
+    def LoadModelJson(self, path):
+        """读取真实模型的model3.json只为了拿到参数id(如果它旁边有参数缓存), 其余什么也不做"""
+        path = Path(path)
+        if path.exists():
+            json.loads(path.read_text("utf-8"))
+
+    def GetParameterCount(self):
+        return len(self.parameters)
+
+    def GetParameter(self, index):
+        return self.parameters[index]
+
+    def SetParameterValue(self, id, value, weight=1.0):
+        self.calls += 1
+        self.written[id] = value
+        index = self.index.get(id)
+        if index is not None:
+            self.parameters[index].value = value
+
+    def SetIndexParamValue(self, index, value, weight=1.0):
+        self.calls += 1
+        parameter = self.parameters[index]
+        parameter.value = self.written[parameter.id] = value
+
+    def Update(self):
+        pass
+
+    def Draw(self):
+        pass
+
+    def Resize(self, width, height):
+        pass
+
+    def SetAutoBreathEnable(self, enable):
+        pass
+
+    def SetAutoBlinkEnable(self, enable):
+        pass
+
+    def reset(self):
+        self.calls = 0
+        self.written.clear()
+
+
+def install():
+    """没有安装live2d-py(或者没有v3模块)时, 注册一个只带FakeLAppModel的live2d.v3模块"""
+    try:
+        import live2d.v3  # noqa: F401
+        return False
+    except ImportError:
+        pass
+    package = types.ModuleType("live2d")
+    module = types.ModuleType("live2d.v3")
+    module.LAppModel = FakeLAppModel
+    module.LIVE2D_VERSION = "fake"
+    for name in ("init", "dispose", "glInit", "glRelease", "clearBuffer"):
+        setattr(module, name, lambda *args, **kwargs: None)
+    package.v3 = module
+    sys.modules["live2d"] = package
+    sys.modules["live2d.v3"] = module
+    return True
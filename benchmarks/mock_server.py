@@ -0,0 +1,390 @@
+"""
+本地的 OpenAI 兼容替身服务器, 不需要真实的大模型端点就能跑 AI.chat / 流式输出 / 工具调用 / 打字机
+
+实现了 /v1/models 与 /v1/chat/completions (流式和非流式, 包括 tool_calls 的增量),
+可以配置首字延迟、生成速度、工具调用数量和故障注入(返回错误码 / 流式输出中途断开);
+--record 把发往真实端点的请求原样转发并把回复(连同每个分片的时间)录到磁盘,
+--replay 按请求内容找到录制的会话, 按原来的时间一模一样地放出来
+
+在设置里把 http://127.0.0.1:8765/v1 当作普通的URL端点添加, token随便填
+
+python benchmarks/mock_server.py [--port 8765] [--latency 0.3] [--token-rate 40] [--tool-calls 2]
+python benchmarks/mock_server.py --record recordings/ --upstream https://api.example.com/v1 --upstream-key sk-...
+python benchmarks/mock_server.py --replay recordings/
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+TOKEN_PATTERN = re.compile(r"[\u3000-\u9fff\uff00-\uffef]|[A-Za-z0-9_]+|\s+|[^\sA-Za-z0-9_]")
+DEFAULT_REPLY = ("嗯……你说的这件事我认真想了一下, 其实没有那么复杂. 先把手头能做的做完, 剩下的交给明天的自己吧. "
+                 "要是累了就休息一会儿, 我会一直在这里陪着你的.")
+
+
+@dataclass
+class Behaviour:
+    """替身服务器的行为参数"""
+    latency: float = 0.3  # 首个分片之前的等待(秒)
+    tokenRate: float = 40.0  # 每秒生成的token数, 0为不限速
+    replyTokens: int = 120  # 每次回复的大约token数
+    toolCalls: int = 0  # 请求带了tools时, 每次回复附带的工具调用数
+    failRate: float = 0.0  # 直接返回错误码的概率
+    failStatus: int = 500
+    dropRate: float = 0.0  # 流式输出中途断开的概率
+    strict: bool = False  # 像一些兼容服务端那样, 请求里有不认识的字段(比如stream_options)时返回400
+    seed: int | None = None
+    models: list = field(default_factory=lambda: ["mock-chat", "mock-vision"])
+    reply: str = DEFAULT_REPLY
+
+
+def tokenize(text) -> list:
+    """粗略切分token: 一个汉字/标点或一个英文单词算一个"""
+    return TOKEN_PATTERN.findall(text)
+
+
+def requestKey(body: dict) -> str:
+    """录制/回放时用来对应请求的键, 只看决定回复内容的字段"""
+    canonical = {name: body.get(name) for name in ("model", "messages", "tools", "tool_choice", "stream")}
+    return hashlib.sha1(json.dumps(canonical, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class MockServer:
+    """
+    可以在脚本里直接使用: url = MockServer(behaviour).start(); ...; server.stop()
+    record 与 replay 都是目录, 每个会话录成一个 <请求哈希>.json
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, behaviour: Behaviour | None = None,
+                 record: Path | None = None, replay: Path | None = None,
+                 upstream: str | None = None, upstreamKey: str | None = None, replaySpeed: float = 1.0):
+        self.behaviour = behaviour or Behaviour()
+        self.random = random.Random(self.behaviour.seed)
+        self.record = Path(record) if record else None
+        self.replay = Path(replay) if replay else None
+        self.upstream = upstream.rstrip("/") if upstream else None
+        self.upstreamKey = upstreamKey
+        self.replaySpeed = replaySpeed
+        if self.record and not self.upstream:
+            raise ValueError("录制需要同时指定 --upstream")
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.httpd = ThreadingHTTPServer((host, port), self.__handler())
+        self.httpd.daemon_threads = True
+        self.thread: threading.Thread | None = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> str:
+        """在后台线程里运行, 返回可以直接填进Config.urls的地址"""
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    def serveForever(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def roll(self, probability) -> bool:
+        with self.lock:
+            return probability > 0 and self.random.random() < probability
+
+    #  合成回复
+
+    def synthesize(self, body: dict) -> tuple[list, list]:
+        """根据请求生成 (内容token列表, 工具调用列表)"""
+        behaviour = self.behaviour
+        userText = ""
+        for message in reversed(body.get("messages") or []):
+            if message.get("role") == "user":
+                content = message.get("content")
+                if isinstance(content, list):
+                    content = "".join(part.get("text", "") for part in content if isinstance(part, dict))
+                userText = str(content or "")
+                break
+        replyTokens = tokenize(behaviour.reply) or ["……"]
+        while len(replyTokens) < behaviour.replyTokens:
+            replyTokens += replyTokens
+        text = f"<think>用户说: {userText[:40]}</think><content>{''.join(replyTokens[:behaviour.replyTokens])}</content>"
+
+        toolCalls = []
+        tools = [tool["function"] for tool in body.get("tools") or [] if tool.get("type") == "function"]
+        for i in range(behaviour.toolCalls if tools else 0):
+            function = tools[(self.requests + i) % len(tools)]
+            arguments = {}
+            for name, schema in (function.get("parameters") or {}).get("properties", {}).items():
+                _type = schema.get("type")
+                if _type in ("number", "integer"):
+                    arguments[name] = 1 if i % 2 == 0 else 0
+                elif _type == "boolean":
+                    arguments[name] = True
+                else:
+                    arguments[name] = f"<think>动作{i}</think><content>第{i + 1}个动作</content>"
+            toolCalls.append({"id": f"call_{uuid.uuid4().hex[:24]}", "type": "function",
+                              "function": {"name": function["name"],
+                                           "arguments": json.dumps(arguments, ensure_ascii=False)}})
+        return tokenize(text), toolCalls
+
+    @staticmethod
+    def usage(body: dict, completionTokens: int) -> dict:
+        promptTokens = len(json.dumps(body.get("messages") or [], ensure_ascii=False)) // 3
+        return {"prompt_tokens": promptTokens, "completion_tokens": completionTokens,
+                "total_tokens": promptTokens + completionTokens}
+
+    def __handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            #  基础输出
+
+            def sendJson(self, status, payload):
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def sendError(self, status, message):
+                self.sendJson(status, {"error": {"message": message, "type": "mock_error", "code": status}})
+
+            def beginStream(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+
+            def writeChunk(self, data: bytes):
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+            def endStream(self):
+                self.wfile.write(b"0\r\n\r\n")
+                self.wfile.flush()
+
+            def sendEvent(self, payload):
+                data = payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False)
+                self.writeChunk(f"data: {data}\n\n".encode("utf-8"))
+
+            #  路由
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_GET(self):
+                if self.path.rstrip("/").endswith("/models"):
+                    recorded = server.replay and server.replay / "models.json"
+                    if recorded and recorded.exists():
+                        return self.sendJson(200, json.loads(recorded.read_text("utf-8")))
+                    if server.record:
+                        return self.proxyModels()
+                    return self.sendJson(200, {"object": "list", "data": [
+                        {"id": model, "object": "model", "created": 0, "owned_by": "mock"}
+                        for model in server.behaviour.models]})
+                self.sendError(404, f"未知路径 {self.path}")
+
+            def do_POST(self):
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    return self.sendError(404, f"未知路径 {self.path}")
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                except ValueError as e:
+                    return self.sendError(400, f"请求不是合法的json: {e}")
+                with server.lock:
+                    server.requests += 1
+                if server.replay:
+                    return self.replay(body)
+                if server.record:
+                    return self.proxy(body)
+                if server.roll(server.behaviour.failRate):
+                    return self.sendError(server.behaviour.failStatus, "注入的故障")
+                if server.behaviour.strict and "stream_options" in body:
+                    return self.sendError(400, "不支持的字段: stream_options")
+                if body.get("stream"):
+                    self.stream(body)
+                else:
+                    self.complete(body)
+
+            #  合成
+
+            def complete(self, body):
+                behaviour = server.behaviour
+                tokens, toolCalls = server.synthesize(body)
+                time.sleep(behaviour.latency + (len(tokens) / behaviour.tokenRate if behaviour.tokenRate else 0))
+                message = {"role": "assistant", "content": "".join(tokens)}
+                if toolCalls:
+                    message["tool_calls"] = toolCalls
+                self.sendJson(200, {
+                    "id": f"chatcmpl-{uuid.uuid4().hex[:24]}", "object": "chat.completion",
+                    "created": int(time.time()), "model": body.get("model") or "mock-chat",
+                    "choices": [{"index": 0, "message": message,
+                                 "finish_reason": "tool_calls" if toolCalls else "stop"}],
+                    "usage": server.usage(body, len(tokens))})
+
+            def stream(self, body):
+                behaviour = server.behaviour
+                tokens, toolCalls = server.synthesize(body)
+                base = {"id": f"chatcmpl-{uuid.uuid4().hex[:24]}", "object": "chat.completion.chunk",
+                        "created": int(time.time()), "model": body.get("model") or "mock-chat"}
+                interval = 1 / behaviour.tokenRate if behaviour.tokenRate else 0
+                dropAt = server.random.randrange(1, max(2, len(tokens))) if server.roll(behaviour.dropRate) else None
+
+                def chunk(delta, finishReason=None):
+                    return {**base, "choices": [{"index": 0, "delta": delta, "finish_reason": finishReason}]}
+
+                self.beginStream()
+                time.sleep(behaviour.latency)
+                self.sendEvent(chunk({"role": "assistant", "content": ""}))
+                nextTime = time.perf_counter()
+                for i, token in enumerate(tokens):
+                    if i == dropAt:
+                        #  模拟连接中途断开: 不发结束标记直接关掉
+                        self.close_connection = True
+                        return
+                    nextTime += interval
+                    delay = nextTime - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    self.sendEvent(chunk({"content": token}))
+                for index, call in enumerate(toolCalls):
+                    arguments = call["function"]["arguments"]
+                    self.sendEvent(chunk({"tool_calls": [{"index": index, "id": call["id"], "type": "function",
+                                                          "function": {"name": call["function"]["name"],
+                                                                       "arguments": ""}}]}))
+                    for start in range(0, len(arguments), 16):
+                        self.sendEvent(chunk({"tool_calls": [{"index": index, "function": {
+                            "arguments": arguments[start:start + 16]}}]}))
+                self.sendEvent(chunk({}, "tool_calls" if toolCalls else "stop"))
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    self.sendEvent({**base, "choices": [], "usage": server.usage(body, len(tokens))})
+                self.sendEvent("[DONE]")
+                self.endStream()
+
+            #  录制
+
+            def upstreamRequest(self, path, body=None):
+                request = urllib.request.Request(
+                    server.upstream + path, method="POST" if body is not None else "GET",
+                    data=json.dumps(body).encode("utf-8") if body is not None else None,
+                    headers={"Authorization": f"Bearer {server.upstreamKey or ''}",
+                             "Content-Type": "application/json"})
+                return urllib.request.urlopen(request, timeout=120)
+
+            def proxyModels(self):
+                try:
+                    with self.upstreamRequest("/models") as response:
+                        payload = json.loads(response.read())
+                except urllib.error.HTTPError as e:
+                    return self.sendError(e.code, e.read().decode("utf-8", "replace"))
+                server.record.mkdir(parents=True, exist_ok=True)
+                (server.record / "models.json").write_text(json.dumps(payload, ensure_ascii=False), "utf-8")
+                self.sendJson(200, payload)
+
+            def proxy(self, body):
+                startTime = time.perf_counter()
+                try:
+                    response = self.upstreamRequest("/chat/completions", body)
+                except urllib.error.HTTPError as e:
+                    return self.sendError(e.code, e.read().decode("utf-8", "replace"))
+                events = []
+                with response:
+                    if body.get("stream"):
+                        self.beginStream()
+                        for line in response:
+                            events.append([time.perf_counter() - startTime, line.decode("utf-8")])
+                            self.writeChunk(line)
+                        self.endStream()
+                    else:
+                        data = response.read()
+                        events.append([time.perf_counter() - startTime, data.decode("utf-8")])
+                        self.send_response(200)
+                        self.send_header("Content-Type", "application/json")
+                        self.send_header("Content-Length", str(len(data)))
+                        self.end_headers()
+                        self.wfile.write(data)
+                server.record.mkdir(parents=True, exist_ok=True)
+                (server.record / f"{requestKey(body)}.json").write_text(json.dumps(
+                    {"request": body, "stream": bool(body.get("stream")), "events": events},
+                    ensure_ascii=False), "utf-8")
+
+            #  回放
+
+            def replay(self, body):
+                recording = server.replay / f"{requestKey(body)}.json"
+                if not recording.exists():
+                    return self.sendError(404, f"没有这个请求的录制: {recording.name}")
+                session = json.loads(recording.read_text("utf-8"))
+                startTime = time.perf_counter()
+                if not session["stream"]:
+                    offset, data = session["events"][0]
+                    time.sleep(max(0.0, offset / server.replaySpeed - (time.perf_counter() - startTime)))
+                    return self.sendJson(200, json.loads(data))
+                self.beginStream()
+                for offset, line in session["events"]:
+                    delay = offset / server.replaySpeed - (time.perf_counter() - startTime)
+                    if delay > 0:
+                        time.sleep(delay)
+                    self.writeChunk(line.encode("utf-8"))
+                self.endStream()
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地的 OpenAI 兼容替身服务器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.3, help="首个分片之前的等待(秒)")
+    parser.add_argument("--token-rate", type=float, default=40.0, help="每秒生成的token数, 0为不限速")
+    parser.add_argument("--reply-tokens", type=int, default=120)
+    parser.add_argument("--tool-calls", type=int, default=0, help="每次回复附带的工具调用数")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="直接返回错误码的概率")
+    parser.add_argument("--fail-status", type=int, default=500)
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="流式输出中途断开的概率")
+    parser.add_argument("--strict", action="store_true", help="请求里有stream_options时返回400")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--record", type=Path, help="录制目录, 需要同时指定 --upstream")
+    parser.add_argument("--upstream", help="录制时转发到的真实端点, 例如 https://api.example.com/v1")
+    parser.add_argument("--upstream-key")
+    parser.add_argument("--replay", type=Path, help="回放目录")
+    parser.add_argument("--replay-speed", type=float, default=1.0, help="回放速度倍数")
+    args = parser.parse_args()
+
+    behaviour = Behaviour(latency=args.latency, tokenRate=args.token_rate, replyTokens=args.reply_tokens,
+                          toolCalls=args.tool_calls, failRate=args.fail_rate, failStatus=args.fail_status,
+                          dropRate=args.drop_rate, strict=args.strict, seed=args.seed)
+    server = MockServer(args.host, args.port, behaviour, record=args.record, replay=args.replay,
+                        upstream=args.upstream, upstreamKey=args.upstream_key, replaySpeed=args.replay_speed)
+    mode = "录制" if args.record else "回放" if args.replay else "合成"
+    print(f"替身服务器({mode})运行在 {server.url}")
+    try:
+        server.serveForever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
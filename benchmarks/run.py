@@ -0,0 +1,367 @@
+"""
+热点路径的微基准套件, 不需要显卡和真实的 Live2D 模型: Qt 使用 offscreen 平台, 模型换成 fake_live2d.FakeLAppModel
+
+每个场景按参数组合(对话记录长度 / 补间数量 / 工具数量 ...)分别计时, 结果写成 JSON, 方便在不同提交之间比较:
+
+python benchmarks/run.py                         # 全部场景, 结果写到 benchmarks/results/<提交>.json
+python benchmarks/run.py -k animation --quick    # 只跑名字里带 animation 的场景, 每个场景少跑几轮
+python benchmarks/run.py --compare old.json new.json [--threshold 0.1]   # 比较两次结果, 变慢超过阈值时退出码为1
+
+bench_log.py / bench_config.py 是改造前后实现的单独对比, 不在这里重复
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+#  配置/对话记录/日志/缓存都写到临时目录, 导入main之前就切换过去(日志写入线程按相对路径打开文件)
+CWD = os.getcwd()
+WORKDIR = tempfile.TemporaryDirectory()
+os.chdir(WORKDIR.name)
+
+from fake_live2d import FakeLAppModel, install  # noqa: E402
+
+install()
+
+from PyQt5.QtWidgets import QApplication  # noqa: E402
+
+import main  # noqa: E402
+
+SCENARIOS = []
+
+
+def scenario(name, **parameters):
+    """注册一个场景; 被装饰的函数接收一组参数, 做好准备后返回每次计时调用的函数"""
+
+    def decorator(setup):
+        grid = [{}]
+        for key, values in parameters.items():
+            grid = [{**item, key: value} for item in grid for value in values]
+        for item in grid:
+            label = ",".join(f"{key}={value}" for key, value in item.items())
+            SCENARIOS.append((f"{name}[{label}]" if label else name, setup, item))
+        return setup
+
+    return decorator
+
+
+#  场景
+
+
+def boundController(parameterCount=200):
+    model = FakeLAppModel(parameterCount)
+    registry = main.ParameterRegistry()
+    registry.load(model, "fake.model3.json")
+    controller = main.AnimationController()
+    controller.bind(model, registry)
+    return model, registry, controller
+
+
+@scenario("animation.update", tweens=[10, 50, 200])
+def animationUpdate(tweens):
+    """每帧: tweens个补间同时在播放, 全部参数的值一次算完并推给模型"""
+    model, registry, controller = boundController(200)
+    for i in range(tweens):
+        controller.registerAnimation(main.Animation(model, registry.ids[i], 0.0, 1.0, 1e6, easing="easeInOutSine"))
+    clock = SimpleNamespace(now=0.0)
+    controller.update(clock.now)
+
+    def step():
+        clock.now += 1 / 60
+        controller.update(clock.now)
+
+    return step
+
+
+@scenario("animation.idle", layers=[5, 50])
+def animationIdle(layers):
+    """没有补间, 只有待机摆动叠加层"""
+    model, registry, controller = boundController(200)
+    for i in range(layers):
+        controller.addIdleLayer(registry.ids[i], 0.1, 3.0 + i * 0.1)
+    clock = SimpleNamespace(now=0.0)
+
+    def step():
+        clock.now += 1 / 60
+        controller.update(clock.now)
+
+    return step
+
+
+@scenario("lipSync.generate", characters=[20, 200])
+def lipSyncGenerate(characters):
+    """一段回复(或流式片段)进入打字机时生成口型曲线"""
+    model, registry, controller = boundController(200)
+    lipSync = main.LipSync(controller)
+    text = ("今天天气不错，要不要出去走走？Sounds good! " * 20)[:characters]
+    return lambda: lipSync.generate(text, 20)
+
+
+@scenario("lipSync.frame")
+def lipSyncFrame():
+    """口型曲线播放中的每帧更新(张嘴和嘴型两条曲线)"""
+    model, registry, controller = boundController(200)
+    lipSync = main.LipSync(controller, openId=registry.ids[0], formId=registry.ids[1])
+    clock = SimpleNamespace(now=0.0)
+    controller.update(clock.now)
+    lipSync.feed("今天天气不错，要不要出去走走？" * 1000, 20)
+
+    def step():
+        clock.now += 1 / 60
+        controller.update(clock.now)
+
+    return step
+
+
+@scenario("speech.envelope", seconds=[1, 5])
+def speechEnvelope(seconds):
+    """合成完一块语音后在线程池里算嘴型包络(22.05kHz)"""
+    rate = 22050
+    np = main.np
+    t = np.arange(rate * seconds) / rate
+    samples = (0.5 * np.sin(2 * np.pi * 180 * t) * (0.5 + 0.5 * np.sin(2 * np.pi * 4 * t))).astype(np.float32)
+    return lambda: main.SpeechPipeline.envelope(samples, rate)
+
+
+@scenario("parameter.find", parameters=[50, 500])
+def parameterFind(parameters):
+    model = FakeLAppModel(parameters)
+    manager = main.ParameterManager()
+    for item in model.parameters:
+        manager.append(main.Parameter(live2d=model, type=item.type, value=item.value, id=item.id, min=item.min,
+                                      max=item.max, default=item.default))
+    ids = [item.id for item in model.parameters]
+    cursor = SimpleNamespace(i=0)
+
+    def step():
+        cursor.i = (cursor.i + 7) % len(ids)
+        manager.find(ids[cursor.i])
+
+    return step
+
+
+@scenario("config.save", entries=[10, 500])
+def configSave(entries):
+    """请求保存并取快照(GUI线程上的开销, 实际写入在后台线程)"""
+    config = main.Config()
+    config.live2dParameterData = {f"Param{i:03d}": i / entries for i in range(entries)}
+
+    def step():
+        config.save()
+        config.saver.commit()
+
+    return step
+
+
+def filledConfig(history):
+    config = main.Config()
+    memory = config.memory
+    for i in range(history):
+        memory.append({"role": "user", "content": [{"type": "text", "text": f"第{i}条消息, 随便聊聊"}]})
+        memory.append({"role": "assistant", "content": f"<think>想一想{i}</think><content>回复{i}</content>"})
+    return config
+
+
+@scenario("ai.getLastAIMessage", history=[100, 1000, 10000])
+def getLastAIMessage(history):
+    ai = SimpleNamespace(config=filledConfig(history))
+    return lambda: main.AI.getLastAIMessage(ai)
+
+
+@scenario("context.build", history=[100, 1000, 10000])
+def contextBuild(history):
+    config = filledConfig(history)
+    context = main.ContextManager(config)
+    return lambda: context.build(config.memory, "mock-chat")
+
+
+@scenario("log")
+def logPut():
+    return lambda: main.log("基准测试的一行日志, 带一点长度" * 2, "DEBUG")
+
+
+def makeTool(index):
+    def _function(value: float, messageForUser: str = ""):
+        pass
+
+    _function.__name__ = f"tool_{index}"
+    _function.__doc__ = f"第{index}个工具" * 10
+    return _function
+
+
+@scenario("functionManager.tools", tools=[10, 50, 200])
+def functionManagerTools(tools):
+    manager = main.FunctionManager()
+    for i in range(tools):
+        manager.openai_function(makeTool(i))
+    manager.tools()
+    return manager.tools
+
+
+@scenario("function.schema", tools=[10, 50, 200])
+def functionSchema(tools):
+    """注册tools个工具(inspect生成schema)并生成一次工具表"""
+    functions = [makeTool(i) for i in range(tools)]
+
+    def step():
+        manager = main.FunctionManager()
+        for function in functions:
+            manager.openai_function(function)
+        manager.tools()
+
+    return step
+
+
+@scenario("function.call")
+def functionCall():
+    manager = main.FunctionManager()
+    manager.openai_function(makeTool(0))
+    arguments = '{"value": 0.5, "messageForUser": "<think>嗯</think><content>好的</content>"}'
+    return lambda: manager.call("tool_0", arguments)
+
+
+@scenario("frameProfiler", enabled=[False, True])
+def frameProfiler(enabled):
+    """OpenGlWidget.__update里的计时桩: 关闭时只有布尔判断"""
+    widget = SimpleNamespace(profiler=main.FrameProfiler())
+    widget.profiler.setEnabled(enabled)
+    phases = range(main.FrameProfiler.PAINT)
+
+    def step():
+        profiler = widget.profiler if widget.profiler.enabled else None
+        if profiler:
+            profiler.begin()
+        for phase in phases:
+            if profiler:
+                profiler.mark(phase)
+        if profiler:
+            profiler.end()
+
+    return step
+
+
+#  计时
+
+
+def measure(step, budget, repeats):
+    """先估计一次调用的耗时, 让每轮大约跑budget秒, 返回每次调用的耗时(微秒)统计"""
+    step()
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            step()
+        elapsed = time.perf_counter() - start
+        if elapsed >= budget / 10 or number >= 1 << 20:
+            break
+        number *= 4
+    number = max(1, int(number * budget / max(elapsed, 1e-9)))
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            step()
+        samples.append((time.perf_counter() - start) / number * 1e6)
+    return {
+        "median_us": statistics.median(samples),
+        "min_us": min(samples),
+        "mean_us": statistics.fmean(samples),
+        "stdev_us": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "iterations": number,
+        "repeats": repeats,
+    }
+
+
+def gitRevision():
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                  text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                                    capture_output=True, text=True).stdout.strip())
+        return revision, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+
+
+def run(pattern=None, quick=False):
+    app = QApplication.instance() or QApplication([])
+    main.logWriter.setLevel("DEBUG", consoleLevel="CRITICAL")
+    budget, repeats = (0.05, 3) if quick else (0.2, 5)
+    revision, dirty = gitRevision()
+    results = {}
+    for name, setup, parameters in SCENARIOS:
+        if pattern and pattern not in name:
+            continue
+        step = setup(**parameters)
+        app.processEvents()
+        results[name] = measure(step, budget, repeats)
+        app.processEvents()
+        print(f"{name:<45} {results[name]['median_us']:>12.2f} us", flush=True)
+    main.logWriter.flush()
+    return {
+        "meta": {
+            "commit": revision,
+            "dirty": dirty,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": main.np.__version__,
+            "quick": quick,
+        },
+        "results": results,
+    }
+
+
+def compare(oldPath, newPath, threshold):
+    old, new = (json.loads((Path(CWD) / path).read_text("utf-8")) for path in (oldPath, newPath))
+    print(f"{'场景':<45} {old['meta']['commit']:>12} {new['meta']['commit']:>12}   比值")
+    regressions = 0
+    for name, result in new["results"].items():
+        before = old["results"].get(name)
+        if before is None:
+            print(f"{name:<45} {'-':>12} {result['median_us']:>12.2f}")
+            continue
+        ratio = result["median_us"] / max(before["median_us"], 1e-9)
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  变慢"
+            regressions += 1
+        elif ratio < 1 - threshold:
+            flag = "  变快"
+        print(f"{name:<45} {before['median_us']:>12.2f} {result['median_us']:>12.2f}   {ratio:5.2f}x{flag}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="热点路径微基准")
+    parser.add_argument("-k", dest="pattern", help="只运行名字里包含该字符串的场景")
+    parser.add_argument("--quick", action="store_true", help="每个场景少跑几轮")
+    parser.add_argument("--out", type=Path, help="结果文件, 默认 benchmarks/results/<提交>.json")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    parser.add_argument("--threshold", type=float, default=0.1, help="比较时视为变化的相对幅度")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold) else 0)
+    report = run(args.pattern, args.quick)
+    out = Path(CWD) / args.out if args.out else Path(__file__).resolve().parent / "results" / \
+        f"{report['meta']['commit']}{'-dirty' if report['meta']['dirty'] else ''}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"结果已写入 {out}")
+    main.logWriter.close()
+    os.chdir(CWD)
+    with contextlib.suppress(OSError):
+        WORKDIR.cleanup()
@@ -1,20 +1,43 @@
+import atexit
 import base64
+import collections
+import concurrent.futures
+import copy
+import gzip
+import hashlib
+import heapq
+import http.server
 import inspect
+import math
 import os
+import queue
 import random
+import shutil
+import struct
+import subprocess
+import threading
 import time
+from dataclasses import dataclass, field, fields
 from typing import Callable, List
 from pathlib import Path
 
-from PyQt5.QtGui import QDragEnterEvent, QDropEvent
+from PyQt5.QtGui import QDragEnterEvent, QDropEvent, QTextCursor, QImage, QImageReader, QPainter, QPainterPath, \
+    QColor, QKeySequence
 from PyQt5.QtWidgets import QMainWindow, QApplication, QOpenGLWidget, QHBoxLayout, QVBoxLayout, QWidget, QPlainTextEdit, \
-    QPushButton, QLineEdit, QSlider, QScrollArea, QComboBox, QLabel
-from PyQt5.QtCore import QTimer, Qt, pyqtSignal, QObject, QEvent
+    QPushButton, QLineEdit, QSlider, QScrollArea, QComboBox, QLabel, QShortcut
+from PyQt5.QtCore import QTimer, Qt, pyqtSignal, QObject, QEvent, QBuffer, QIODevice, QSize, QRectF
+
+try:
+    from PyQt5.QtMultimedia import QAudioFormat, QAudioOutput
+except ImportError:  # 没有QtMultimedia(或者缺少系统音频库)时语音不可用, 只显示文字
+    QAudioFormat = QAudioOutput = None
 import sys
 import traceback as tb
 import live2d.v3 as live2d
 import json
-from openai import OpenAI
+import numpy as np
+import httpx
+from openai import APIStatusError, OpenAI
 from OpenGL.GL import *
 import requests
 from threading import Thread as th
@@ -34,23 +57,160 @@ mouth_id = "ParamMouthOpenY"
 #
 
 
+LOG_LEVELS = {"DEBUG": 10, "CONSOLE": 20, "INFO": 20, "WARN": 30, "ERROR": 40, "CRITICAL": 50}
+
+
+class LogWriter:
+    """
+    队列化的日志后端
+    调用方(GUI/渲染线程)只把(时间戳,等级,内容)放进队列,
+    格式化、打印、打开文件、写盘、轮转和压缩全部在后台写入线程完成
+    """
+
+    def __init__(self, logDir="log", level="DEBUG", consoleLevel="DEBUG", maxBytes=8 * 1024 * 1024,
+                 compress=False, flushInterval=0.5, batchSize=512):
+        self.logDir = Path(logDir)
+        self.level = LOG_LEVELS.get(level, 10)
+        self.consoleLevel = LOG_LEVELS.get(consoleLevel, 10)
+        self.maxBytes = maxBytes  # 单个日志文件的大小上限,超过后切分,0为不限制
+        self.compress = compress  # 切分出去的旧日志是否用gzip压缩
+        self.flushInterval = flushInterval
+        self.batchSize = batchSize
+
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.writer = None  # 保持打开的文件句柄,只在写入线程里使用
+        self.day = None
+        self.filePath: Path | None = None
+        self.closed = False
+
+        self.thread = th(target=self.__run, name="LogWriter", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def setLevel(self, level, consoleLevel=None):
+        self.level = LOG_LEVELS.get(level, self.level)
+        if consoleLevel is not None:
+            self.consoleLevel = LOG_LEVELS.get(consoleLevel, self.consoleLevel)
+
+    def put(self, content, level):
+        rank = LOG_LEVELS.get(level, 20)
+        if rank < self.level and rank < self.consoleLevel:
+            return
+        self.queue.put((time.time(), level, rank, content))
+
+    def flush(self, timeout=5.0):
+        """阻塞到队列里已有的日志全部落盘,给退出流程和基准测试用"""
+        if self.closed:
+            return
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait(timeout)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join(5)
+
+    def __run(self):
+        while True:
+            try:
+                items = [self.queue.get(timeout=self.flushInterval)]
+            except queue.Empty:
+                continue
+            while len(items) < self.batchSize:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = self.__write(items)
+            if stop:
+                return
+
+    def __write(self, items) -> bool:
+        console = []
+        events = []
+        stop = False
+        for item in items:
+            if item is None:
+                stop = True
+                continue
+            if isinstance(item, threading.Event):
+                events.append(item)
+                continue
+            timestamp, level, rank, content = item
+            today = dt.datetime.fromtimestamp(timestamp)
+            system_time = f"{today.year}年-{today.month}月-{today.day}日-{today.hour}时-{today.minute}分-{today.second}秒"
+            outputContent = f"[{system_time}][{level}]: {content}"
+            if rank >= self.consoleLevel:
+                console.append(outputContent)
+            if rank >= self.level:
+                try:
+                    self.__open(today.date())
+                    self.writer.write(f"\n{outputContent}")
+                except Exception as e:
+                    console.append(f"日志写入失败:{e}")
+        try:
+            if console:
+                print("\n".join(console))
+            if self.writer:
+                self.writer.flush()
+                if self.maxBytes and self.writer.tell() >= self.maxBytes:
+                    self.__rotate()
+        except Exception as e:
+            print(f"日志写入失败:{e}")
+        for event in events:
+            event.set()
+        if stop and self.writer:
+            self.writer.close()
+            self.writer = None
+        return stop
+
+    def __open(self, day):
+        if self.writer and self.day == day:
+            return
+        previous = self.filePath
+        if self.writer:
+            self.writer.close()
+        self.day = day
+        self.filePath = self.logDir / f"{day.year}年-{day.month}月-{day.day}日.log"
+        self.filePath.parent.mkdir(exist_ok=true, parents=true)
+        notInit = self.filePath.exists()
+        self.writer = open(self.filePath, "a", encoding='utf-8')
+        if not notInit:
+            self.writer.write(f"日志开始于 {day.year}年-{day.month}月-{day.day}日.log")
+        if previous and self.compress and previous != self.filePath:
+            self.__compress(previous)
+
+    def __rotate(self):
+        """当天的日志超过大小上限,切分成 xxx.1.log, xxx.2.log ..."""
+        self.writer.close()
+        self.writer = None
+        index = 1
+        while any((self.filePath.with_suffix(f".{index}{suffix}")).exists() for suffix in (".log", ".log.gz")):
+            index += 1
+        rotated = self.filePath.with_suffix(f".{index}.log")
+        os.replace(self.filePath, rotated)
+        if self.compress:
+            self.__compress(rotated)
+        self.__open(self.day)
+
+    @staticmethod
+    def __compress(filePath: Path):
+        try:
+            with open(filePath, "rb") as reader, gzip.open(f"{filePath}.gz", "wb") as writer:
+                shutil.copyfileobj(reader, writer)
+            filePath.unlink()
+        except Exception as e:
+            print(f"日志压缩失败:{e}")
+
+
+logWriter = LogWriter()
+
+
 def log(content, level):
-    today = dt.datetime.today()
-    today.weekday()
-    system_time = f"{today.year}年-{today.month}月-{today.day}日-{today.hour}时-{today.minute}分-{today.second}秒"
-    outputContent = f"[{system_time}][{level}]: {content}"
-    print(outputContent)
-    filePath = Path(f"log/{today.year}年-{today.month}月-{today.day}日.log")
-    if not filePath.parent.exists():
-        filePath.parent.mkdir(exist_ok=true, parents=true)
-    notInit = filePath.exists()
-    with open(filePath, "a+", encoding='utf-8') as writer:
-        if notInit:
-            # 已经有内容了，附加
-            writer.write(f"\n{outputContent}")
-        else:
-            writer.write(f"日志开始于 {today.year}年-{today.month}月-{today.day}日.log")
-        writer.close()
+    logWriter.put(content, level)
 
 
 info = lambda content: log(content, "INFO")
@@ -63,97 +223,412 @@ console = lambda content: log(content, "CONSOLE")
 debug(f"版本:{version}")
 
 
-class AnimationController:
+class CommandBus:
+    """
+    工作线程 -> 渲染线程 的命令队列
+    post可以在任意线程调用, drain只在渲染循环里调用, 所以所有对live2d模型和界面的修改都发生在渲染线程;
+    带key的命令会作废还在排队的同key旧命令, 只在最新一条的位置执行一次(比如连续的"设置AI文本"只需要执行最后一次),
+    排在旧命令之后、新命令之前的其他命令仍然按顺序先执行
+    deque.append/popleft和dict的单次读写在CPython里都是原子的, 这里不需要加锁
+    """
 
     def __init__(self):
-        self.animations: List[Animation] = []
-        self.registerList: List[Animation] = []
-        #  添加到动画列表的缓冲
-        self.finishAnimationList: List[Animation] = []
+        self.queue = collections.deque()  # (key, command)
+        self.latest = {}  # key -> 最新的命令, 队列里其他同key的命令执行时直接跳过
+
+    def post(self, command: Callable, key=None):
+        if key is not None:
+            #  先登记再入队, drain取到这条时一定能看到它(或者更新的一条)
+            self.latest[key] = command
+        self.queue.append((key, command))
+
+    def drain(self):
+        """每帧调用一次,只执行本次调用之前已经入队的命令"""
+        for _ in range(len(self.queue)):
+            key, command = self.queue.popleft()
+            if key is not None and self.latest.get(key) is not command:
+                continue
+            try:
+                command()
+            except Exception as e:
+                error(f"渲染线程命令执行异常:{e}\n{tb.format_exc()}")
+
+    def __len__(self):
+        return len(self.queue)
+
 
-    def registerAnimation(self, animation):
-        self.registerList.append(animation)
+class ParameterRegistry:
+    """
+    模型参数 id -> 连续下标 的注册表(下标与模型内部的参数顺序一致), 查找是O(1)的字典操作
+    参数元数据(id/type/value/max/min/default)按.moc3文件的哈希缓存在磁盘上,
+    同一个模型再次启动时不用再逐个参数getattr
+    """
+    fields = ("id", "type", "value", "max", "min", "default")
+    cachePath = Path("cache/parameters/")
 
-    def update(self):
+    def __init__(self):
+        self.ids: List[str] = []
+        self.index: dict[str, int] = {}
+        self.metadata: List[dict] = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def indexOf(self, id) -> int | None:
+        return self.index.get(id)
+
+    def register(self, id) -> int:
+        i = self.index.get(id)
+        if i is None:
+            i = self.index[id] = len(self.ids)
+            self.ids.append(id)
+        return i
+
+    def load(self, model: live2d.LAppModel, modelJsonPath):
+        """读取模型参数表,优先使用磁盘缓存"""
+        startTime = time.perf_counter()
+        cacheFile = None
         try:
-            for a in self.animations:
-                a.update()
-                if a.isFinish():
-                    self.finishAnimationList.append(a)
+            modelJsonPath = Path(modelJsonPath)
+            mocPath = modelJsonPath.parent / json.loads(modelJsonPath.read_text("utf-8"))["FileReferences"]["Moc"]
+            cacheFile = self.cachePath / f"{hashlib.sha1(mocPath.read_bytes()).hexdigest()}.json"
+        except Exception as e:
+            warn(f"无法计算模型文件哈希,不使用参数缓存:{e}")
+
+        metadata = None
+        if cacheFile and cacheFile.exists():
+            try:
+                metadata = json.loads(cacheFile.read_text("utf-8"))
+                if len(metadata) != model.GetParameterCount():
+                    metadata = None
+            except ValueError:
+                metadata = None
+        fromCache = metadata is not None
+        if metadata is None:
+            metadata = [self.__describe(model.GetParameter(i)) for i in range(model.GetParameterCount())]
+            if cacheFile:
+                try:
+                    cacheFile.parent.mkdir(parents=True, exist_ok=True)
+                    cacheFile.write_text(json.dumps(metadata, ensure_ascii=False), encoding="utf-8")
+                except Exception as e:
+                    warn(f"写入参数缓存失败:{e}")
+
+        self.ids = []
+        self.index = {}
+        self.metadata = metadata
+        for item in metadata:
+            self.register(item["id"])
+        info(f"注册了 {len(self.ids)} 个模型参数{'(缓存)' if fromCache else ''}, "
+             f"耗时 {(time.perf_counter() - startTime) * 1000:.2f}ms")
+
+    def __describe(self, parameter) -> dict:
+        item = {}
+        for name in self.fields:
+            value = getattr(parameter, name)
+            if name == "id":
+                item[name] = str(value)
+            elif name == "type":
+                try:
+                    item[name] = int(value)
+                except (TypeError, ValueError):
+                    item[name] = str(value)
             else:
-                if self.registerList:
-                    self.animations.extend(self.registerList)
-                    self.registerList = []
-                if self.finishAnimationList:
-                    for delAnimation in self.finishAnimationList:
-                        try:
-                            self.animations.remove(delAnimation)
-                        except Exception as e:
-                            error(f"动画更新异常:{e}\n{tb.format_exc()}")
-                    else:
-                        self.finishAnimationList = []
+                item[name] = float(value)
+        return item
+
+    @staticmethod
+    def setter(model: live2d.LAppModel, ids: List[str]) -> Callable[[int, float], None]:
+        """按下标写参数, live2d-py提供SetIndexParamValue时直接用下标,省掉一次id查找"""
+        setIndex = getattr(model, "SetIndexParamValue", None)
+        if setIndex is not None:
+            return setIndex
+        setValue = model.SetParameterValue
+        return lambda i, value: setValue(ids[i], value)
+
+
+parameterRegistry = ParameterRegistry()
+
+
+EASINGS = {
+    "linear": lambda t: t,
+    "easeInQuad": lambda t: t * t,
+    "easeOutQuad": lambda t: t * (2 - t),
+    "easeInOutQuad": lambda t: np.where(t < 0.5, 2 * t * t, 1 - (-2 * t + 2) ** 2 / 2),
+    "easeInOutCubic": lambda t: np.where(t < 0.5, 4 * t * t * t, 1 - (-2 * t + 2) ** 3 / 2),
+    "easeInOutSine": lambda t: 0.5 - np.cos(np.pi * t) / 2,
+    "easeOutBack": lambda t: 1 + 2.70158 * (t - 1) ** 3 + 1.70158 * (t - 1) ** 2,
+}
+EASING_CODES = {name: code for code, name in enumerate(EASINGS)}
+EASING_FUNCTIONS = list(EASINGS.values())
+#  呼吸: (参数, 偏移, 振幅, 周期秒), 和Cubism示例里默认的呼吸一样(已经乘上了0.5的权重)
+BREATH_LAYERS = (("ParamAngleX", 0.0, 7.5, 6.5345), ("ParamAngleY", 0.0, 4.0, 3.5345),
+                 ("ParamAngleZ", 0.0, 5.0, 5.5345), ("ParamBodyAngleX", 0.0, 2.0, 15.5345),
+                 ("ParamBreath", 0.25, 0.25, 3.2345))
+
+
+class AnimationController:
+    """
+    模型全部参数的状态保存在NumPy数组里, 每帧把所有正在播放的补间、预计算曲线、空闲叠加层(呼吸)和姿势目标值一次性算完,
+    只把和上一次写进模型的值不一样的参数推给live2d
+    每个参数同一时刻只有一条补间: 新注册的补间接管旧的,并从当前值开始(blend)
+    """
+
+    def __init__(self):
+        self.model: live2d.LAppModel | None = None
+        self.setter: Callable[[int, float], None] | None = None  # 按参数下标写进模型
+        #  添加到动画列表的缓冲,下一帧开始播放
+        self.registerList: List[tuple] = []
+        self.now = time.monotonic()
+
+        self.ids: List[str] = []
+        self.index: dict[str, int] = {}
+        self.animations: List[Animation | None] = []  # 参数下标 -> 正在播放的补间,播完后用来接下一段
+        self.values = self.start = self.end = self.startTime = self.playTime = np.zeros(0)
+        self.easing = np.zeros(0, dtype=np.int8)
+        self.active = self.owned = np.zeros(0, dtype=bool)  # owned: 由这里管理的参数,其余参数留给live2d自己(眨眼/物理)
+        self.pushed = np.zeros(0)  # 上一次写进模型的值
+        self.idleAmplitude = self.idlePeriod = self.idlePhase = self.idleOffset = np.zeros(0)
+        self.idleIndex = np.zeros(0, dtype=np.intp)
+        self.tracks: dict[int, Track] = {}  # 参数下标 -> 正在播放的预计算曲线(口型)
+
+    def bind(self, model: live2d.LAppModel, registry: ParameterRegistry):
+        """加载模型后调用,按注册表里的参数建立状态数组"""
+        self.model = model
+        self.ids = registry.ids
+        self.index = registry.index
+        self.setter = registry.setter(model, self.ids)
+        count = len(self.ids)
+        self.animations = [None] * count
+        self.values = np.array([item["value"] for item in registry.metadata], dtype=np.float64)
+        self.start = self.values.copy()
+        self.end = self.values.copy()
+        self.startTime = np.zeros(count)
+        self.playTime = np.ones(count)
+        self.easing = np.zeros(count, dtype=np.int8)
+        self.active = np.zeros(count, dtype=bool)
+        self.owned = np.zeros(count, dtype=bool)
+        self.pushed = self.values.copy()
+        self.idleAmplitude = np.zeros(count)
+        self.idlePeriod = np.ones(count)
+        self.idlePhase = np.zeros(count)
+        self.idleOffset = np.zeros(count)
+        self.idleIndex = np.zeros(0, dtype=np.intp)
+        self.tracks = {}
+
+    def registerAnimation(self, animation, delay: float = 0):
+        self.registerList.append((animation, delay))
+
+    def isActive(self):
+        return bool(self.registerList) or bool(self.tracks) or bool(self.active.any())
+
+    def cancel(self, parameter):
+        i = self.index.get(parameter)
+        if i is not None:
+            self.active[i] = False
+            self.animations[i] = None
+
+    def value(self, parameter):
+        """参数当前的值(不含曲线和空闲叠加层),不是这里管理的参数返回None"""
+        i = self.index.get(parameter)
+        return float(self.values[i]) if i is not None and self.owned[i] else None
+
+    def set(self, parameter, value):
+        """直接设置参数(取消它上面的补间),立即写进模型"""
+        value = float(value)
+        i = self.index.get(parameter)
+        if i is None:
+            if self.model:
+                self.model.SetParameterValue(parameter, value)
+            return
+        self.cancel(parameter)
+        self.values[i] = self.pushed[i] = value
+        self.owned[i] = True
+        self.setter(i, value)
+
+    def addIdleLayer(self, parameter, amplitude, period, phase=0.0, offset=0.0):
+        """在参数上叠加一个offset + 正弦摆动(比如呼吸、待机时轻微晃动),amplitude为0时移除"""
+        i = self.index.get(parameter)
+        if i is None:
+            return
+        self.idleAmplitude[i] = amplitude
+        self.idlePeriod[i] = max(period, 1e-3)
+        self.idlePhase[i] = phase
+        self.idleOffset[i] = offset if amplitude else 0.0
+        self.owned[i] = True
+        self.idleIndex = np.flatnonzero(self.idleAmplitude)
+
+    def playTrack(self, parameter, samples: np.ndarray, rate: float, additive: bool = False, now=None):
+        """
+        在参数上播放一段预先算好的曲线(每秒rate个采样), 每帧只按时间取一个采样;
+        additive为True时叠加在参数当前值上, 否则覆盖它; 同一参数上的曲线还没播完时, 新曲线接在剩下的部分后面
+        """
+        i = self.index.get(parameter)
+        if i is None or not len(samples):
+            return
+        now = self.now if now is None else now
+        track = self.tracks.get(i)
+        if track is not None and track.fadeStart is None and track.rate == rate:
+            played = int((now - track.startTime) * rate)
+            if played < len(track.samples):
+                samples = np.concatenate((track.samples[played:], samples))
+        self.tracks[i] = Track(samples, rate, now, additive)
+        self.owned[i] = True
+
+    def isPlaying(self, parameter):
+        """参数上有还没开始淡出的曲线"""
+        track = self.tracks.get(self.index.get(parameter))
+        return track is not None and track.fadeStart is None
+
+    def stopTrack(self, parameter, fade: float = 0.1):
+        """曲线在fade秒内淡出到参数本身的值"""
+        i = self.index.get(parameter)
+        track = self.tracks.get(i)
+        if track is not None and track.fadeStart is None:
+            track.fadeStart = self.now
+            track.fade = max(fade, 1e-3)
+
+    def __tracks(self, output, now):
+        for i, track in list(self.tracks.items()):
+            position = int((now - track.startTime) * track.rate)
+            if position >= len(track.samples):
+                #  播完了: 停在最后一个采样上淡出
+                position = len(track.samples) - 1
+                if track.fadeStart is None:
+                    track.fadeStart, track.fade = now, 0.1
+            gain = 1.0 if track.fadeStart is None else 1.0 - (now - track.fadeStart) / track.fade
+            if gain <= 0:
+                del self.tracks[i]
+                continue
+            sample = track.samples[position]
+            output[i] += sample * gain if track.additive else (sample - output[i]) * gain
+
+    def __start(self, animation, startTime):
+        i = self.index.get(animation.parameter)
+        if i is None:
+            warn(f"模型中没有参数 {animation.parameter}, 动画被忽略")
+            return
+        if animation.blend and self.owned[i]:
+            animation.startValue = float(self.values[i])
+        self.animations[i] = animation
+        self.start[i] = animation.startValue
+        self.end[i] = animation.finishValue
+        self.startTime[i] = startTime
+        self.playTime[i] = max(animation.playTime, 1e-6)
+        self.easing[i] = animation.easing
+        self.active[i] = True
+        self.owned[i] = True
+
+    def update(self, now=None):
+        self.now = now = time.monotonic() if now is None else now
+        if self.model is None:
+            return
+        try:
+            if self.registerList:
+                registerList, self.registerList = self.registerList, []
+                for animation, delay in registerList:
+                    self.__start(animation, now + delay)
+
+            active = np.flatnonzero(self.active)
+            if active.size:
+                elapsed = now - self.startTime[active]
+                progress = np.clip(elapsed / self.playTime[active], 0.0, 1.0)
+                codes = self.easing[active]
+                eased = progress.copy()
+                for code in np.unique(codes):
+                    if code:
+                        mask = codes == code
+                        eased[mask] = EASING_FUNCTIONS[code](progress[mask])
+                self.values[active] = self.start[active] + (self.end[active] - self.start[active]) * eased
+                for i in active[progress >= 1.0]:
+                    self.__finish(i, now)
+
+            output = self.values
+            if self.idleIndex.size or self.tracks:
+                output = self.values.copy()
+            if self.idleIndex.size:
+                idle = self.idleIndex
+                output[idle] += self.idleOffset[idle] + self.idleAmplitude[idle] * np.sin(
+                    2 * np.pi * now / self.idlePeriod[idle] + self.idlePhase[idle])
+            if self.tracks:
+                self.__tracks(output, now)
+
+            changed = np.flatnonzero(self.owned & (np.abs(output - self.pushed) > 1e-5))
+            if changed.size:
+                self.pushed[changed] = output[changed]
+                setter = self.setter
+                for i, value in zip(changed.tolist(), output[changed].tolist()):
+                    setter(i, value)
         except Exception as e:
             error(f"动画更新异常:{e}\n{tb.format_exc()}")
 
+    def __finish(self, i, now):
+        animation = self.animations[i]
+        self.active[i] = False
+        self.animations[i] = None
+        if animation is None:
+            return
+        if animation.owner is not None:
+            animation.owner.value = animation.finishValue
+        nextAnimation = animation.createNext()
+        if nextAnimation is not None:
+            self.__start(nextAnimation, now + animation.nextWaitTime)
+
 
 class Animation:
+    """一段补间的描述,由AnimationController按时间线播放"""
+    __slots__ = ("model", "parameter", "startValue", "finishValue", "playTime", "nextAnimation", "nextWaitTime",
+                 "easing", "blend", "owner")
 
     def __init__(self, model: live2d.LAppModel, parameter: str, startValue: float, finishValue: float, playTime: float,
-                 nextAnimation=None, nextWaitTime: float = 0, testFlg=False):
-        self.testFlg = testFlg
+                 nextAnimation=None, nextWaitTime: float = 0, easing: str = "linear", blend: bool = True, owner=None):
         self.model = model
         self.playTime = playTime
         self.finishValue = finishValue
         self.startValue = startValue
         self.parameter = parameter
-        self.createTime = time.time()
-        self.playDone = False
-        self.nextAnimationIsInit = False
-        self.nextAnimation: Animation = nextAnimation  # 这应该是一个匿名实例
-        self.nextWaitTime = nextWaitTime
-
-    def isFinish(self):
-        if not self.playDone:
-            return False
-        if self.playDone and not self.nextAnimation:
-            return True
-        if not self.nextAnimationIsInit:
-            return False
-        return self.nextAnimation.isFinish()
-
-    def update(self):
-        if self.nextAnimation and self.playDone and self.createTime + self.playTime + self.nextWaitTime < time.time():
-            if not self.nextAnimationIsInit:
-                self.nextAnimation = self.nextAnimation()
-                self.nextAnimationIsInit = True
-            return self.nextAnimation.update()
-        if self.createTime + self.playTime < time.time():
-            self.playDone = True
-            self.model.SetParameterValue(self.parameter, self.finishValue)
-            return
-        t = (time.time() - self.createTime) / self.playTime
-        nowValue = self.startValue * (1 - t) + self.finishValue * t
-        self.model.SetParameterValue(self.parameter, nowValue)
+        self.nextAnimation = nextAnimation  # 这应该是一个匿名实例,或者返回Animation的函数
+        self.nextWaitTime = nextWaitTime  # 播完之后等待多久再开始nextAnimation
+        self.easing = EASING_CODES[easing]
+        self.blend = blend  # 接管同一参数上的旧补间时,从当前的值开始
+        self.owner: Parameter | None = owner  # 播完时同步更新Parameter.value
+
+    def createNext(self):
+        if self.nextAnimation is None:
+            return None
+        return self.nextAnimation if isinstance(self.nextAnimation, Animation) else self.nextAnimation()
+
+
+class Track:
+    """AnimationController上一条正在播放的预计算曲线"""
+    __slots__ = ("samples", "rate", "startTime", "additive", "fadeStart", "fade")
+
+    def __init__(self, samples: np.ndarray, rate: float, startTime: float, additive: bool = False):
+        self.samples = samples
+        self.rate = rate
+        self.startTime = startTime
+        self.additive = additive
+        self.fadeStart: float | None = None
+        self.fade = 0.1
 
 
 class ParameterManager:
 
     def __init__(self):
         self.parameters: List[Parameter] = []
+        self.byId: dict[str, Parameter] = {}
 
     def find(self, id):
-        for parameter in self.parameters:
-            if id == parameter:
-                return parameter
-        return None
+        return self.byId.get(id)
 
     def append(self, parameter):
         self.parameters.append(parameter)
+        self.byId[parameter.id] = parameter
 
 
 class Parameter:
+    __slots__ = ("type", "live2d", "id", "min", "max", "default", "value", "controller")
 
-    def __init__(self, live2d: live2d.LAppModel | None, type, value, id, min, max, default):
+    def __init__(self, live2d: live2d.LAppModel | None, type, value, id, min, max, default, controller=None):
         self.type = type
         self.live2d = live2d
         self.id = id
@@ -161,21 +636,26 @@ class Parameter:
         self.max = max
         self.default = default
         self.value = self.default
+        self.controller: AnimationController | None = controller  # 有的话经由它设置,保持参数状态数组一致
+
+    def __set(self, value):
+        if self.controller:
+            self.controller.set(self.id, value)
+        else:
+            self.live2d.SetParameterValue(self.id, value)
+        self.value = value
 
     def reset(self):
-        self.live2d.SetParameterValue(self.id, int(self.default))
-        self.value = int(self.default)
+        self.__set(int(self.default))
 
     def ChangeValue(self, value):
-        value = float(value)
-        self.live2d.SetParameterValue(self.id, value)
-        self.value = value
+        self.__set(float(value))
 
     def Animation(self, targetValue, playTime: float = 0.1, nextAnimation=None,
-                  nextWaitTime: float | int = 0):
+                  nextWaitTime: float | int = 0, easing: str = "linear"):
         return Animation(self.live2d, self.id, float(self.value), float(targetValue),
                          playTime, nextAnimation=nextAnimation,
-                         nextWaitTime=nextWaitTime)
+                         nextWaitTime=nextWaitTime, easing=easing, owner=self)
 
     def __eq__(self, other):
         if other == self.id:
@@ -183,8 +663,7 @@ class Parameter:
         return False
 
     def ToDefault(self):
-        self.live2d.SetParameterValue(self.id, self.default)
-        self.value = self.default
+        self.__set(self.default)
 
 
 class Body(ABC):  # 每个部位都需要创建一个继承Body的对象作为管理器
@@ -212,19 +691,13 @@ class Body(ABC):  # 每个部位都需要创建一个继承Body的对象作为
 
     def init(self):
 
-        def functionsAction(*args):
-            for function in args:
-                if function:
-                    function()
-
         def makeFunction(key):
-            return lambda value=float, messageForUser=str: functionsAction(
-                lambda: self.bodyController.mainWindow.animationController.registerAnimation(
-                    self.parameterManager.find(key).Animation(value, 0.2)),
-                self.bodyController.mainWindow.config.setLive2dParameterData(key, float(value)),
-                self.toggle(),
-                lambda: self.bodyController.mainWindow.ai.appendAssistantMessage(messageForUser),
-                lambda: self.reset(key))
+            def _function(value: float, messageForUser: str = ""):
+                #  工具在AI的工作线程里被调用,动作本身交给渲染线程执行
+                self.bodyController.mainWindow.choreographer.add(self, key, value)
+                self.bodyController.mainWindow.ai.appendAssistantMessage(messageForUser, append=True)
+
+            return _function
 
         """批量创建匿名函数"""
         for key in self.map:
@@ -234,10 +707,13 @@ class Body(ABC):  # 每个部位都需要创建一个继承Body的对象作为
             _func.__name__ = self.nameMap.get(key)
             self.bodyController.mainWindow.ai.functionManager.openai_function(_func)
 
-    def setParameterValue(self, id, value):
-        value = float(value)
-        self.bodyController.mainWindow.config.live2dParameterData[id] = value
-        self.bodyController.mainWindow.ai.live2d.SetParameterValue(id, value)
+    def pose(self, key, value):
+        """切换到这个部位的某个动作,只能在渲染线程调用"""
+        self.bodyController.mainWindow.config.setLive2dParameterData(key, value)
+        self.toggle()
+        self.bodyController.mainWindow.animationController.registerAnimation(
+            self.parameterManager.find(key).Animation(value, 0.2, easing="easeInOutSine"))
+        self.reset(key)
 
 
 #  开始是身体
@@ -442,7 +918,7 @@ class BodyController:
         try:
             for key in list(self.mainWindow.config.live2dParameterData.keys()):
                 info(f"读取到: {key} 值 {self.mainWindow.config.live2dParameterData[key]}")
-                self.mainWindow.ai.live2d.SetParameterValue(key, float(self.mainWindow.config.live2dParameterData[key]))
+                self.mainWindow.animationController.set(key, float(self.mainWindow.config.live2dParameterData[key]))
             info("\n" * 3)
         except Exception as e:
             error(f"live2d数据加载失败\n{e}\n{tb.format_exc()}")
@@ -453,65 +929,297 @@ class BodyController:
             for key in list(body.map.keys()):
                 _map[key] = body
 
-        for count in range(self.mainWindow.ai.live2d.GetParameterCount()):
-            args = {"live2d": self.mainWindow.ai.live2d}
-            for name in ["id", 'type', 'value', 'max', 'min', 'default']:
-                args[name] = getattr(self.mainWindow.ai.live2d.GetParameter(count), name)
-            parameter = Parameter(**args)
-            if parameter.id == mouth_id:
-                self.mainWindow.ai.mouth = parameter
+        for item in parameterRegistry.metadata:
+            parameter = Parameter(live2d=self.mainWindow.ai.live2d, controller=self.mainWindow.animationController,
+                                  **item)
 
             _body = _map.get(parameter.id)
             if _body:
                 _body.parameterManager.append(parameter)
 
 
-class FunctionCall:
+class Choreographer:
+    """
+    把AI一次回复里的多个工具调用编排成一条动作时间线, 由渲染循环按时间逐个播放
+    工具调用在AI的工作线程里只是记下来(add), 整批调用结束后commit一次交给渲染线程排时间:
+    同一部位连续重复的动作合并成一个, 每个部位最多保留最后maxPerBody个动作,
+    任意两个动作之间至少间隔spacing秒, 同一部位的两个动作之间至少间隔hold秒(等上一个姿势做完)
+    新一批动作会替换掉同一部位还没播放的旧动作
+    """
+
+    def __init__(self, commandBus: CommandBus, spacing: float = 0.15, hold: float = 0.45, maxPerBody: int = 3):
+        self.commandBus = commandBus
+        self.spacing = spacing
+        self.hold = hold
+        self.maxPerBody = maxPerBody
+        self.lock = threading.Lock()
+        self.pending: List[tuple] = []  # 工作线程里收集到的 (部位, 键, 值)
+        self.timeline: List[tuple] = []  # 堆: (播放时间, 序号, 部位, 键, 值)
+        self.sequence = 0
+        self.cursor = 0.0  # 下一个动作最早的播放时间
+        self.lastPlayed: dict[int, float] = {}  # 各部位(id)最后一次播放动作的时间
+
+    def add(self, body, key, value):
+        """任意线程: 记下一个工具调用"""
+        with self.lock:
+            self.pending.append((body, key, float(value)))
+
+    def commit(self):
+        """任意线程: 一批工具调用结束, 交给渲染线程排进时间线"""
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if batch:
+            self.commandBus.post(lambda: self.schedule(batch, time.monotonic()))
+
+    def isActive(self):
+        return bool(self.timeline)
+
+    def clear(self):
+        self.timeline.clear()
+
+    def merge(self, batch: List[tuple]) -> List[tuple]:
+        """按部位分组合并: 连续的同一个键只保留最后一次的值, 每个部位只保留最后maxPerBody个动作"""
+        groups: dict[int, List[list]] = {}  # Body重写了__eq__,不能直接当字典的键
+        for order, (body, key, value) in enumerate(batch):
+            group = groups.setdefault(id(body), [])
+            if group and group[-1][2] == key:
+                group[-1][3] = value
+            else:
+                group.append([order, body, key, value])
+        merged = [item for group in groups.values() for item in group[-self.maxPerBody:]]
+        merged.sort(key=lambda item: item[0])  # 保持动作在原批次里的先后
+        return [(body, key, value) for order, body, key, value in merged]
+
+    def schedule(self, batch: List[tuple], now: float):
+        """渲染线程: 把一批工具调用排进时间线"""
+        keyframes = self.merge(batch)
+        bodies = {id(body) for body, key, value in keyframes}
+        self.timeline = [item for item in self.timeline if id(item[2]) not in bodies]
+        heapq.heapify(self.timeline)
+
+        cursors = {body: self.lastPlayed.get(body, -math.inf) + self.hold for body in bodies}
+        cursor = max(now, self.cursor)
+        first = None
+        for body, key, value in keyframes:
+            at = max(cursor, cursors[id(body)])
+            first = at if first is None else first
+            heapq.heappush(self.timeline, (at, self.sequence, body, key, value))
+            self.sequence += 1
+            cursor = at + self.spacing
+            cursors[id(body)] = at + self.hold
+        self.cursor = cursor
+        debug(f"编排了 {len(keyframes)} 个动作(合并前 {len(batch)} 个), "
+              f"{first - now:.2f}s 后开始, 持续 {cursor - self.spacing - first:.2f}s")
+
+    def tick(self, now):
+        timeline = self.timeline
+        while timeline and timeline[0][0] <= now:
+            at, sequence, body, key, value = heapq.heappop(timeline)
+            self.lastPlayed[id(body)] = now
+            try:
+                body.pose(key, value)
+            except Exception as e:
+                error(f"播放动作 {key} 失败:\n{e}\n{tb.format_exc()}")
+
+
+class ToolCallAccumulator:
+    """把流式返回里按index分片的tool_calls增量拼回完整的调用"""
 
     def __init__(self):
-        self.functionName = None
-        self.args = None
+        self.calls = {}  # index -> tool call dict
+
+    def feed(self, deltas):
+        for delta in deltas:
+            call = self.calls.setdefault(delta.index, {"id": "", "type": "function",
+                                                       "function": {"name": "", "arguments": ""}})
+            if delta.id:
+                call["id"] = delta.id
+            if delta.function:
+                if delta.function.name:
+                    call["function"]["name"] += delta.function.name
+                if delta.function.arguments:
+                    call["function"]["arguments"] += delta.function.arguments
+
+    def result(self) -> list:
+        return [self.calls[index] for index in sorted(self.calls)]
+
+
+class StreamParser:
+    """
+    增量解析 <think>...</think><content>...</content>
+    think的内容只收集不显示, content的内容一到就通过onContent回调出去,
+    标签被切在两个chunk之间时先留在缓冲里等下一个chunk
+    """
+    OUTSIDE = 0
+    THINK = 1
+    CONTENT = 2
+
+    tags = {"<think>": THINK, "</think>": OUTSIDE, "<content>": CONTENT, "</content>": OUTSIDE}
+
+    def __init__(self, onContent: Callable[[str], None] | None = None):
+        self.onContent = onContent
+        self.state = self.OUTSIDE
+        self.buffer = ""
+        self.raw = []
+        self.think = []
+        self.content = []
+        self.outside = []
+
+    def feed(self, text: str):
+        self.raw.append(text)
+        self.buffer += text
+        position = 0
+        while True:
+            tagStart = self.buffer.find("<", position)
+            if tagStart == -1:
+                self.__emit(self.buffer[position:])
+                self.buffer = ""
+                return
+            self.__emit(self.buffer[position:tagStart])
+            rest = self.buffer[tagStart:]
+            for tag, state in self.tags.items():
+                if rest.startswith(tag):
+                    self.state = state
+                    position = tagStart + len(tag)
+                    break
+            else:
+                if any(tag.startswith(rest) for tag in self.tags):
+                    # 可能是被截断的标签,等下一个chunk
+                    self.buffer = rest
+                    return
+                self.__emit("<")
+                position = tagStart + 1
+
+    def close(self):
+        """流结束: 把残留缓冲当普通文本处理; 整段回复都没有<content>时把标签外的文本当作内容"""
+        if self.buffer:
+            self.__emit(self.buffer)
+            self.buffer = ""
+        if not self.content and self.outside:
+            text = "".join(self.outside).strip()
+            if text:
+                self.content.append(text)
+                if self.onContent:
+                    self.onContent(text)
+
+    def __emit(self, text):
+        if not text:
+            return
+        if self.state == self.CONTENT:
+            self.content.append(text)
+            if self.onContent:
+                self.onContent(text)
+        elif self.state == self.THINK:
+            self.think.append(text)
+        else:
+            self.outside.append(text)
+
+    def getRaw(self) -> str:
+        return "".join(self.raw)
+
+    def getContent(self) -> str:
+        return "".join(self.content)
+
+
+class ToolArgumentError(ValueError):
+    """AI给出的工具参数不合法"""
 
-    def update(self, test):
-        return
+
+def _coerceNumber(value):
+    if isinstance(value, bool):
+        raise TypeError
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError
+    return value
+
+
+def _coerceInteger(value):
+    number = _coerceNumber(value)
+    if not number.is_integer():
+        raise ValueError
+    return int(number)
+
+
+def _coerceBoolean(value):
+    if isinstance(value, bool):
+        return value
+    if value in ("true", "True", 1):
+        return True
+    if value in ("false", "False", 0):
+        return False
+    raise ValueError
+
+
+def _coerceType(_type):
+    def _coerce(value):
+        if not isinstance(value, _type):
+            raise TypeError
+        return value
+
+    return _coerce
 
 
 class Function:
-    def __init__(self, function: Callable):
-        self.type_mapping = {
-            'str': 'string',
-            'int': 'integer',
-            'float': 'number',
-            'bool': 'boolean',
-            'list': 'array',
-            'dict': 'object',
-            'NoneType': 'null',
-            # 添加更多类型映射
-            'string': 'string',
-            'integer': 'integer',
-            'number': 'number',
-            'boolean': 'boolean',
-            'array': 'array',
-            'object': 'object',
-            '_empty': 'string'
-        }
+    """
+    把一个python函数包装成openai的工具, schema在构造时用inspect生成一次
+    参数的类型取自注解,没有注解时把默认值当作参数类型(默认值本身是一个类型则该参数是必填的)
+    每个参数预先编译好一个转换函数, 调用前先校验AI给出的参数
+    """
+    type_mapping = {
+        'str': 'string',
+        'int': 'integer',
+        'float': 'number',
+        'bool': 'boolean',
+        'list': 'array',
+        'dict': 'object',
+        'NoneType': 'null',
+        # 添加更多类型映射
+        'string': 'string',
+        'integer': 'integer',
+        'number': 'number',
+        'boolean': 'boolean',
+        'array': 'array',
+        'object': 'object',
+        '_empty': 'string'
+    }
+    coercers = {
+        'string': str,
+        'integer': _coerceInteger,
+        'number': _coerceNumber,
+        'boolean': _coerceBoolean,
+        'array': _coerceType(list),
+        'object': _coerceType(dict),
+        'null': lambda value: None,
+    }
 
+    def __init__(self, function: Callable):
         self.function: Callable = function
         self.doc = self.function.__doc__
         self.name = self.function.__name__
 
         self.parameters = {
         }
+        self.required: List[str] = []
+        self.validators: dict[str, Callable] = {}
         sig = inspect.signature(self.function)
         for name, param in sig.parameters.items():
             if name == "self":
                 continue
-            _type = self.type_mapping[param.annotation.__name__]
-            """ 把默认值当作参数类型"""
+            annotation, default = param.annotation, param.default
+            if annotation is inspect.Parameter.empty and isinstance(default, type):
+                """ 把默认值当作参数类型"""
+                annotation, default = default, inspect.Parameter.empty
+            elif annotation is inspect.Parameter.empty and default is not inspect.Parameter.empty:
+                annotation = type(default)
+            _type = self.type_mapping[getattr(annotation, "__name__", str(annotation))]
             self.parameters[name] = {
                 "type": _type,
                 "description": ""
             }
+            self.validators[name] = self.coercers[_type]
+            if default is inspect.Parameter.empty:
+                self.required.append(name)
 
         self.obj = {
             "type": "function",
@@ -520,59 +1228,441 @@ class Function:
                 "description": self.doc,
                 "parameters": {
                     "type": "object",
-                    "properties": self.parameters
-                },
-                "required": []
+                    "properties": self.parameters,
+                    "required": self.required
+                }
             }
         }
 
+    def validate(self, arguments: str | dict | None) -> dict:
+        """把AI给出的参数(json字符串或字典)转换成调用用的关键字参数,不合法时抛出ToolArgumentError"""
+        if not arguments:
+            arguments = {}
+        elif isinstance(arguments, str):
+            try:
+                arguments = json.loads(arguments)
+            except ValueError as e:
+                raise ToolArgumentError(f"{self.name} 的参数不是合法的json: {e}") from None
+        if not isinstance(arguments, dict):
+            raise ToolArgumentError(f"{self.name} 的参数必须是对象, 得到 {type(arguments).__name__}")
+
+        kwargs = {}
+        for name, value in arguments.items():
+            validator = self.validators.get(name)
+            if validator is None:
+                debug(f"忽略工具 {self.name} 的未知参数 {name}")
+                continue
+            try:
+                kwargs[name] = validator(value)
+            except (TypeError, ValueError):
+                raise ToolArgumentError(
+                    f"{self.name} 的参数 {name} 应为 {self.parameters[name]['type']}, 得到 {value!r}") from None
+        for name in self.required:
+            if name not in kwargs:
+                raise ToolArgumentError(f"{self.name} 缺少必填参数 {name}")
+        return kwargs
+
+    def __call__(self, arguments: str | dict | None = None):
+        return self.function(**self.validate(arguments))
+
+
+class ConversationMemory:
+    """
+    对话记录, 保存在 config/memory.jsonl 里, 一条消息一行, 每轮对话只追加写一行
+    启动时只把每行原样读进来, 哪条消息被用到才解析哪条(通常只有最近几轮)
+    清空记忆时整体写一份快照替换掉旧文件
+
+    按角色维护消息下标(roles), 最后一条ai消息就是roles["assistant"][-1];
+    ai消息的<think>/<content>在追加时解析一次缓存在replies里, 显示最新回复不用再扫描整个记录
+    """
+    rolePattern = re.compile(r'"role":\s*"(\w+)"')
+
+    def __init__(self, filePath: Path):
+        self.filePath = filePath
+        self.entries: list = []  # 未解析的原始行(str) 或 已解析的消息(dict)
+        self.roles: dict[str, list[int]] = {}
+        self.replies: dict[int, tuple[str, str]] = {}  # 下标 -> (think, content)
+        self.lock = threading.Lock()
+        self.writer = None
+        self.load()
+
+    def load(self):
+        if not self.filePath.exists():
+            return
+        damaged = False
+        for line in self.filePath.read_text("utf-8").splitlines():
+            if line.strip():
+                self.entries.append(line)
+            else:
+                damaged = True
+        #  写到一半崩溃只会损坏最后一行,启动时检查一下,有问题就压实重写
+        if self.entries:
+            try:
+                self.entries[-1] = json.loads(self.entries[-1])
+            except ValueError:
+                warn(f"对话记录最后一行已损坏,已丢弃: {self.entries[-1][:100]}")
+                self.entries.pop()
+                damaged = True
+        if damaged:
+            self.compact()
+        self.reindex()
+        info(f"读取到 {len(self.entries)} 条对话记录")
+
+    def reindex(self):
+        """重建角色下标; 未解析的行只用正则取出role, 不做完整的json解析"""
+        self.roles = {}
+        self.replies = {}
+        for index, entry in enumerate(self.entries):
+            if isinstance(entry, str):
+                result = self.rolePattern.search(entry)
+                role = result.group(1) if result is not None else self.__parse(index).get("role")
+            else:
+                role = entry.get("role")
+            self.roles.setdefault(role, []).append(index)
 
-class Config:
+    def indexes(self, role) -> list[int]:
+        return self.roles.get(role, [])
 
-    def __init__(self, **kwargs):
-        self.savePath = Path("config/")
-        self.fileName = Path("config.json")
-        self.savePath.mkdir(parents=True, exist_ok=True)
-
-        if not kwargs and (self.savePath / self.fileName).exists():
-            kwargs = self.read()
-
-        self.urls = []
-        self.tokenMap = {}  # url: [token]  一个url可以有多个key,因为有的url端点会为不同分区key提供不同模型
-        self.models = {}  # token -> [modelName]   同上
-        self.useModel = {}  # token -> modelName
-        self.useToken = {}  # url ->  token
-        self.useUrl = ""
-        self.appPrompt = """
-        你的回复必须使用以下格式,且think与content标签在一次回复中应该各仅有一对(<think>与</think>是一对,<content>与</content>是一对):\n
-        <think>思考内容</think><content>要告诉用户的内容</content>\n
-        其中思考内容要包含你对事情的见解，推测，以及推测如果用户后续做出哪些举动你应该做出什么样的回复(为了辅助你后续衔接上思维)。\n系统设定:\n
-        """
-        self.prompt: str = ""
-        self.ip = '127.0.0.1'
-        self.port = 5114
-        self.position = [0, 0]
-        self.size = [0, 0]
-        self.live2dParameterData = {}  # key -> value
-        self.memory = [
+    def lastIndex(self, role) -> int | None:
+        indexes = self.roles.get(role)
+        return indexes[-1] if indexes else None
+
+    def reply(self, index) -> tuple[str, str]:
+        """ai消息里<think>和<content>的内容, 没有对应标签时为空字符串"""
+        result = self.replies.get(index)
+        if result is None:
+            result = self.replies[index] = self.parseReply(self[index].get("content"))
+        return result
+
+    def lastReply(self) -> str:
+        """最后一条ai消息的<content>"""
+        index = self.lastIndex("assistant")
+        return "" if index is None else self.reply(index)[1]
+
+    @staticmethod
+    def parseReply(content) -> tuple[str, str]:
+        """和流式显示用同一个解析器, 没有<content>标签时同样把标签外的文本当作内容"""
+        if not isinstance(content, str):
+            return "", ""
+        parser = StreamParser()
+        parser.feed(content)
+        parser.close()
+        return "".join(parser.think), "".join(parser.content)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.__parse(i) for i in range(*index.indices(len(self.entries)))]
+        if index < 0:
+            index += len(self.entries)
+        return self.__parse(index)
+
+    def __iter__(self):
+        for index in range(len(self.entries)):
+            yield self.__parse(index)
+
+    def __parse(self, index):
+        entry = self.entries[index]
+        if isinstance(entry, str):
+            entry = self.entries[index] = json.loads(entry)
+        return entry
+
+    def append(self, message: dict):
+        line = json.dumps(message, ensure_ascii=False)
+        role = message.get("role")
+        reply = self.parseReply(message.get("content")) if role == "assistant" else None
+        with self.lock:
+            index = len(self.entries)
+            self.entries.append(message)
+            self.roles.setdefault(role, []).append(index)
+            if reply is not None:
+                self.replies[index] = reply
+            try:
+                if self.writer is None:
+                    self.filePath.parent.mkdir(parents=True, exist_ok=True)
+                    self.writer = open(self.filePath, "a", encoding="utf-8")
+                self.writer.write(line + "\n")
+                self.writer.flush()
+            except Exception as e:
+                error(f"写入对话记录失败\n{e}\n{tb.format_exc()}")
+
+    def reset(self, messages: list):
+        """用新的消息列表替换全部记录(清空记忆/迁移旧配置时使用)"""
+        with self.lock:
+            self.entries = list(messages)
+            self.reindex()
+            self.__snapshot()
+
+    def compact(self):
+        """按内存中的记录重写文件,去掉损坏的行"""
+        with self.lock:
+            self.__snapshot()
+
+    def __snapshot(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+        try:
+            self.filePath.parent.mkdir(parents=True, exist_ok=True)
+            temp = self.filePath.with_suffix(".tmp")
+            with open(temp, "w", encoding="utf-8") as writer:
+                for entry in self.entries:
+                    writer.write((entry if isinstance(entry, str) else json.dumps(entry, ensure_ascii=False)) + "\n")
+                writer.flush()
+                os.fsync(writer.fileno())
+            os.replace(temp, self.filePath)
+        except Exception as e:
+            error(f"写入对话记录快照失败\n{e}\n{tb.format_exc()}")
 
-        ]
 
-        self.enabledImageModal = False
-        self.windowOnTop = True
-        self.streamOutPut = True
-        self.autoBreath = True
-        self.autoBlink = True
+class ConfigSaver(QObject):
+    """
+    Config的持久化
+    save()和字段赋值只是标记为脏并请求保存, 一个合并窗口(interval)内的请求只会写一次;
+    窗口结束时在GUI线程取一份深拷贝快照, 交给后台线程序列化, 内容没变就跳过,
+    变了就写临时文件 -> fsync -> 替换, 写到一半崩溃也不会损坏原来的配置
+    """
+    requested = pyqtSignal()
+
+    def __init__(self, config, interval=1000):
+        super().__init__()
+        self.config: Config = config
+        self.filePath: Path = config.savePath / config.fileName
+        self.fields = set(config.export())
+        self.dirty = set()
+        self.requests = 0  # 本窗口内合并掉的保存请求数
+        self.lastText = None
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.commit)
+        #  任意线程emit, 都排队到GUI线程执行
+        self.requested.connect(self.__schedule)
+
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.thread = th(target=self.__run, name="ConfigWriter", daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def markDirty(self, field="*"):
+        self.dirty.add(field)
+        self.requests += 1
+        self.requested.emit()
+
+    def __schedule(self):
+        #  不重置计时器: 持续拖动窗口时也是每个窗口期写一次,而不是一直推迟
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def snapshot(self) -> dict:
+        for _ in range(5):
+            try:
+                return copy.deepcopy(self.config.export())
+            except RuntimeError:
+                #  其他线程正在往字典里加东西,稍后重试
+                time.sleep(0.001)
+        return copy.deepcopy(self.config.export())
+
+    def commit(self):
+        """取快照交给写入线程,在GUI线程调用"""
+        if not self.dirty:
+            return
+        fields, self.dirty = self.dirty, set()
+        requests, self.requests = self.requests, 0
+        try:
+            self.queue.put((self.snapshot(), fields, requests))
+        except Exception as e:
+            error(f"保存配置文件出错\n{e}\n{tb.format_exc()}")
+
+    def flush(self, timeout=5.0):
+        """立即写入并等待完成,退出程序前调用"""
+        self.commit()
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait(timeout)
+
+    def __run(self):
+        while True:
+            items = [self.queue.get()]
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            events = [i for i in items if isinstance(i, threading.Event)]
+            snapshots = [i for i in items if not isinstance(i, threading.Event)]
+            if snapshots:
+                #  排队的快照只需要写最新的一份
+                snapshot, fields, requests = snapshots[-1]
+                for _, _fields, _requests in snapshots[:-1]:
+                    fields |= _fields
+                    requests += _requests
+                self.__write(snapshot, fields, requests)
+            for event in events:
+                event.set()
+
+    def __write(self, snapshot, fields, requests):
+        try:
+            text = json.dumps(snapshot, ensure_ascii=False, indent=4)
+            if text == self.lastText:
+                return
+            temp = self.filePath.with_suffix(".tmp")
+            with open(temp, "w", encoding="utf-8") as writer:
+                writer.write(text)
+                writer.flush()
+                os.fsync(writer.fileno())
+            os.replace(temp, self.filePath)
+            self.lastText = text
+            debug(f"配置已保存: {','.join(sorted(fields))} (合并了 {requests} 次保存请求)")
+        except Exception as e:
+            error(f"保存配置文件出错\n{e}\n{tb.format_exc()}\n{snapshot}")
+
 
-        if not kwargs and (self.savePath / self.fileName).exists():
-            kwargs = json.loads((self.savePath / self.fileName).read_text("utf-8"))
+class ConfigSignals(QObject):
+    """配置变更通知: 字段被赋值或notify后, 订阅了这个字段的回调会在GUI线程里被调用"""
+    changed = pyqtSignal(str, object)
 
-        for key in list(kwargs.keys()):
-            self.__setattr__(key, kwargs[key])
-        if not self.memory:
-            self.memory.append({"role": "system", "content": self.appPrompt + self.prompt})
+    def __init__(self):
+        super().__init__()
+        self.subscribers = {}  # field -> [callback]
+        self.changed.connect(self.__dispatch)
 
-        self.save()
+    def subscribe(self, field, callback: Callable):
+        self.subscribers.setdefault(field, []).append(callback)
+
+    def __dispatch(self, field, value):
+        for callback in self.subscribers.get(field, ()):
+            try:
+                callback(value)
+            except Exception as e:
+                error(f"配置变更回调异常:{field}\n{e}\n{tb.format_exc()}")
+
+
+def _runtime(default=None):
+    """不写进config.json的运行时字段"""
+    return field(default=default, init=False, repr=False, metadata={"persist": False})
+
+
+@dataclass(slots=True, weakref_slot=True, eq=False)
+class Config:
+    """
+    全局配置, 启动时由Config.load()读取解析一次, 之后各模块共享同一个实例
+    需要跟随配置变化的地方用subscribe订阅字段, 不要自己轮询或重新读取文件
+    """
+    savePath = Path("config/")
+    fileName = Path("config.json")
+    appPrompt = """
+        你的回复必须使用以下格式,且think与content标签在一次回复中应该各仅有一对(<think>与</think>是一对,<content>与</content>是一对):\n
+        <think>思考内容</think><content>要告诉用户的内容</content>\n
+        其中思考内容要包含你对事情的见解，推测，以及推测如果用户后续做出哪些举动你应该做出什么样的回复(为了辅助你后续衔接上思维)。\n系统设定:\n
+        """
+
+    urls: list = field(default_factory=list)
+    tokenMap: dict = field(default_factory=dict)  # url: [token]  一个url可以有多个key,因为有的url端点会为不同分区key提供不同模型
+    models: dict = field(default_factory=dict)  # token -> [modelName]   同上
+    useModel: dict = field(default_factory=dict)  # token -> modelName
+    useToken: dict = field(default_factory=dict)  # url ->  token
+    useUrl: str = ""
+    prompt: str = ""
+    ip: str = '127.0.0.1'
+    port: int = 5114
+    position: list = field(default_factory=lambda: [0, 0])
+    size: list = field(default_factory=lambda: [0, 0])
+    live2dParameterData: dict = field(default_factory=dict)  # key -> value
+    summary: str = ""  # 更早对话的滚动摘要
+    summaryUntil: int = 0  # 摘要覆盖到memory的哪个下标(不含)
+    contextBudget: dict = field(default_factory=dict)  # modelName -> 每次请求上下文的token预算
+    defaultContextBudget: int = 16000
+
+    enabledImageModal: bool = False
+    windowOnTop: bool = True
+    streamOutPut: bool = True
+    typewriterSpeed: int = 20  # 打字机效果每秒显示的字符数,0为立即显示
+    frameRate: int = 60  # 有动画时的帧率
+    idleFrameRate: int = 10  # 空闲时(只有呼吸/眨眼)的帧率
+    autoBreath: bool = True
+    autoBlink: bool = True
+    metricsEnabled: bool = False  # 在 http://metricsHost:metricsPort/metrics 提供请求统计(文本格式)
+    metricsHost: str = "127.0.0.1"  # 默认只允许本机访问
+    metricsPort: int = 5115
+    traceRequests: bool = False  # 把请求和回复记录到 log/traces/ (按traceSampleRate抽样)
+    traceSampleRate: float = 0.2
+    streamUsage: bool = True  # 流式请求带上stream_options.include_usage, 让服务端在最后返回token用量
+    imageMaxEdge: int = 1568  # 发给视觉模型的图片长边最大像素数
+    imageQuality: int = 85  # 重新编码为jpeg时的质量
+    speechEnabled: bool = False  # 用本地引擎把回复读出来
+    speechEngine: str = "espeak-ng"  # espeak-ng / piper
+    speechVoice: str = ""  # espeak-ng的语音名(cmn / ja / en-us ...), piper的.onnx模型路径
+    speechSpeed: float = 1.0
+    speechLatencyTarget: float = 1.5  # 从第一个content字符到第一个音频采样的目标延迟(秒)
+
+    saver: ConfigSaver | None = _runtime()
+    signals: ConfigSignals | None = _runtime()
+    _memory: ConversationMemory | None = _runtime()
+    _legacyMemory: list | None = _runtime()
+
+    def __post_init__(self):
+        self.signals = ConfigSignals()
+        self.saver = ConfigSaver(self)
+
+    @classmethod
+    def load(cls):
+        """读取并校验config.json(只解析一次), 类型不对的字段使用默认值"""
+        startTime = time.perf_counter()
+        cls.savePath.mkdir(parents=True, exist_ok=True)
+        filePath = cls.savePath / cls.fileName
+        data = {}
+        if filePath.exists():
+            try:
+                data = json.loads(filePath.read_text("utf-8"))
+            except ValueError as e:
+                error(f"配置文件解析失败,使用默认配置\n{e}\n{tb.format_exc()}")
+        legacyMemory = data.pop("memory", None)
+        values = {}
+        for _field in fields(cls):
+            if not _field.init or _field.name not in data:
+                continue
+            value = data[_field.name]
+            if _field.type is int and isinstance(value, float) and value.is_integer():
+                value = int(value)
+            if isinstance(value, _field.type) and not (_field.type is not bool and isinstance(value, bool)):
+                values[_field.name] = value
+            elif value is not None:
+                warn(f"配置项 {_field.name} 的类型应为 {_field.type.__name__},实际为 {type(value).__name__},使用默认值")
+        config = cls(**values)
+        if legacyMemory:
+            #  旧版本把对话记录存在config.json里,迁移到memory.jsonl,并重新保存去掉它
+            config._legacyMemory = legacyMemory
+            _ = config.memory
+            config.save()
+        debug(f"配置加载耗时 {(time.perf_counter() - startTime) * 1000:.2f}ms")
+        return config
+
+    @property
+    def memory(self) -> ConversationMemory:
+        """对话记录在第一次用到时才读取"""
+        if self._memory is None:
+            memory = ConversationMemory(self.savePath / "memory.jsonl")
+            if self._legacyMemory and not memory:
+                info(f"迁移旧配置中的 {len(self._legacyMemory)} 条对话记录")
+                memory.reset(self._legacyMemory)
+            self._legacyMemory = None
+            if not memory:
+                memory.append({"role": "system", "content": self.appPrompt + self.prompt})
+            self._memory = memory
+        return self._memory
+
+    def subscribe(self, field, callback: Callable):
+        """订阅某个字段的变化, callback(新值)在GUI线程执行"""
+        self.signals.subscribe(field, callback)
+
+    def notify(self, *fields):
+        """字典/列表被原地修改后调用: 标记需要保存并通知订阅者"""
+        for _field in fields:
+            self.saver.markDirty(_field)
+            self.signals.changed.emit(_field, getattr(self, _field))
 
     def setLive2dParameterData(self, key, value):
         self.live2dParameterData[key] = value
@@ -580,73 +1670,78 @@ class Config:
     def setPrompt(self, newPrompt=None):
         if newPrompt is not None:
             self.prompt = newPrompt
-        self.memory = []
-        self.memory.append({"role": "system", "content": self.appPrompt + self.prompt})
+        self.memory.reset([{"role": "system", "content": self.appPrompt + self.prompt}])
+        self.summary = ""
+        self.summaryUntil = 0
+
+    def __setattr__(self, key, value):
+        saver = getattr(self, "saver", None)
+        changed = saver is not None and key in saver.fields and getattr(self, key, saver) != value
+        object.__setattr__(self, key, value)
+        if changed:
+            saver.markDirty(key)
+            self.signals.changed.emit(key, value)
 
     def save(self):
-        try:
-            (self.savePath / self.fileName).write_text(json.dumps(self.export(), ensure_ascii=False, indent=4),
-                                                       encoding="utf-8")
-        except Exception as e:
-            error(f"保存配置文件出错\n{e}\n{tb.format_exc()}\n{self.export()}")
+        """请求保存,实际写入由ConfigSaver合并后在后台完成; 字典/列表原地修改后需要手动调用"""
+        self.saver.markDirty()
 
-    def export(self):
-        return {"urls": self.urls,
-                "tokenMap": self.tokenMap,
-                "useModel": self.useModel,
-                "windowOnTop": self.windowOnTop,
-                "autoBreath": self.autoBreath,
-                "autoBlink": self.autoBlink,
-                "models": self.models,
-                "prompt": self.prompt,
-                "memory": self.memory,
-                "ip": self.ip,
-                "port": self.port,
-                "streamOutPut": self.streamOutPut,
-                "useUrl": self.useUrl,
-                "useToken": self.useToken,
-                "position": self.position,
-                "live2dParameterData": self.live2dParameterData,
-                "size": self.size,
-                "enabledImageModal": self.enabledImageModal,
-
-                }
+    def flush(self):
+        self.saver.flush()
 
-    def read(self) -> dict:
-        if (self.savePath / self.fileName).exists():
-            return json.loads((self.savePath / self.fileName).read_text("utf-8"))
+    def export(self):
+        return {_field.name: getattr(self, _field.name) for _field in fields(self)
+                if _field.metadata.get("persist", True)}
 
 
 class FunctionManager:
+    """工具注册表, 按名字O(1)查找; 发给api的工具表只在注册新工具时重建一次"""
 
     def __init__(self):
-        self.functions: List[Function] = []
-
-    def tools(self):
-        return [i.obj for i in self.functions]
+        self.functions: dict[str, Function] = {}
+        self.__tools: List[dict] | None = None
+        self.__toolsJson: str = "[]"
+        self.version: str = ""
+
+    def tools(self) -> List[dict]:
+        if self.__tools is None:
+            self.__tools = [i.obj for i in self.functions.values()]
+            self.__toolsJson = json.dumps(self.__tools, ensure_ascii=False, separators=(",", ":"))
+            self.version = hashlib.sha1(self.__toolsJson.encode("utf-8")).hexdigest()[:12]
+            debug(f"工具表已更新: {len(self.__tools)} 个工具, 版本 {self.version}")
+        return self.__tools
+
+    def toolsJson(self) -> str:
+        self.tools()
+        return self.__toolsJson
 
     def add(self, function: Function):
-        self.functions.append(function)
+        #  同名工具以后注册的为准
+        self.functions[function.name] = function
+        self.__tools = None
 
     def openai_function(self, func=None):
         if func:
             _function = Function(func)
-            self.functions.append(_function)
+            self.add(_function)
             return _function
 
         def __function(func: Callable):
             _function = Function(func)
-            self.functions.append(_function)
+            self.add(_function)
             return _function
 
         return __function
 
     def get(self, functionName) -> Function | None:
-        for _function in self.functions:
-            if _function.name == functionName:
-                return _function
-        else:
-            return None
+        return self.functions.get(functionName)
+
+    def call(self, functionName, arguments: str | dict | None = None):
+        """校验参数后调用工具, 工具不存在或参数不合法时抛出ToolArgumentError"""
+        _function = self.functions.get(functionName)
+        if _function is None:
+            raise ToolArgumentError(f"没有名为 {functionName} 的工具")
+        return _function(arguments)
 
 
 class MainWindow(QMainWindow):
@@ -654,7 +1749,7 @@ class MainWindow(QMainWindow):
     def autoSaveConfigMethod(self):
         self.config.save()
 
-    def __init__(self):
+    def __init__(self, config):
         super().__init__()
 
         self.startPosition = (0, 0)
@@ -664,19 +1759,23 @@ class MainWindow(QMainWindow):
         self.is_topmost = False
 
         self.animationController: AnimationController = AnimationController()
+        self.commandBus: CommandBus = CommandBus()  # 其他线程对界面/模型的修改都通过它交给渲染线程
+        self.choreographer: Choreographer = Choreographer(self.commandBus)  # AI的工具调用编排成动作时间线
+        self.imagePipeline: ImagePipeline = ImagePipeline(config.imageMaxEdge, config.imageQuality)
+        self.thumbnailCache: ThumbnailCache = ThumbnailCache()
 
         self.autoSaveConfig = QTimer()
         self.autoSaveConfig.timeout.connect(self.autoSaveConfigMethod)
-        self.function = None
+        self.idleTimer = QTimer()  # 空闲时做后台整理(对话摘要)
+        self.idleTimer.timeout.connect(self.idleWork)
         self.aiName = "橘雪莉"
         self.resize(*self.windowSize)
         self.setWindowTitle("通用框架可行性测试")
         self.ai: AI | None = None
-        self.config: Config | None = None
+        self.config: Config = config
         self.settingWindow: SettingWindow | None = None
         self.isClose = False
         self.bodyController: BodyController = BodyController(self)
-        self.enabledImageModal = False  # 是否启用视觉模态
 
         self.thinkThread: th | None = None
 
@@ -763,6 +1862,8 @@ class MainWindow(QMainWindow):
 
         self.openglWidget = OpenGlWidget(self)
         self.openglWidget.setCursor(Qt.OpenHandCursor)
+        QShortcut(QKeySequence("F3"), self, self.openglWidget.toggleProfiler)
+        QShortcut(QKeySequence("Shift+F3"), self, self.openglWidget.exportProfile)
 
         self.contentWidget = QWidget()  # 要往这里面添加功能性组件
         self.contentLayout = QVBoxLayout(self.contentWidget)
@@ -775,6 +1876,10 @@ class MainWindow(QMainWindow):
         self.AIMessage.viewport().setCursor(Qt.ArrowCursor)
         self.AIMessage.setPlaceholderText(f"与 {self.aiName} 聊些什么")
         self.contentLayout.addWidget(self.AIMessage)
+        self.typewriter: Typewriter = Typewriter(self.AIMessage)
+        self.lipSync: LipSync = LipSync(self.animationController)  # 跟着打字机的显示进度动嘴
+        self.speech: SpeechPipeline = SpeechPipeline(self.animationController)  # 开启语音时由音频包络动嘴
+        self.AIMessage.viewport().installEventFilter(self)  # 点击AI消息跳过打字效果
         self.contentLayout.addStretch()
 
         self.userMessage = PlainTextEdit(self)
@@ -800,6 +1905,7 @@ class MainWindow(QMainWindow):
             self.isClose = False
 
     def mousePressEvent(self, a0):
+        self.openglWidget.scheduler.wake()
         self.dragging = a0.button() == Qt.LeftButton
         if self.dragging:
             self.startPosition = a0.globalPos() - self.pos()
@@ -817,12 +1923,49 @@ class MainWindow(QMainWindow):
         self.setAIMessage(self.ai.getLastAIMessage())
         self.resize(*self.config.size)
         self.move(*self.config.position)
-        self.enabledImageModal = self.config.enabledImageModal
+        self.typewriter.speed = self.config.typewriterSpeed
+        self.config.subscribe("typewriterSpeed", lambda value: setattr(self.typewriter, "speed", value))
+        self.config.subscribe("imageMaxEdge", lambda value: setattr(self.imagePipeline, "maxEdge", value))
+        self.config.subscribe("imageQuality", lambda value: setattr(self.imagePipeline, "quality", value))
+        self.typewriter.onFeed = self.onTextFeed
+        self.typewriter.onFinish = self.onTextFinish
+        self.configureSpeech()
+        for _field in ("speechEnabled", "speechEngine", "speechVoice", "speechSpeed"):
+            self.config.subscribe(_field, lambda value: self.configureSpeech())
+        self.config.subscribe("speechLatencyTarget", lambda value: setattr(self.speech, "target", value))
         self.autoSaveConfig.start(20000)
+        self.idleTimer.start(30000)
+
+    def configureSpeech(self):
+        self.speech.target = self.config.speechLatencyTarget
+        self.speech.configure(self.config.speechEnabled, self.config.speechEngine, self.config.speechVoice,
+                              self.config.speechSpeed)
+
+    def onTextFeed(self, text, rate):
+        """打字机收到新文本: 开启语音时交给语音(嘴型跟着音频), 否则按文字节奏动嘴"""
+        if not self.speech.feed(text):
+            self.lipSync.feed(text, rate)
+
+    def onTextFinish(self):
+        if not self.speech.enabled:
+            self.lipSync.stop()
+
+    def idleWork(self):
+        if self.thinkThread and self.thinkThread.is_alive():
+            return
+        if time.time() - self.ai.lastedChat < 60:
+            return
+        self.ai.summarizeInBackground()
 
     def setAIMessage(self, text):
+        self.typewriter.stop()
         self.AIMessage.setPlainText(text)
 
+    def eventFilter(self, a0, a1):
+        if a0 is self.AIMessage.viewport() and a1.type() == QEvent.MouseButtonPress:
+            self.typewriter.skip()
+        return super().eventFilter(a0, a1)
+
     def toggle_topmost(self):
         flags = self.windowFlags()
 
@@ -833,33 +1976,801 @@ class MainWindow(QMainWindow):
             flags |= Qt.WindowStaysOnTopHint
             self.is_topmost = True
         self.config.windowOnTop = self.is_topmost
-        self.config.save()
         self.setWindowFlags(flags)
         self.show()
 
     def resizeEvent(self, a0):
-        size = a0.size()
-        self.config.size = [size.width(), size.height()]
-        self.config.save()
+        if self.config:
+            size = a0.size()
+            self.config.size = [size.width(), size.height()]
+
+    def moveEvent(self, a0):
+        if self.config:
+            self.config.position = [self.x(), self.y()]
 
     def chat(self):
         if not self.thinkThread or self.thinkThread.ident is not None and not self.thinkThread.is_alive():
             if not bool(self.userMessage.toPlainText()):
                 return
 
-            #  这里还要添加  图片处理
+            #  图片在线程池里预处理(拖进来时就已经开始了), 在AI的工作线程里等结果, 不卡界面
             images = []
-            if self.enabledImageModal and self.userMessage.images:
-                for image in self.userMessage.images:
-                    images.append(f"data:image/jpeg;base64,{base64.b64encode(Path(image).read_bytes()).decode("utf-8")}")
-
-            self.ai.addUserMessage(self.userMessage.toPlainText(), images)
-            self.userMessage.setPlaceholderText(self.userMessage.toPlainText())
-            self.AIMessage.setPlainText(f"{self.aiName} 思考中...")
+            if self.config.enabledImageModal and self.userMessage.images:
+                images = [self.imagePipeline.prefetch(image) for image in self.userMessage.images]
+
+            text = self.userMessage.toPlainText()
+            self.userMessage.setPlaceholderText(text)
+            self.speech.stop()
+            #  和AI线程里的设置文本走同一个key, 上一轮还没执行的文本更新会被作废
+            self.commandBus.post(lambda: self.setAIMessage(f"{self.aiName} 思考中..."), key="aiText")
             self.userMessage.clear()
-            self.thinkThread = th(target=self.ai.chat)
+            self.thinkThread = th(target=lambda: self.think(text, images))
             self.thinkThread.daemon = True
             self.thinkThread.start()
+            self.openglWidget.scheduler.wake()
+
+    def think(self, text, images: List[concurrent.futures.Future]):
+        """AI工作线程: 等图片预处理完, 写入用户消息, 然后请求回复"""
+        dataUrls = []
+        for future in images:
+            try:
+                dataUrls.append(future.result())
+            except Exception as e:
+                error(f"图片预处理失败, 已跳过:\n{e}")
+        self.ai.addUserMessage(text, dataUrls)
+        self.ai.chat()
+
+
+class Typewriter:
+    """
+    打字机效果,由渲染循环每帧调用tick驱动
+    每帧只把新露出来的字符追加到文档末尾,不再重建整段文本;
+    speed为每秒显示的字符数,0为立即全部显示;
+    流式输出时积压的字符越多显示得越快,保证显示进度大约只落后生成进度catchUp秒
+    """
+
+    def __init__(self, textEdit: QPlainTextEdit, speed: float = 20, catchUp: float = 1.5):
+        self.textEdit = textEdit
+        self.speed = speed
+        self.catchUp = catchUp
+        self.queue = collections.deque()  # 还没显示的文本片段
+        self.queued = 0  # 还没显示的字符数
+        self.budget = 0.0  # 累计下来还没用掉的"可显示字符数"
+        self.lastTick = None
+        self.streaming = False
+        self.onType: Callable[[], None] | None = None  # 本帧有新字符显示
+        self.onFeed: Callable[[str, float], None] | None = None  # 新文本进入队列, 参数为文本和预计的显示速度
+        self.onFinish: Callable[[], None] | None = None  # 积压的字符全部显示完, 或者被stop清空
+
+    def isTyping(self):
+        return self.queued > 0
+
+    def rate(self):
+        """当前每秒显示的字符数, 0为立即显示"""
+        if self.speed <= 0:
+            return 0
+        return max(self.speed, self.queued / self.catchUp) if self.streaming else self.speed
+
+    def start(self, text="", streaming=False):
+        """清空当前显示,开始显示一段新文本; streaming为True时后续文本会继续feed进来"""
+        self.stop()
+        self.streaming = streaming
+        self.textEdit.setPlainText("")
+        self.feed(text)
+
+    def feed(self, text):
+        """追加要显示的文本,流式输出的每个片段直接feed进来"""
+        if not text:
+            return
+        if not self.queued:
+            self.lastTick = None
+        self.queue.append(text)
+        self.queued += len(text)
+        if self.onFeed:
+            self.onFeed(text, self.rate())
+
+    def append(self, text):
+        """另起一行接在当前显示的文本后面"""
+        if text and (self.queued or not self.textEdit.document().isEmpty()):
+            text = "\n" + text
+        self.feed(text)
+
+    def endStream(self):
+        """流式输出结束, 不再按积压量加速"""
+        self.streaming = False
+
+    def stop(self):
+        queued = self.queued
+        self.queue.clear()
+        self.queued = 0
+        self.budget = 0.0
+        self.streaming = False
+        if queued and self.onFinish:
+            self.onFinish()
+
+    def skip(self):
+        """用户点击跳过: 积压的文本一次性显示完"""
+        if self.queued:
+            self.__append(self.__take(self.queued))
+            self.__finish()
+
+    def tick(self, now):
+        if not self.queued:
+            return
+        if self.speed <= 0:
+            count = self.queued
+        else:
+            if self.lastTick is None:
+                self.lastTick = now
+                self.budget = 1.0
+            self.budget += (now - self.lastTick) * self.rate()
+            self.lastTick = now
+            count = min(int(self.budget), self.queued)
+            self.budget -= count
+        if count:
+            self.__append(self.__take(count))
+            if self.onType:
+                self.onType()
+        if not self.queued:
+            self.__finish()
+
+    def __take(self, count):
+        parts = []
+        self.queued -= count
+        while count:
+            chunk = self.queue.popleft()
+            if len(chunk) > count:
+                self.queue.appendleft(chunk[count:])
+                chunk = chunk[:count]
+            parts.append(chunk)
+            count -= len(chunk)
+        return "".join(parts)
+
+    def __append(self, text):
+        self.textEdit.moveCursor(QTextCursor.End)
+        self.textEdit.insertPlainText(text)
+        self.textEdit.ensureCursorVisible()
+
+    def __finish(self):
+        self.budget = 0.0
+        if self.onFinish:
+            self.onFinish()
+
+
+class LipSync:
+    """
+    把要显示的文本换成预先算好的口型曲线(张嘴程度 + 嘴型偏移, 每秒rate个采样), 交给AnimationController逐帧播放
+    曲线和打字机对齐: 每个字符占 1/字符速度 秒; 汉字/假名/数字每个算一个音节, 英文按元音组算音节,
+    音节太密时合并, 保证每秒最多maxSyllables次开合; 逗号等停顿处半闭, 句末标点闭嘴;
+    每个音节的张嘴幅度和嘴型由字符算出的伪随机数决定, 同一段文字每次生成的曲线一样
+    流式输出时每个片段的曲线从上一个片段结束时的口型接着算, 接在正在播放的曲线后面; 显示停止时由stop淡出闭嘴
+    """
+    rate = 60
+    maxSyllables = 7.0
+    sentenceEnd = set("。！？!?…\n")
+    pauses = set("，、,;；:：\"“”'‘’()（）《》「」『』~～-—") | {" ", "\t"}
+    vowels = set("aeiouyAEIOUY")
+    roundVowels = set("ouOU")  # 圆唇, 嘴型往负方向
+
+    def __init__(self, controller: AnimationController, openId: str = mouth_id, formId: str = "ParamMouthForm",
+                 openGain: float = 0.9, formGain: float = 0.25):
+        self.controller = controller
+        self.openId = openId
+        self.formId = formId
+        self.openGain = openGain
+        self.formGain = formGain
+        kernel = np.hanning(7)
+        self.kernel = kernel / kernel.sum()
+        self.state = (0.0, 0.0, "", 1.0)  # 上一个片段结束时的 (张嘴程度, 嘴型, 最后一个字符, 距上一个音节的秒数)
+
+    @staticmethod
+    def jitter(char) -> float:
+        """字符 -> [0, 1) 的固定伪随机数"""
+        return (ord(char) * 2654435761 & 0xFFFFFFFF) / 4294967296.0
+
+    def generate(self, text: str, charRate: float, state=(0.0, 0.0, "", 1.0)):
+        """返回 (张嘴程度, 嘴型偏移, 结束时的状态), state为接着生成的起始状态"""
+        slot = 1.0 / charRate
+        gap = 1.0 / self.maxSyllables
+        mouthOpen, mouthForm, previous, since = state
+        times, opens, forms = [0.0], [mouthOpen], [mouthForm]
+        lastOnset = -since
+        for position, char in enumerate(text):
+            t = position * slot
+            if char in self.sentenceEnd:
+                times += [t, t + slot]
+                opens += [opens[-1], 0.0]
+                forms += [forms[-1], 0.0]
+                lastOnset = -gap
+            elif char in self.pauses:
+                times += [t, t + slot]
+                opens += [opens[-1], min(opens[-1], 0.15)]
+                forms += [forms[-1], forms[-1] * 0.5]
+            else:
+                if char.isascii() and char.isalpha():
+                    onset = char in self.vowels and previous not in self.vowels
+                else:
+                    onset = True
+                if onset and t - lastOnset >= gap:
+                    lastOnset = t
+                    value = self.jitter(char)
+                    if char in self.vowels:
+                        form = -0.8 if char in self.roundVowels else 0.6
+                    else:
+                        form = value * 2 - 1
+                    times += [t, t + slot * 0.5]
+                    opens += [min(opens[-1], 0.2), 0.55 + 0.45 * value]
+                    forms += [forms[-1], form]
+            previous = char
+        end = len(text) * slot
+        times.append(end)
+        opens.append(opens[-1])
+        forms.append(forms[-1])
+
+        t = np.arange(max(int(end * self.rate), 1)) / self.rate
+        pad = len(self.kernel) // 2
+        mouthOpen = np.convolve(np.pad(np.interp(t, times, opens), pad, mode="edge"), self.kernel, mode="valid")
+        mouthForm = np.convolve(np.pad(np.interp(t, times, forms), pad, mode="edge"), self.kernel, mode="valid")
+        state = (opens[-1], forms[-1], previous, end - lastOnset)
+        return np.clip(mouthOpen * self.openGain, 0.0, 1.0), np.clip(mouthForm * self.formGain, -1.0, 1.0), state
+
+    def feed(self, text: str, charRate: float):
+        """打字机收到新文本时调用(渲染线程); 立即显示(charRate为0)时不动嘴"""
+        if charRate <= 0 or not text:
+            return
+        if not self.controller.isPlaying(self.openId):
+            self.state = (0.0, 0.0, "", 1.0)
+        mouthOpen, mouthForm, self.state = self.generate(text, charRate, self.state)
+        self.controller.playTrack(self.openId, mouthOpen, self.rate)
+        self.controller.playTrack(self.formId, mouthForm, self.rate, additive=True)
+
+    def stop(self):
+        """文字显示停止: 嘴在很短时间内合上"""
+        self.controller.stopTrack(self.openId, 0.08)
+        self.controller.stopTrack(self.formId, 0.08)
+
+
+class SpeechEngine(ABC):
+    """本地语音合成引擎, synthesize在线程池里调用, 返回单声道float32采样(-1~1)和采样率"""
+    name = ""
+    executable = ""
+
+    def __init__(self, voice: str = "", speed: float = 1.0):
+        self.voice = voice
+        self.speed = speed
+
+    def available(self) -> bool:
+        return shutil.which(self.executable) is not None
+
+    def run(self, command, text) -> bytes:
+        return subprocess.run(command, input=text.encode("utf-8"), capture_output=True, timeout=30,
+                              check=True).stdout
+
+    @abstractmethod
+    def synthesize(self, text: str) -> tuple[np.ndarray, int]:
+        pass
+
+
+class EspeakEngine(SpeechEngine):
+    """espeak-ng, voice为语音名(比如 cmn / ja / en-us), 留空用默认语音"""
+    name = "espeak-ng"
+    executable = "espeak-ng"
+
+    def synthesize(self, text):
+        command = [self.executable, "--stdout", "-s", str(int(175 * self.speed))]
+        if self.voice:
+            command += ["-v", self.voice]
+        return self.decodeWav(self.run(command, text))
+
+    @staticmethod
+    def decodeWav(data: bytes) -> tuple[np.ndarray, int]:
+        """
+        解析16位PCM的wav; 输出到管道时espeak-ng没法回头改写长度字段,
+        所以data块的长度不可信, 直接取到文件末尾
+        """
+        position, rate = 12, 22050
+        while position + 8 <= len(data):
+            chunk, size = struct.unpack_from("<4sI", data, position)
+            if chunk == b"fmt ":
+                rate = struct.unpack_from("<I", data, position + 12)[0]
+            elif chunk == b"data":
+                body = data[position + 8:]
+                body = body[:len(body) // 2 * 2]
+                return np.frombuffer(body, dtype="<i2").astype(np.float32) / 32768.0, rate
+            position += 8 + size + (size & 1)
+        raise ValueError("语音合成的输出不是有效的wav")
+
+
+class PiperEngine(SpeechEngine):
+    """piper, voice为.onnx模型的路径, 采样率从旁边的 .onnx.json 读取"""
+    name = "piper"
+    executable = "piper"
+
+    def available(self):
+        return super().available() and Path(self.voice).is_file()
+
+    def synthesize(self, text):
+        command = [self.executable, "--model", self.voice, "--output_raw", "--length_scale", f"{1 / self.speed:.3f}"]
+        rate = 22050
+        modelConfig = Path(f"{self.voice}.json")
+        if modelConfig.is_file():
+            rate = json.loads(modelConfig.read_text("utf-8")).get("audio", {}).get("sample_rate", rate)
+        data = self.run(command, text.replace("\n", " ") + "\n")
+        data = data[:len(data) // 2 * 2]
+        return np.frombuffer(data, dtype="<i2").astype(np.float32) / 32768.0, rate
+
+
+SPEECH_ENGINES = {engine.name: engine for engine in (EspeakEngine, PiperEngine)}
+
+
+class AudioSink:
+    """QAudioOutput推模式的包装: 按采样率建立输出设备(单声道16位), write写入设备当前能接收的部分"""
+
+    def __init__(self, bufferSeconds: float = 0.2):
+        self.bufferSeconds = bufferSeconds
+        self.output: QAudioOutput | None = None
+        self.device: QIODevice | None = None
+        self.rate = 0
+
+    def open(self, rate: int):
+        if self.output is not None and rate == self.rate:
+            return
+        self.stop()
+        audioFormat = QAudioFormat()
+        audioFormat.setSampleRate(rate)
+        audioFormat.setChannelCount(1)
+        audioFormat.setSampleSize(16)
+        audioFormat.setCodec("audio/pcm")
+        audioFormat.setByteOrder(QAudioFormat.LittleEndian)
+        audioFormat.setSampleType(QAudioFormat.SignedInt)
+        self.output = QAudioOutput(audioFormat)
+        self.output.setBufferSize(int(rate * 2 * self.bufferSeconds))
+        self.device = self.output.start()
+        self.rate = rate
+
+    def write(self, data: bytes) -> int:
+        if self.output is None or self.device is None:
+            return len(data)
+        size = min(self.output.bytesFree(), len(data))
+        return max(self.device.write(data[:size]), 0) if size > 0 else 0
+
+    def stop(self):
+        if self.output is not None:
+            self.output.stop()
+        self.output = self.device = None
+        self.rate = 0
+
+
+class SpeechPipeline(QObject):
+    """
+    流式语音: 打字机收到的<content>文本先攒进缓冲, 按句子切块交给线程池里的本地引擎合成,
+    块按顺序播放, 第N块播放时后面的块已经在合成; 嘴型用音频每帧的RMS包络作为曲线交给AnimationController
+    一轮回复的第一块切得更短(估计合成耗时不超过target的一半), 记录从第一个content字符到第一个音频采样写入设备的延迟
+    播放由GUI线程的定时器推进, 只在有待播放的内容时运行
+    """
+    sentenceEnd = set("。！？!?…\n")
+    softBreak = set("，、,;；：:")
+    frameRate = 60  # 嘴型包络的采样率
+
+    def __init__(self, controller: AnimationController, target: float = 1.5, workers: int = 2,
+                 parameter: str = mouth_id):
+        super().__init__()
+        self.controller = controller
+        self.parameter = parameter
+        self.target = target
+        self.engine: SpeechEngine | None = None
+        self.enabled = False
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="speech")
+        self.sink = AudioSink()
+        self.buffer = ""
+        self.generation = 0  # stop()后递增, 旧的合成结果直接丢弃
+        self.pending: collections.deque = collections.deque()  # 按顺序等待播放的Future
+        self.playing = b""  # 当前块还没写进设备的部分
+        self.utteranceStart: float | None = None  # 本轮第一个content字符进来的时间
+        self.chunks = 0  # 本轮已经切出的块数
+        self.awaitingAudio = False
+        self.latencies = collections.deque(maxlen=200)
+        self.secondsPerChar = 0.02  # 合成耗时估计(指数平均)
+        self.pumpTimer = QTimer()
+        self.pumpTimer.setInterval(15)
+        self.pumpTimer.timeout.connect(self.pump)
+        self.flushTimer = QTimer()
+        self.flushTimer.setSingleShot(True)
+        self.flushTimer.timeout.connect(self.flush)
+
+    def configure(self, enabled: bool, engine: str, voice: str, speed: float):
+        """按配置建立引擎, 引擎或音频输出不可用时保持关闭并说明原因"""
+        self.stop()
+        self.enabled = False
+        self.engine = None
+        if not enabled:
+            return
+        if QAudioOutput is None:
+            warn("没有可用的QtMultimedia, 语音已关闭")
+            return
+        engineClass = SPEECH_ENGINES.get(engine)
+        if engineClass is None:
+            warn(f"未知的语音引擎: {engine}, 可选: {', '.join(SPEECH_ENGINES)}")
+            return
+        self.engine = engineClass(voice, speed)
+        if not self.engine.available():
+            warn(f"语音引擎 {engine} 不可用(没有找到可执行文件或语音模型), 语音已关闭")
+            self.engine = None
+            return
+        self.enabled = True
+        info(f"语音已开启: {engine} {voice}")
+
+    def isIdle(self):
+        return not self.buffer and not self.pending and not self.playing
+
+    def feed(self, text: str) -> bool:
+        """打字机收到新文本时调用(GUI线程); 返回是否由语音接管嘴型"""
+        if not self.enabled or not text:
+            return False
+        if self.isIdle():
+            self.utteranceStart = time.perf_counter()
+            self.chunks = 0
+            self.awaitingAudio = True
+        self.buffer += text
+        while (cut := self.findCut()) is not None:
+            self.submit(self.buffer[:cut])
+            self.buffer = self.buffer[cut:]
+        if not self.chunks and self.buffer and time.perf_counter() - self.utteranceStart > self.target * 0.3:
+            #  第一句迟迟等不到标点, 为了延迟先把已有的部分合成
+            self.flush()
+        self.flushTimer.start(300)
+        return True
+
+    def findCut(self) -> int | None:
+        """缓冲里下一块的结束位置; 第一块在逗号处就切, 并限制长度"""
+        first = not self.chunks
+        limit = int(min(max(self.target * 0.5 / max(self.secondsPerChar, 1e-4), 4), 60)) if first else 200
+        for i, char in enumerate(self.buffer):
+            if char in self.sentenceEnd or first and char in self.softBreak and i >= 1:
+                return i + 1
+            if i + 1 >= limit:
+                space = self.buffer.rfind(" ", 0, i + 1)
+                return space + 1 if space > 0 else i + 1
+        return None
+
+    def flush(self):
+        """把缓冲里剩下的文本作为一块(回复结束或者等了太久)"""
+        self.flushTimer.stop()
+        if self.buffer:
+            self.submit(self.buffer)
+            self.buffer = ""
+
+    def submit(self, text):
+        self.chunks += 1
+        if not any(char.isalnum() for char in text):
+            return
+        self.pending.append(self.executor.submit(self.synthesize, text.strip(), self.generation))
+        self.pumpTimer.start()
+
+    def synthesize(self, text, generation):
+        """线程池里: 合成并算好要写进设备的PCM和嘴型包络"""
+        if generation != self.generation:
+            return None
+        start = time.perf_counter()
+        try:
+            samples, rate = self.engine.synthesize(text)
+        except Exception as e:
+            error(f"语音合成失败: {text[:30]}\n{e}")
+            return None
+        self.secondsPerChar = 0.7 * self.secondsPerChar + 0.3 * (time.perf_counter() - start) / max(len(text), 1)
+        pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype("<i2").tobytes()
+        envelope, envelopeRate = self.envelope(samples, rate, self.frameRate)
+        return generation, pcm, rate, envelope, envelopeRate
+
+    @staticmethod
+    def envelope(samples: np.ndarray, rate: int, frameRate: int = 60) -> tuple[np.ndarray, float]:
+        """每帧的RMS, 按这段音频的95百分位归一化, 小于噪声门的部分当作闭嘴; 返回 (包络, 包络的采样率)"""
+        hop = max(int(round(rate / frameRate)), 1)
+        count = len(samples) // hop
+        if not count:
+            return np.zeros(1), rate / hop
+        frames = samples[:count * hop].reshape(count, hop)
+        rms = np.sqrt(np.mean(np.square(frames, dtype=np.float64), axis=1))
+        level = np.clip(rms / max(float(np.percentile(rms, 95)), 1e-4), 0.0, 1.0)
+        level = np.where(level < 0.1, 0.0, level) ** 0.7
+        kernel = np.hanning(5)
+        level = np.convolve(np.pad(level, 2, mode="edge"), kernel / kernel.sum(), mode="valid")
+        return np.append(level, 0.0), rate / hop
+
+    def pump(self):
+        """GUI线程的定时器: 把音频写进设备, 当前块写完就开始下一块"""
+        if self.playing:
+            written = self.sink.write(self.playing)
+            self.playing = self.playing[written:]
+        while not self.playing and self.pending and self.pending[0].done():
+            future = self.pending.popleft()
+            result = None if future.cancelled() else future.result()
+            if result is None or result[0] != self.generation:
+                continue
+            _, pcm, rate, envelope, envelopeRate = result
+            self.sink.open(rate)
+            if self.awaitingAudio:
+                self.awaitingAudio = False
+                latency = time.perf_counter() - self.utteranceStart
+                self.latencies.append(latency)
+                if latency > self.target:
+                    warn(f"语音首句延迟 {latency:.2f}s 超过目标 {self.target:.2f}s")
+                else:
+                    debug(f"语音首句延迟 {latency:.2f}s")
+            self.controller.playTrack(self.parameter, envelope, envelopeRate)
+            self.playing = pcm[self.sink.write(pcm):]
+        if self.isIdle():
+            self.pumpTimer.stop()
+
+    def stop(self):
+        """打断: 丢掉缓冲、还没播放的块和正在播放的音频"""
+        self.generation += 1
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.buffer = ""
+        self.playing = b""
+        self.awaitingAudio = False
+        self.flushTimer.stop()
+        self.pumpTimer.stop()
+        self.sink.stop()
+        self.controller.stopTrack(self.parameter, 0.08)
+
+    def summary(self) -> str:
+        if not self.enabled:
+            return "语音未开启"
+        lines = [f"引擎: {self.engine.name} {self.engine.voice}", f"首句延迟目标: {self.target:.2f}s",
+                 f"合成速度估计: {self.secondsPerChar * 1000:.1f} ms/字"]
+        if self.latencies:
+            latencies = np.array(self.latencies)
+            lines.append(f"首句延迟: p50 {np.percentile(latencies, 50):.2f}s  p95 {np.percentile(latencies, 95):.2f}s  "
+                         f"超过目标 {int((latencies > self.target).sum())}/{len(latencies)}")
+        return "\n".join(lines)
+
+
+class ImagePipeline:
+    """
+    视觉模式的图片预处理, 在线程池里完成: 识别真实格式, 长边缩小到maxEdge, 重新编码, 转成data url
+    结果按文件内容的哈希缓存, 同一个文件(路径+修改时间+大小不变)不会再读第二次;
+    图片拖进输入框时就开始预处理(prefetch), 发送时通常已经处理完了
+    """
+    signatures = (
+        (b"\x89PNG\r\n\x1a\n", "png"),
+        (b"\xff\xd8\xff", "jpeg"),
+        (b"GIF87a", "gif"),
+        (b"GIF89a", "gif"),
+        (b"BM", "bmp"),
+    )
+    passthrough = ("png", "jpeg", "gif", "webp")  # 大多数服务商直接支持的格式,不需要缩小时原样发送
+
+    def __init__(self, maxEdge: int = 1568, quality: int = 85, workers: int = 2, cacheSize: int = 32):
+        self.maxEdge = maxEdge
+        self.quality = quality
+        self.cacheSize = cacheSize
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image")
+        self.lock = threading.Lock()
+        self.futures: dict[str, concurrent.futures.Future] = {}
+        self.digests: collections.OrderedDict[tuple, str] = collections.OrderedDict()  # (路径, 修改时间, 大小) -> 内容哈希
+        self.cache: collections.OrderedDict[tuple, str] = collections.OrderedDict()  # (内容哈希, 长边, 质量) -> data url
+
+    @classmethod
+    def detectFormat(cls, data: bytes) -> str | None:
+        for signature, name in cls.signatures:
+            if data.startswith(signature):
+                return name
+        if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+            return "webp"
+        return None
+
+    def prefetch(self, path) -> concurrent.futures.Future:
+        """开始预处理一张图片, 返回的Future结果是data url"""
+        path = str(path)
+        with self.lock:
+            future = self.futures.get(path)
+            if future is None or future.done() and (future.exception() or not self.__fresh(path)):
+                future = self.futures[path] = self.executor.submit(self.encode, path)
+            return future
+
+    def __fresh(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return (path, stat.st_mtime_ns, stat.st_size) in self.digests
+
+    def encode(self, path) -> str:
+        startTime = time.perf_counter()
+        stat = os.stat(path)
+        statKey = (path, stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            digest = self.digests.get(statKey)
+        if digest is not None:
+            dataUrl = self.__cached((digest, self.maxEdge, self.quality))
+            if dataUrl is not None:
+                return dataUrl
+
+        data = Path(path).read_bytes()
+        digest = hashlib.sha1(data).hexdigest()
+        with self.lock:
+            self.digests[statKey] = digest
+            while len(self.digests) > self.cacheSize * 4:
+                self.digests.popitem(last=False)
+        key = (digest, self.maxEdge, self.quality)
+        dataUrl = self.__cached(key)
+        if dataUrl is not None:
+            return dataUrl
+
+        sourceFormat = self.detectFormat(data)
+        image = QImage.fromData(data)
+        if image.isNull():
+            raise ValueError(f"无法识别的图片: {path}")
+        width, height = image.width(), image.height()
+        if max(width, height) > self.maxEdge or sourceFormat not in self.passthrough:
+            if max(width, height) > self.maxEdge:
+                image = image.scaled(self.maxEdge, self.maxEdge, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+            #  有透明通道只能用png; png来源(截图之类)两种都编码一次, 取小的
+            if image.hasAlphaChannel():
+                outputFormat, output = "png", self.save(image, "png")
+            else:
+                outputFormat, output = "jpeg", self.save(image, "jpeg")
+                if sourceFormat == "png":
+                    png = self.save(image, "png")
+                    if len(png) < len(output):
+                        outputFormat, output = "png", png
+        else:
+            outputFormat, output = sourceFormat, data
+        dataUrl = f"data:image/{outputFormat};base64,{base64.b64encode(output).decode('ascii')}"
+
+        with self.lock:
+            self.cache[key] = dataUrl
+            while len(self.cache) > self.cacheSize:
+                self.cache.popitem(last=False)
+        info(f"图片预处理: {Path(path).name} {sourceFormat} {width}x{height} {len(data) // 1024}KB -> "
+             f"{outputFormat} {image.width()}x{image.height()} {len(output) // 1024}KB, "
+             f"耗时 {(time.perf_counter() - startTime) * 1000:.0f}ms")
+        return dataUrl
+
+    def save(self, image: QImage, outputFormat) -> bytes:
+        buffer = QBuffer()
+        buffer.open(QIODevice.WriteOnly)
+        image.save(buffer, outputFormat.upper(), self.quality if outputFormat == "jpeg" else -1)
+        output = bytes(buffer.data())
+        buffer.close()
+        return output
+
+    def __cached(self, key):
+        with self.lock:
+            dataUrl = self.cache.get(key)
+            if dataUrl is not None:
+                self.cache.move_to_end(key)
+            return dataUrl
+
+
+class ThumbnailCache(QObject):
+    """
+    附件缩略图: 在工作线程里用QImageReader按目标尺寸直接解码(不解出整张原图), 居中裁剪成缩略图
+    内存里按LRU保留最近maxItems张, 磁盘上存在cache/thumbnails/<文件哈希>_<宽>x<高>.png,
+    读到磁盘缓存时更新文件的修改时间, 写入新缩略图后按修改时间删掉最久没用的, 最多保留maxDiskItems个/maxDiskBytes字节
+    缩略图准备好后通过ready信号(在界面线程)通知
+    """
+    ready = pyqtSignal(str, QImage)  # 文件路径, 缩略图
+    cachePath = Path("cache/thumbnails/")
+
+    def __init__(self, maxItems: int = 64, workers: int = 1, maxDiskItems: int = 512, maxDiskBytes: int = 32 << 20):
+        super().__init__()
+        self.maxItems = maxItems
+        self.maxDiskItems = maxDiskItems
+        self.maxDiskBytes = maxDiskBytes
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbnail")
+        self.lock = threading.Lock()
+        self.images: collections.OrderedDict[tuple, QImage] = collections.OrderedDict()  # (文件哈希, 宽, 高) -> 缩略图
+        self.digests: dict[tuple, str] = {}  # (路径, 修改时间, 大小) -> 文件哈希
+        self.loading: set = set()
+
+    def request(self, path, size: QSize) -> QImage | None:
+        """内存里有就直接返回, 否则返回None并在后台生成, 生成后发出ready信号"""
+        path = str(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        statKey = (path, stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            digest = self.digests.get(statKey)
+            if digest is not None:
+                image = self.images.get((digest, size.width(), size.height()))
+                if image is not None:
+                    self.images.move_to_end((digest, size.width(), size.height()))
+                    return image
+            if (statKey, size.width(), size.height()) in self.loading:
+                return None
+            self.loading.add((statKey, size.width(), size.height()))
+        self.executor.submit(self.__load, statKey, QSize(size))
+        return None
+
+    def __load(self, statKey, size: QSize):
+        path = statKey[0]
+        width, height = size.width(), size.height()
+        try:
+            with self.lock:
+                digest = self.digests.get(statKey)
+            if digest is None:
+                sha1 = hashlib.sha1()
+                with open(path, "rb") as file:
+                    while chunk := file.read(1 << 20):
+                        sha1.update(chunk)
+                digest = sha1.hexdigest()
+            cacheFile = self.cachePath / f"{digest}_{width}x{height}.png"
+            image = QImage(str(cacheFile)) if cacheFile.exists() else QImage()
+            if not image.isNull():
+                try:
+                    os.utime(cacheFile)
+                except OSError:
+                    pass
+            else:
+                image = self.decode(path, size)
+                if image.isNull():
+                    warn(f"无法生成缩略图: {path}")
+                    return
+                try:
+                    self.cachePath.mkdir(parents=True, exist_ok=True)
+                    image.save(str(cacheFile), "PNG")
+                    self.pruneDisk()
+                except Exception as e:
+                    warn(f"写入缩略图缓存失败:{e}")
+            with self.lock:
+                self.digests[statKey] = digest
+                while len(self.digests) > self.maxItems * 4:
+                    del self.digests[next(iter(self.digests))]
+                self.images[(digest, width, height)] = image
+                while len(self.images) > self.maxItems:
+                    self.images.popitem(last=False)
+            self.ready.emit(path, image)
+        except Exception as e:
+            error(f"生成缩略图失败:\n{e}\n{tb.format_exc()}")
+        finally:
+            with self.lock:
+                self.loading.discard((statKey, width, height))
+
+    def pruneDisk(self):
+        """磁盘缓存超过上限时按修改时间从旧到新删除(只在工作线程里调用)"""
+        entries = []
+        for file in self.cachePath.glob("*.png"):
+            try:
+                stat = file.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, file))
+        total = sum(size for _, size, _ in entries)
+        if len(entries) <= self.maxDiskItems and total <= self.maxDiskBytes:
+            return
+        entries.sort()
+        count = len(entries)
+        for _, size, file in entries:
+            if count <= self.maxDiskItems and total <= self.maxDiskBytes:
+                break
+            try:
+                file.unlink()
+            except OSError:
+                continue
+            count -= 1
+            total -= size
+
+    @staticmethod
+    def decode(path, size: QSize) -> QImage:
+        reader = QImageReader(path)
+        reader.setAutoTransform(True)
+        source = reader.size()
+        if source.isValid():
+            #  按覆盖目标尺寸缩放后解码, jpeg等格式解码器会直接按比例降采样
+            reader.setScaledSize(source.scaled(size, Qt.KeepAspectRatioByExpanding))
+        image = reader.read()
+        if image.isNull():
+            return image
+        if not source.isValid():
+            image = image.scaled(size, Qt.KeepAspectRatioByExpanding, Qt.SmoothTransformation)
+        x, y = max(0, (image.width() - size.width()) // 2), max(0, (image.height() - size.height()) // 2)
+        return image.copy(x, y, size.width(), size.height())
 
 
 class FileWidget(QWidget):
@@ -872,16 +2783,15 @@ class FileWidget(QWidget):
         self.mainLayout.addStretch()
 
         self.filePath = filePath
-        # background-image: url({self.filePath});
+        #  缩略图在后台生成, 之前先画占位
         size = 100
-        self.setStyleSheet(f"""
-        border-radius:5px;
-        border-image: url({filePath}) 0 0 0 0 stretch stretch;
-        min-width:{size}px;
-        min-height:{size * 0.8}px;
-        max-width:{size}px;
-        max-height:{size * 0.8}px;
-        """)
+        self.thumbnailSize = QSize(size, int(size * 0.8))
+        self.setFixedSize(self.thumbnailSize)
+        #  先连信号再请求, 后台线程在request返回前就生成完也不会漏掉
+        self._parent.thumbnailCache.ready.connect(self.onThumbnail)
+        self.thumbnail: QImage | None = self._parent.thumbnailCache.request(filePath, self.thumbnailSize)
+        if self.thumbnail is not None:
+            self.disconnectThumbnail()
 
         childWidget = QWidget()
         childLayout = QHBoxLayout(childWidget)
@@ -889,7 +2799,6 @@ class FileWidget(QWidget):
         _del = QPushButton("x")
         _button_size = 25
         _del.setStyleSheet(f"""
-        border-image:none;
         min-width:{_button_size}px;
         min-height:{_button_size}px;
         max-width:{_button_size}px;
@@ -902,6 +2811,34 @@ class FileWidget(QWidget):
         childLayout.addWidget(_del)
         self.mainLayout.addWidget(childWidget)
 
+    def onThumbnail(self, path, image):
+        if path != self.filePath:
+            return
+        self.thumbnail = image
+        self.disconnectThumbnail()
+        self.update()
+
+    def disconnectThumbnail(self):
+        """关闭的控件要断开, 不然缩略图缓存的信号会一直引用着它"""
+        try:
+            self._parent.thumbnailCache.ready.disconnect(self.onThumbnail)
+        except TypeError:
+            pass
+
+    def paintEvent(self, a0):
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.Antialiasing)
+        clip = QPainterPath()
+        clip.addRoundedRect(QRectF(self.rect()), 5, 5)
+        painter.setClipPath(clip)
+        if self.thumbnail is not None:
+            painter.drawImage(self.rect(), self.thumbnail)
+        else:
+            painter.fillRect(self.rect(), QColor(128, 128, 128, 90))
+            painter.setPen(QColor(255, 255, 255, 200))
+            painter.drawText(self.rect(), Qt.AlignCenter, "加载中...")
+        painter.end()
+
     def __str__(self):
         return self.filePath
 
@@ -911,7 +2848,10 @@ class FileWidget(QWidget):
 
     def delSelf(self):
         try:
+            self.disconnectThumbnail()
             self.close()
+            self.deleteLater()
+            self._parent.userMessage.imageObjs.remove(self)
             self._parent.userMessage.images.remove(self.filePath)
             info("对象销毁成功")
         except Exception as e:
@@ -930,6 +2870,12 @@ class PlainTextEdit(QPlainTextEdit):
         self._layout = QHBoxLayout()
         self.viewport().setLayout(self._layout)
         self._layout.addStretch()
+        self.textChanged.connect(self.onTextChanged)
+
+    def onTextChanged(self):
+        #  开始输入就在后台连上服务器, 发送时省掉建立连接的时间
+        if self._parent.ai and self.document().characterCount() > 1:
+            self._parent.ai.prewarm()
 
     def keyPressEvent(self, e):
         if e.key() in (Qt.Key_Return, Qt.Key_Enter) and e.modifiers() != Qt.ShiftModifier:
@@ -939,7 +2885,7 @@ class PlainTextEdit(QPlainTextEdit):
 
     def dragEnterEvent(self, event: QDragEnterEvent):
         """拖拽进入事件"""
-        if not self._parent.enabledImageModal:
+        if not self._parent.config.enabledImageModal:
             return
         if event.mimeData().hasUrls():
             event.acceptProposedAction()
@@ -964,6 +2910,7 @@ class PlainTextEdit(QPlainTextEdit):
                 self._layout.addWidget(_imageWidget)
                 self.images.append(str(_imageWidget))
                 self.imageObjs.append(_imageWidget)
+                self._parent.imagePipeline.prefetch(file_path)
                 # 发射信号  虽然暂时没用
                 self.file_dropped.emit(file_path)
 
@@ -974,10 +2921,370 @@ class PlainTextEdit(QPlainTextEdit):
     def clear(self):
         self.images.clear()
         for obj in self.imageObjs:
+            obj.disconnectThumbnail()
             obj.close()
+            obj.deleteLater()
+        self.imageObjs.clear()
         super().clear()
 
 
+class ContextManager:
+    """
+    按token预算组装每次请求的上下文: 系统提示词 + 更早对话的滚动摘要 + 放得下的最近几轮原文
+    每条消息的token数只估算一次并缓存; 摘要在空闲时由后台线程生成,不占用用户发消息的那一轮
+    """
+    imageTokens = 800  # 一张图片大概占用的token
+    messageOverhead = 4
+    cjkPattern = re.compile(r"[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+    def __init__(self, config):
+        self.config: Config = config
+        self.cache = {}  # id(message) -> (message, tokens), 保留message引用保证id不会被复用
+
+    @classmethod
+    def estimateTokens(cls, text: str) -> int:
+        """粗略估算: 中日韩字符一个字算一个token,其它字符四个算一个"""
+        if not text:
+            return 0
+        cjk = len(cls.cjkPattern.findall(text))
+        return cjk + (len(text) - cjk + 3) // 4
+
+    def count(self, message: dict) -> int:
+        cached = self.cache.get(id(message))
+        if cached is not None and cached[0] is message:
+            return cached[1]
+        content = message.get("content")
+        tokens = self.messageOverhead
+        if isinstance(content, str):
+            tokens += self.estimateTokens(content)
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") == "text":
+                    tokens += self.estimateTokens(part.get("text", ""))
+                else:
+                    tokens += self.imageTokens
+        if message.get("tool_calls"):
+            tokens += self.estimateTokens(json.dumps(message["tool_calls"], ensure_ascii=False))
+        self.cache[id(message)] = (message, tokens)
+        return tokens
+
+    def budget(self, model) -> int:
+        return int(self.config.contextBudget.get(model, self.config.defaultContextBudget))
+
+    def recentStart(self, memory, budget) -> int:
+        """从最新的消息往前数,返回预算内能放下的第一条消息的下标(至少包含最后一条)"""
+        first = max(1, self.config.summaryUntil)
+        used = 0
+        start = len(memory)
+        for index in range(len(memory) - 1, first - 1, -1):
+            used += self.count(memory[index])
+            if used > budget and start < len(memory):
+                break
+            start = index
+        #  tool消息必须跟在带tool_calls的assistant消息后面,不能作为开头
+        while start < len(memory) and memory[start].get("role") == "tool":
+            start += 1
+        return start
+
+    def summaryMessage(self):
+        if not self.config.summary:
+            return None
+        return {"role": "system", "content": f"以下是更早之前对话的摘要:\n{self.config.summary}"}
+
+    def build(self, memory, model) -> list:
+        if len(self.cache) > 2 * len(memory) + 64:
+            self.cache.clear()
+        messages = [memory[0]] if memory and memory[0].get("role") == "system" else []
+        summary = self.summaryMessage()
+        if summary:
+            messages.append(summary)
+        budget = self.budget(model) - sum(self.count(i) for i in messages)
+        messages.extend(memory[self.recentStart(memory, budget):])
+        return messages
+
+    def pendingSummary(self, memory, model):
+        """
+        需要并入摘要的区间 [summaryUntil, end)
+        只保留一半预算的最近原文,给新消息留出余量,避免每一轮都要重新摘要
+        """
+        start = max(1, self.config.summaryUntil)
+        end = self.recentStart(memory, self.budget(model) // 2)
+        #  一次最多摘要一个预算的量,剩下的留给下一次空闲
+        used = 0
+        for index in range(start, end):
+            used += self.count(memory[index])
+            if used > self.budget(model):
+                end = max(index, start + 1)
+                break
+        if end - start < 4:
+            return None
+        return start, end
+
+    @staticmethod
+    def transcript(messages) -> str:
+        lines = []
+        for message in messages:
+            content = message.get("content")
+            if isinstance(content, list):
+                content = "".join(part.get("text", "") if part.get("type") == "text" else "[图片]" for part in content)
+            if message.get("role") == "assistant" and content:
+                content = ConversationMemory.parseReply(content)[1] or content
+            if content:
+                lines.append(f"{message.get('role')}: {content}")
+        return "\n".join(lines)
+
+
+class LlmMetrics:
+    """
+    每次请求的首token时间/总耗时/输入输出token数/生成速度/请求体大小/工具调用数, 按(url, token, model)汇总
+    累计值一直保留, 耗时分位数只看最近window次请求; 可以在任意线程record, 读取时加锁取快照
+    """
+    fields = ("ttft", "latency", "promptTokens", "completionTokens", "tokensPerSecond", "payloadBytes", "toolCalls")
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self.lock = threading.Lock()
+        self.series: dict[tuple, dict] = {}
+
+    @staticmethod
+    def maskToken(token) -> str:
+        token = str(token or "")
+        return f"...{token[-4:]}" if len(token) > 8 else "***"
+
+    def __entry(self, url, token, model) -> dict:
+        key = (url or "", self.maskToken(token), model or "")
+        entry = self.series.get(key)
+        if entry is None:
+            entry = self.series[key] = {"requests": 0, "errors": 0, "estimated": 0,
+                                        "totals": dict.fromkeys(self.fields, 0.0),
+                                        "recent": {name: collections.deque(maxlen=self.window)
+                                                   for name in ("ttft", "latency", "tokensPerSecond")}}
+        return entry
+
+    def record(self, url, token, model, ttft, latency, promptTokens, completionTokens, payloadBytes, toolCalls,
+               estimated=False):
+        """ttft为None(非流式)时首token时间按总耗时算, 生成速度也按总耗时算"""
+        generation = latency - ttft if ttft is not None and latency > ttft else latency
+        ttft = latency if ttft is None else ttft
+        sample = {"ttft": ttft, "latency": latency, "promptTokens": promptTokens,
+                  "completionTokens": completionTokens, "payloadBytes": payloadBytes, "toolCalls": toolCalls,
+                  "tokensPerSecond": completionTokens / generation if generation > 0 else 0.0}
+        with self.lock:
+            entry = self.__entry(url, token, model)
+            entry["requests"] += 1
+            entry["estimated"] += bool(estimated)
+            for name, value in sample.items():
+                entry["totals"][name] += value
+            for name, values in entry["recent"].items():
+                values.append(sample[name])
+        return sample
+
+    def recordError(self, url, token, model):
+        with self.lock:
+            self.__entry(url, token, model)["errors"] += 1
+
+    def snapshot(self) -> List[dict]:
+        result = []
+        with self.lock:
+            for (url, token, model), entry in self.series.items():
+                item = {"url": url, "token": token, "model": model, "requests": entry["requests"],
+                        "errors": entry["errors"], "estimated": entry["estimated"], "totals": dict(entry["totals"])}
+                for name, values in entry["recent"].items():
+                    item[name] = np.percentile(np.fromiter(values, float), [50, 95]).tolist() if values else [0, 0]
+                result.append(item)
+        return result
+
+    def summary(self) -> str:
+        lines = []
+        for item in self.snapshot():
+            count = max(item["requests"], 1)
+            totals = item["totals"]
+            estimated = f", 其中{item['estimated']}次token为估算" if item["estimated"] else ""
+            lines += [f"{item['model']}  @ {item['url']} (token {item['token']})",
+                      f"  请求 {item['requests']} 次, 失败 {item['errors']} 次{estimated}",
+                      f"  首token  p50 {item['ttft'][0]:.2f}s  p95 {item['ttft'][1]:.2f}s",
+                      f"  总耗时   p50 {item['latency'][0]:.2f}s  p95 {item['latency'][1]:.2f}s",
+                      f"  生成速度 p50 {item['tokensPerSecond'][0]:.1f} token/s",
+                      f"  token 输入 {int(totals['promptTokens'])} / 输出 {int(totals['completionTokens'])}, "
+                      f"平均请求体 {totals['payloadBytes'] / count / 1024:.1f}KB, 工具调用 {int(totals['toolCalls'])} 次",
+                      ""]
+        return "\n".join(lines) or "还没有请求记录"
+
+    def render(self) -> str:
+        """Prometheus文本格式"""
+        lines = []
+
+        def metric(name, kind, help, values):
+            lines.append(f"# HELP desktoppet_llm_{name} {help}")
+            lines.append(f"# TYPE desktoppet_llm_{name} {kind}")
+            for labels, value in values:
+                lines.append(f"desktoppet_llm_{name}{{{labels}}} {value}")
+
+        def escape(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+        labels = [(",".join(f'{key}="{escape(item[key])}"' for key in ("url", "token", "model")), item)
+                  for item in self.snapshot()]
+        metric("requests_total", "counter", "请求次数", [(label, item["requests"]) for label, item in labels])
+        metric("errors_total", "counter", "失败的请求次数", [(label, item["errors"]) for label, item in labels])
+        for name, metricName, help in (("promptTokens", "prompt_tokens", "输入token数"),
+                                       ("completionTokens", "completion_tokens", "输出token数"),
+                                       ("payloadBytes", "payload_bytes", "请求体字节数"),
+                                       ("toolCalls", "tool_calls", "工具调用次数")):
+            metric(f"{metricName}_total", "counter", help, [(label, item["totals"][name]) for label, item in labels])
+        for name, help in (("ttft", "首token时间(秒)"), ("latency", "总耗时(秒)")):
+            metric(f"{name}_seconds_sum", "counter", f"{help}之和", [(label, item["totals"][name]) for label, item in labels])
+            for quantile, index in (("0.5", 0), ("0.95", 1)):
+                metric(f"{name}_seconds_p{quantile[2:]}", "gauge", f"最近请求的{help}分位数",
+                       [(label, item[name][index]) for label, item in labels])
+        metric("tokens_per_second_p50", "gauge", "最近请求的生成速度中位数",
+               [(label, item["tokensPerSecond"][0]) for label, item in labels])
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """在config.metricsHost:config.metricsPort上提供 GET /metrics, 返回LlmMetrics.render()的文本"""
+
+    def __init__(self, metrics: LlmMetrics, host, port):
+        self.metrics = metrics
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split("?")[0] != "/metrics":
+                    handler.send_error(404)
+                    return
+                data = metrics.render().encode("utf-8")
+                handler.send_response(200)
+                handler.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                handler.send_header("Content-Length", str(len(data)))
+                handler.end_headers()
+                handler.wfile.write(data)
+
+            def log_message(handler, format, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = th(target=self.httpd.serve_forever, name="MetricsServer", daemon=True)
+        self.thread.start()
+        info(f"请求统计: http://{host}:{port}/metrics")
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class TraceRecorder:
+    """
+    请求/回复的调试记录(代替以前每次都同步写的file.json): 需要手动开启, 按sampleRate抽样,
+    在后台线程写到 log/traces/ 下每次一个文件, 只保留最近maxFiles个; 图片的data url只记录长度
+    """
+
+    def __init__(self, directory=Path("log/traces/"), enabled=False, sampleRate: float = 0.2, maxFiles: int = 50):
+        self.directory = Path(directory)
+        self.enabled = enabled
+        self.sampleRate = sampleRate
+        self.maxFiles = maxFiles
+        self.sequence = 0
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.thread = th(target=self.__run, name="TraceRecorder", daemon=True)
+        self.thread.start()
+
+    def record(self, build: Callable[[], dict]):
+        """build只在抽中时才调用, 没开启或没抽中时几乎没有开销"""
+        if not self.enabled or random.random() >= self.sampleRate:
+            return
+        self.sequence += 1
+        try:
+            self.queue.put((f"{dt.datetime.now():%Y%m%d-%H%M%S}-{self.sequence:04d}.json", build()))
+        except Exception as e:
+            warn(f"生成请求记录失败:{e}")
+
+    @classmethod
+    def redact(cls, value):
+        if isinstance(value, str) and value.startswith("data:") and len(value) > 256:
+            return f"<{value[:value.find(',')]} {len(value)} bytes>"
+        if isinstance(value, dict):
+            return {key: cls.redact(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [cls.redact(item) for item in value]
+        return value
+
+    def __run(self):
+        while True:
+            name, trace = self.queue.get()
+            try:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                (self.directory / name).write_text(json.dumps(self.redact(trace), ensure_ascii=False, indent=4,
+                                                              default=str), encoding="utf-8")
+                files = sorted(self.directory.glob("*.json"))
+                for old in files[:max(0, len(files) - self.maxFiles)]:
+                    old.unlink(missing_ok=True)
+            except Exception as e:
+                warn(f"写入请求记录失败:{e}")
+
+
+class ClientPool:
+    """
+    (url, token) -> OpenAI客户端, 切换接口/密钥时复用已经建好的客户端
+    所有客户端共用同一个httpx连接池, 同一个服务器的keep-alive连接在不同密钥之间也能复用;
+    prewarm在后台先连上服务器(DNS + TCP + TLS), 真正发消息时直接用池里的连接
+    """
+
+    def __init__(self, timeout: float = 60.0, connectTimeout: float = 5.0, keepAlive: float = 90.0,
+                 warmInterval: float = 30.0, maxRetries: int = 2):
+        self.timeout = httpx.Timeout(timeout, connect=connectTimeout)
+        self.connectTimeout = connectTimeout
+        self.warmInterval = warmInterval
+        self.maxRetries = maxRetries
+        self.http = httpx.Client(timeout=self.timeout, follow_redirects=True,
+                                 limits=httpx.Limits(max_connections=16, max_keepalive_connections=8,
+                                                     keepalive_expiry=keepAlive))
+        self.lock = threading.Lock()
+        self.clients: dict[tuple[str, str], OpenAI] = {}
+        self.warmedAt: dict[str, float] = {}  # url -> 上次预热的时间
+        self.warming: set = set()
+        self.warmer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="prewarm")
+
+    def get(self, url, token) -> OpenAI | None:
+        if not url or not token:
+            return None
+        with self.lock:
+            client = self.clients.get((url, token))
+            if client is None:
+                client = self.clients[(url, token)] = OpenAI(base_url=url, api_key=token, timeout=self.timeout,
+                                                             max_retries=self.maxRetries, http_client=self.http)
+            return client
+
+    def prewarm(self, url):
+        """后台和服务器建立连接, warmInterval秒内重复调用直接返回"""
+        if not url:
+            return
+        now = time.monotonic()
+        with self.lock:
+            if url in self.warming or now - self.warmedAt.get(url, -math.inf) < self.warmInterval:
+                return
+            self.warming.add(url)
+        self.warmer.submit(self.__warm, url)
+
+    def __warm(self, url):
+        startTime = time.perf_counter()
+        try:
+            #  只为了把连接留在池里, 服务器返回什么状态码都无所谓
+            self.http.head(url, timeout=self.connectTimeout)
+            debug(f"已预热连接 {url}, 耗时 {(time.perf_counter() - startTime) * 1000:.0f}ms")
+        except httpx.HTTPError as e:
+            debug(f"预热连接 {url} 失败: {e}")
+        finally:
+            with self.lock:
+                self.warming.discard(url)
+                self.warmedAt[url] = time.monotonic()
+
+    def close(self):
+        self.warmer.shutdown(wait=False, cancel_futures=True)
+        self.http.close()
+
+
 class AI:
 
     def __init__(self, parent: MainWindow):
@@ -988,19 +3295,41 @@ class AI:
         self.functionManager: FunctionManager = FunctionManager()
 
         self.lastedChat = time.time()
-        self.mouth: Parameter = None
-
+        self.shownThisTurn = False  # 这一轮回复是否已经显示过文字(之前显示的是"思考中...")
+        self.context: ContextManager = ContextManager(self.config)
+        self.summaryThread: th | None = None
+
+        self.clientPool: ClientPool = ClientPool()
+        self.noStreamUsage: set[str] = set()  # 不支持stream_options的url
+        self.metrics: LlmMetrics = LlmMetrics()
+        self.metricsServer: MetricsServer | None = None
+        self.setMetricsServer(self.config.metricsEnabled)
+        self.config.subscribe("metricsEnabled", self.setMetricsServer)
+        self.traceRecorder: TraceRecorder = TraceRecorder(enabled=self.config.traceRequests,
+                                                          sampleRate=self.config.traceSampleRate)
+        self.config.subscribe("traceRequests", lambda value: setattr(self.traceRecorder, "enabled", value))
+        self.config.subscribe("traceSampleRate", lambda value: setattr(self.traceRecorder, "sampleRate", value))
         self.ai: OpenAI | None = None
-        if self.config.useUrl and self.config.useToken.get(self.config.useUrl):
-            self.ai = OpenAI(base_url=self.config.useUrl, api_key=self.config.useToken.get(self.config.useUrl))
+        self.reconnect()
+        self.config.subscribe("useUrl", lambda _: self.reconnect())
+        self.config.subscribe("useToken", lambda _: self.reconnect())
         self.init()
 
+    def reconnect(self):
+        self.connect(self.config.useUrl, self.config.useToken.get(self.config.useUrl))
+
     def connect(self, url, key) -> OpenAI | None:
         if not key or not url:
             return
-        self.ai = OpenAI(base_url=url, api_key=key)
+        self.ai = self.clientPool.get(url, key)
+        self.clientPool.prewarm(url)
         return self.ai
 
+    def prewarm(self):
+        """用户开始输入时调用, 提前连上当前接口"""
+        if self.ai:
+            self.clientPool.prewarm(self.config.useUrl)
+
     def addUserMessage(self, text, images: list[str] | None | list[bytes] = None):
         """image 需要自行转base64然后传入"""
         content = []
@@ -1010,83 +3339,298 @@ class AI:
             content.append({"type": "image_url", "image_url": {"url": image}})
         self.config.memory.append({"role": "user", "content": content})
 
-    def appendAssistantMessage(self, message, toolCall=None):
+    def setMetricsServer(self, enabled):
+        """按设置启动/关闭 /metrics 服务"""
+        if self.metricsServer:
+            self.metricsServer.close()
+            self.metricsServer = None
+        if not enabled:
+            return
+        host, port = self.config.metricsHost, self.config.metricsPort
+        try:
+            self.metricsServer = MetricsServer(self.metrics, host, port)
+        except OSError as e:
+            warn(f"请求统计服务启动失败({host}:{port}): {e}")
+
+    def appendAssistantMessage(self, message, toolCall=None, display=True, append=False):
+        """
+        display为False时只写入记忆(流式输出时内容已经边收边显示过了)
+        append为True时接在这一轮已经显示的文本后面(工具调用附带的消息),否则替换掉当前显示;
+        这一轮还没有显示过文字时(比如回复只有工具调用)总是替换, 不接在"思考中..."后面
+        """
         addMemory = {"role": "assistant", "content": message}
         if toolCall:
             addMemory['tool_calls'] = toolCall
         if not message or message == str:
             return
         self.config.memory.append(addMemory)
+        if not display:
+            return
 
         lastMessage = self.getLastAIMessage()
-        history = ""
         if lastMessage:
-            for i in lastMessage:
-                if not self.parent.function:
-                    if self.mouth:
-                        _timeMap = [i / 10 for i in range(1, 5)]
-                        _timeMap.append(0)
-                        for _i in range(0, 4):
-                            random.shuffle(_timeMap)
-
-                        self.mouth.ChangeValue(_timeMap[0])
-                    self.parent.function = lambda: self.parent.setAIMessage(history + i)
-                history += i
-                time.sleep(0.1)
-
-        self.mouth.ChangeValue(0)
+            if append and self.shownThisTurn:
+                self.parent.commandBus.post(lambda: self.parent.typewriter.append(lastMessage))
+            else:
+                self.parent.commandBus.post(lambda: self.parent.typewriter.start(lastMessage), key="aiText")
+            self.shownThisTurn = True
 
     def getLastAIMessage(self):
-        aiMessage = ""
-        for i in self.config.memory:
-            if i['role'] == "assistant":
-                try:
-                    result = re.search("<content>(.*?)</content>", i["content"], re.DOTALL)
-                    aiMessage = result.group(1) if result is not None else ""
-                except Exception as e:
-                    error(f"获取最后一次ai消息发生错误:\n{e}\n{tb.format_exc()}")
-        return aiMessage
+        try:
+            return self.config.memory.lastReply()
+        except Exception as e:
+            error(f"获取最后一次ai消息发生错误:\n{e}\n{tb.format_exc()}")
+            return ""
 
     def chat(self):
+        url, token = self.config.useUrl, self.config.useToken.get(self.config.useUrl)
+        model = self.config.useModel.get(token)
+        self.shownThisTurn = False
         try:
             if not self.config.memory:
                 self.config.setPrompt()
-            response = self.ai.chat.completions.create(
-                model=self.config.useModel.get(self.config.useToken.get(self.config.useUrl)),
-                messages=self.config.memory,
-                stream=self.config.streamOutPut,
-                tools=self.functionManager.tools(),
-                tool_choice="auto"
-            )
-            self.lastedChat = time.time()
-            Path("file.json").write_text(response.model_dump_json(indent=4), encoding="utf-8")
-            if not response.choices[0].message.content:
-                response.choices[0].message.content = ""
-            self.appendAssistantMessage(response.choices[0].message.content)
+            messages = self.context.build(self.config.memory, model)
+            promptTokens = sum(self.context.count(i) for i in messages)
+            debug(f"本次请求上下文: {len(messages)}/{len(self.config.memory)} 条消息, 约 {promptTokens} tokens")
+            payloadBytes = (len(json.dumps(messages, ensure_ascii=False).encode("utf-8"))
+                            + len(self.functionManager.toolsJson().encode("utf-8")))
+            stream = self.config.streamOutPut
+            request = dict(model=model, messages=messages, stream=stream, tools=self.functionManager.tools(),
+                           tool_choice="auto")
+            withUsage = stream and self.config.streamUsage and url not in self.noStreamUsage
+            requestTime = time.perf_counter()
+            try:
+                response = self.ai.chat.completions.create(
+                    **request, **({"stream_options": {"include_usage": True}} if withUsage else {}))
+            except APIStatusError as e:
+                #  有的兼容服务端不认识stream_options, 直接拒绝整个请求; 去掉它重试, 这个url之后也不再带
+                #  只认错误内容里提到了这个字段的, 其他400(比如上下文太长)照常报错
+                detail = f"{e.message} {e.body}"
+                if (not withUsage or e.status_code not in (400, 422)
+                        or "stream_options" not in detail and "include_usage" not in detail):
+                    raise
+                warn(f"{url} 拒绝了stream_options, 之后不再请求usage(改用估算): {e}")
+                self.noStreamUsage.add(url)
+                requestTime = time.perf_counter()
+                response = self.ai.chat.completions.create(**request)
+            if stream:
+                content, toolCalls, usage, firstToken = self.readStream(response, requestTime)
+            else:
+                self.lastedChat = time.time()
+                message = response.choices[0].message
+                content = message.content or ""
+                toolCalls = [tool.model_dump() for tool in message.tool_calls or []]
+                usage = response.usage
+                firstToken = None
+                info(f"非流式回复完成, 首个可见字符需要等待完整生成: {time.perf_counter() - requestTime:.3f}s")
+            latency = time.perf_counter() - requestTime
+            #  服务端没有返回usage时用估算值
+            sample = self.metrics.record(
+                url, token, model, ttft=firstToken, latency=latency,
+                promptTokens=usage.prompt_tokens if usage else promptTokens,
+                completionTokens=usage.completion_tokens if usage else self.context.estimateTokens(content),
+                payloadBytes=payloadBytes, toolCalls=len(toolCalls), estimated=usage is None)
+            self.traceRecorder.record(lambda: {
+                "url": url, "model": model, "stream": stream, "metrics": sample,
+                "request": {"messages": messages, "tools": self.functionManager.tools()},
+                "response": response.model_dump() if not stream else {"content": content, "tool_calls": toolCalls}
+            })
+            self.appendAssistantMessage(content, display=not stream)
+            self.runTools(toolCalls)
+            self.config.save()
+        except Exception as e:
+            self.metrics.recordError(url, token, model)
+            print(f"{e}\n{tb.format_exc()}")
+
+    def readStream(self, response, requestTime):
+        """边收边解析流式回复, 返回(原始回复文本, 拼好的tool_calls, usage, 首token时间)"""
+        timing = {}
+
+        def onContent(text):
+            if "firstVisible" not in timing:
+                timing["firstVisible"] = time.perf_counter() - requestTime
+                self.shownThisTurn = True
+                self.parent.commandBus.post(lambda: self.parent.typewriter.start(text, streaming=True), key="aiText")
+            else:
+                self.parent.commandBus.post(lambda: self.parent.typewriter.feed(text))
+
+        parser = StreamParser(onContent)
+        toolCalls = ToolCallAccumulator()
+        usage = None
+        try:
+            for chunk in response:
+                if getattr(chunk, "usage", None):
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    if "firstToken" not in timing:
+                        timing["firstToken"] = time.perf_counter() - requestTime
+                    parser.feed(delta.content)
+                if delta.tool_calls:
+                    if "firstToken" not in timing:
+                        timing["firstToken"] = time.perf_counter() - requestTime
+                    toolCalls.feed(delta.tool_calls)
+            parser.close()
+        finally:
+            #  流结束(或中断)后剩下的文字和之后追加的文字都按正常速度显示
+            self.parent.commandBus.post(self.parent.typewriter.endStream)
+        self.lastedChat = time.time()
+        info(f"流式回复完成: 首token {timing.get('firstToken', -1):.3f}s, "
+             f"首个可见字符 {timing.get('firstVisible', -1):.3f}s, "
+             f"总耗时 {time.perf_counter() - requestTime:.3f}s")
+        return parser.getRaw(), toolCalls.result(), usage, timing.get("firstToken")
+
+    def runTools(self, toolCalls: list):
+        for tool in toolCalls:
             try:
-                if response.choices[0].message.tool_calls:
-                    for tool in response.choices[0].message.tool_calls:
-                        function = self.functionManager.get(tool.function.name)
-                        if function: function.function(**json.loads(tool.function.arguments))
+                self.functionManager.call(tool["function"]["name"], tool["function"]["arguments"])
+            except ToolArgumentError as e:
+                warn(f"已拒绝工具调用: {e}")
             except Exception as e:
                 error(f"工具调用错误:\n{e}\n{tb.format_exc()}")
+        self.parent.choreographer.commit()
+
+    def summarizeInBackground(self):
+        """空闲时调用: 把超出预算一半的旧对话并入滚动摘要"""
+        if not self.ai or self.summaryThread and self.summaryThread.is_alive():
+            return
+        model = self.config.useModel.get(self.config.useToken.get(self.config.useUrl))
+        pending = self.context.pendingSummary(self.config.memory, model)
+        if not pending:
+            return
+        self.summaryThread = th(target=lambda: self.summarize(model, *pending))
+        self.summaryThread.daemon = True
+        self.summaryThread.start()
+
+    def summarize(self, model, start, end):
+        try:
+            memory = self.config.memory
+            lastMessage = memory[end - 1]
+            until = self.config.summaryUntil
+            oldSummary = self.config.summary
+            prompt = (f"已有摘要:\n{oldSummary or '无'}\n\n新的对话记录:\n{self.context.transcript(memory[start:end])}\n\n"
+                      "请把已有摘要和新的对话记录合并成一份新的摘要,保留人物关系、用户的偏好、约定和重要事实,"
+                      "使用第三人称,不超过400字,只输出摘要本身.")
+            response = self.ai.chat.completions.create(
+                model=model,
+                messages=[{"role": "system", "content": "你负责压缩长对话的历史记录."},
+                          {"role": "user", "content": prompt}],
+                stream=False
+            )
+            summary = (response.choices[0].message.content or "").strip()
+            #  摘要期间记忆被清空或者摘要被别处更新,这次的结果作废
+            if not summary or self.config.summaryUntil != until or len(self.config.memory) < end \
+                    or self.config.memory[end - 1] is not lastMessage:
+                return
+            self.config.summary = summary
+            self.config.summaryUntil = end
             self.config.save()
+            info(f"对话摘要已更新, 覆盖前 {end} 条消息")
         except Exception as e:
-            print(f"{e}\n{tb.format_exc()}")
+            error(f"生成对话摘要失败:\n{e}\n{tb.format_exc()}")
 
     def init(self):
         pass
 
 
+class ModelDiscovery(QObject):
+    """
+    获取各个端点可用的模型列表: Config.tokenMap里所有(url, token)同时查询, 共用一个requests.Session复用连接
+    结果带时间戳缓存在cache/models.json(按url+token的哈希, 不在缓存里保存token), 超过ttl秒才重新查询
+    查询在线程池里进行, 结果只通过信号交给界面线程
+    """
+    discovered = pyqtSignal(str, str, list)  # url, token, 模型列表
+    failed = pyqtSignal(str, str, str)  # url, token, 错误信息
+    cachePath = Path("cache/models.json")
+
+    def __init__(self, ttl: float = 6 * 3600, timeout: tuple = (5, 15), workers: int = 4):
+        super().__init__()
+        self.ttl = ttl
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="models")
+        self.lock = threading.Lock()
+        self.inflight: set = set()
+        self.cache: dict[str, dict] = {}
+        try:
+            if self.cachePath.exists():
+                self.cache = json.loads(self.cachePath.read_text("utf-8"))
+        except ValueError:
+            warn("模型列表缓存已损坏,已忽略")
+
+    @staticmethod
+    def key(url, token) -> str:
+        return hashlib.sha1(f"{url}\n{token}".encode("utf-8")).hexdigest()
+
+    def cached(self, url, token) -> List[str] | None:
+        entry = self.cache.get(self.key(url, token))
+        return entry["models"] if entry else None
+
+    def isStale(self, url, token) -> bool:
+        entry = self.cache.get(self.key(url, token))
+        return entry is None or time.time() - entry["time"] > self.ttl
+
+    def refresh(self, tokenMap: dict, force=False):
+        """后台查询tokenMap里所有过期(force为True时全部)的(url, token), 立即返回"""
+        for url, tokens in tokenMap.items():
+            for token in tokens or []:
+                if not url or not token or not force and not self.isStale(url, token):
+                    continue
+                with self.lock:
+                    if (url, token) in self.inflight:
+                        continue
+                    self.inflight.add((url, token))
+                self.executor.submit(self.__fetch, url, token)
+
+    def __fetch(self, url, token):
+        startTime = time.perf_counter()
+        try:
+            response = self.session.get(url.rstrip("/") + "/models", timeout=self.timeout, headers={
+                "Authorization": f"Bearer {token}",  # OpenAI标准格式
+                "Content-Type": "application/json"
+            })
+            response.raise_for_status()
+            models = [i['id'] for i in response.json()['data']]
+        except Exception as e:
+            warn(f"获取模型列表失败 {url}: {e}")
+            self.failed.emit(url, token, str(e))
+            return
+        finally:
+            with self.lock:
+                self.inflight.discard((url, token))
+        info(f"获取到 {url} 的 {len(models)} 个模型, 耗时 {(time.perf_counter() - startTime) * 1000:.0f}ms")
+        with self.lock:
+            self.cache[self.key(url, token)] = {"models": models, "time": time.time()}
+            self.__save()
+        self.discovered.emit(url, token, models)
+
+    def __save(self):
+        try:
+            self.cachePath.parent.mkdir(parents=True, exist_ok=True)
+            temp = self.cachePath.with_suffix(".tmp")
+            temp.write_text(json.dumps(self.cache, ensure_ascii=False), encoding="utf-8")
+            os.replace(temp, self.cachePath)
+        except Exception as e:
+            warn(f"写入模型列表缓存失败:{e}")
+
+
 class SettingWindow(QMainWindow):
 
-    def __init__(self, parent: MainWindow):
+    def __init__(self, parent: MainWindow, config):
         super().__init__(parent)
         self._parent: MainWindow = parent
         self.setWindowTitle("设置")
         self.resize(1000, 650)
         self.changeLock = False
-        self.config: Config = Config()
+        self.config: Config = config
+        self.modelComboBox: QComboBox | None = None  # 大模型设置界面打开时才有
+        self.modelStatus: QLineEdit | None = None  # 同上, 显示模型列表的获取结果
+        self.metricsTimer = QTimer(self)  # 请求统计界面打开时每秒刷新
+        self.modelDiscovery: ModelDiscovery = ModelDiscovery()
+        self.modelDiscovery.discovered.connect(self.onModelsDiscovered)
+        self.modelDiscovery.failed.connect(self.onModelsFailed)
 
         #  self.setAttribute(Qt.WA_TranslucentBackground)
 
@@ -1131,6 +3675,11 @@ class SettingWindow(QMainWindow):
         windowSetting = QPushButton("窗口设置")
         windowSetting.clicked.connect(self.windowSetting)
 
+        metricsSetting = QPushButton("请求统计")
+        metricsSetting.clicked.connect(self.metricsSetting)
+        speechSetting = QPushButton("语音")
+        speechSetting.clicked.connect(self.speechSetting)
+
         saveConfig = QPushButton("保存配置")
         exportConfig = QPushButton("导出配置(暂时没用)")
         other = QPushButton("关于软件")
@@ -1141,7 +3690,8 @@ class SettingWindow(QMainWindow):
         other.clicked.connect(self.other)
 
         [self.scrollLayout.addWidget(i) for i in
-         [llmSetting, live2dSetting, windowSetting, memoryAndPrompt, saveConfig, exportConfig, other]]
+         [llmSetting, live2dSetting, windowSetting, speechSetting, metricsSetting, memoryAndPrompt, saveConfig,
+          exportConfig, other]]
         self.scrollLayout.addStretch()
 
         """"""
@@ -1176,6 +3726,13 @@ class SettingWindow(QMainWindow):
     def clearSettingContent(self, layout=None):
         if not layout:
             layout = self.settingContentLayout
+            self.modelComboBox = None
+            self.modelStatus = None
+            self.metricsTimer.stop()
+            try:
+                self.metricsTimer.timeout.disconnect()
+            except TypeError:
+                pass
         if layout is not None:
             while layout.count():
                 item = layout.takeAt(0)
@@ -1183,18 +3740,6 @@ class SettingWindow(QMainWindow):
                 if widget is not None:
                     widget.deleteLater()  # 安全删除控件
 
-    @staticmethod
-    def getModelList(url, apiKey="0") -> List[str]:
-        """仅获取模型id"""
-        headers = {
-            "Authorization": f"Bearer {apiKey}",  # OpenAI标准格式
-            "Content-Type": "application/json"
-        }
-        response = requests.get(url + "/models", headers=headers)
-        if response.ok:
-            return [i['id'] for i in response.json()['data']]
-        return []
-
     def live2dSetting(self):
         """切换为live2d设置界面"""
         self.clearSettingContent()
@@ -1221,10 +3766,107 @@ class SettingWindow(QMainWindow):
         _size2.clicked.connect(lambda: self._parent.resize(1000, 400))
 
         [_childLayout.addWidget(i) for i in [_size0, _size1, _size2]]
-        [mainLayout.addWidget(i) for i in [_lineEdit_title, _childWidget]]
+
+        _lineEdit_speed = QLineEdit()
+        _lineEdit_speed.setReadOnly(True)
+        _speed = QSlider(Qt.Horizontal)
+        _speed.setRange(0, 100)
+        _speed.setValue(int(self.config.typewriterSpeed))
+        _speed.valueChanged.connect(lambda value: self.setTypewriterSpeed(value, _lineEdit_speed))
+        self.setTypewriterSpeed(_speed.value(), _lineEdit_speed)
+
+        _profiler = QPushButton("显示/隐藏帧耗时统计(F3), Shift+F3导出时间线")
+        _profiler.clicked.connect(self._parent.openglWidget.toggleProfiler)
+
+        [mainLayout.addWidget(i) for i in [_lineEdit_title, _childWidget, _lineEdit_speed, _speed, _profiler]]
         mainLayout.addStretch()
         self.settingContentLayout.addWidget(mainWidget)
 
+    def metricsSetting(self):
+        """切换为请求统计界面"""
+        self.clearSettingContent()
+        mainWidget = QWidget()
+        mainLayout = QVBoxLayout(mainWidget)
+
+        _lineEdit_endpoint = QLineEdit()
+        _lineEdit_endpoint.setReadOnly(True)
+        _server = QPushButton()
+        _server.clicked.connect(lambda: self.toggleMetricsServer(_server, _lineEdit_endpoint))
+        self.toggleMetricsServer(_server, _lineEdit_endpoint, toggle=False)
+
+        _metrics = QPlainTextEdit(self._parent.ai.metrics.summary())
+        _metrics.setReadOnly(True)
+        self.metricsTimer.timeout.connect(lambda: _metrics.setPlainText(self._parent.ai.metrics.summary()))
+        self.metricsTimer.start(1000)
+
+        _trace = QPushButton()
+        _trace.clicked.connect(lambda: self.toggleTrace(_trace))
+        self.toggleTrace(_trace, toggle=False)
+
+        [mainLayout.addWidget(i) for i in [_server, _lineEdit_endpoint, _metrics, _trace]]
+        self.settingContentLayout.addWidget(mainWidget)
+
+    def speechSetting(self):
+        """切换为语音设置界面"""
+        self.clearSettingContent()
+        mainWidget = QWidget()
+        mainLayout = QVBoxLayout(mainWidget)
+
+        _enabled = QPushButton()
+        _enabled.clicked.connect(lambda: self.toggleSpeech(_enabled))
+        self.toggleSpeech(_enabled, toggle=False)
+
+        _engine = QComboBox()
+        _engine.addItems(list(SPEECH_ENGINES))
+        _engine.setCurrentText(self.config.speechEngine)
+        _engine.currentTextChanged.connect(lambda value: setattr(self.config, "speechEngine", value))
+
+        _voice = QLineEdit(self.config.speechVoice)
+        _voice.setPlaceholderText("espeak-ng: 语音名(cmn / ja / en-us), piper: .onnx模型路径")
+        _voice.editingFinished.connect(lambda: setattr(self.config, "speechVoice", _voice.text().strip()))
+
+        _lineEdit_target = QLineEdit()
+        _lineEdit_target.setReadOnly(True)
+        _target = QSlider(Qt.Horizontal)
+        _target.setRange(3, 50)
+        _target.setValue(int(self.config.speechLatencyTarget * 10))
+        _target.valueChanged.connect(lambda value: self.setSpeechLatencyTarget(value / 10, _lineEdit_target))
+        self.setSpeechLatencyTarget(_target.value() / 10, _lineEdit_target)
+
+        _summary = QPlainTextEdit(self._parent.speech.summary())
+        _summary.setReadOnly(True)
+        self.metricsTimer.timeout.connect(lambda: _summary.setPlainText(self._parent.speech.summary()))
+        self.metricsTimer.start(1000)
+
+        [mainLayout.addWidget(i) for i in [_enabled, _engine, _voice, _lineEdit_target, _target, _summary]]
+        self.settingContentLayout.addWidget(mainWidget)
+
+    def toggleSpeech(self, button: QPushButton, toggle=True):
+        if toggle:
+            self.config.speechEnabled = not self.config.speechEnabled
+        button.setText(f"语音: {'已开启' if self.config.speechEnabled else '已关闭'}")
+
+    def setSpeechLatencyTarget(self, value, title: QLineEdit):
+        self.config.speechLatencyTarget = value
+        title.setText(f"首句语音延迟目标: {value:.1f} 秒")
+
+    def toggleTrace(self, button: QPushButton, toggle=True):
+        if toggle:
+            self.config.traceRequests = not self.config.traceRequests
+        button.setText(f"请求记录(log/traces/, 抽样 {self.config.traceSampleRate:.0%}): "
+                       f"{'已开启' if self.config.traceRequests else '已关闭'}")
+
+    def toggleMetricsServer(self, button: QPushButton, endpoint: QLineEdit, toggle=True):
+        if toggle:
+            self.config.metricsEnabled = not self.config.metricsEnabled
+        button.setText(f"统计服务(/metrics): {'已开启' if self.config.metricsEnabled else '已关闭'}")
+        endpoint.setText(f"文本格式的统计: http://{self.config.metricsHost}:{self.config.metricsPort}/metrics"
+                         if self._parent.ai.metricsServer else "统计服务未启动")
+
+    def setTypewriterSpeed(self, value, speedTitle: QLineEdit):
+        self.config.typewriterSpeed = value
+        speedTitle.setText(f"文字显示速度: {f'{value} 字/秒' if value else '立即显示'}")
+
     def other(self):
         self.clearSettingContent()
         mainWidget = QWidget()
@@ -1316,7 +3958,6 @@ class SettingWindow(QMainWindow):
 
     def clearMemory(self):
         try:
-            self.config.memory = []
             self._parent.AIMessage.clear()
             self.config.setPrompt()
             self.config.save()
@@ -1347,6 +3988,10 @@ class SettingWindow(QMainWindow):
 
         [childLayout.addWidget(i) for i in [tokenComboBox, modelComboBox]]
 
+        modelStatus = QLineEdit()
+        modelStatus.setReadOnly(True)
+        modelStatus.setPlaceholderText("模型列表的获取结果")
+
         self.loadUrls(urlComboBox)
         self.loadTokens(tokenComboBox)
         self.loadModels(modelComboBox)
@@ -1381,38 +4026,59 @@ class SettingWindow(QMainWindow):
 
         saveUrl.clicked.connect(lambda: self.addUrl(newUrl, urlComboBox))
         saveToken.clicked.connect(lambda: self.addToken(newToken, tokenComboBox))
-        getModel.clicked.connect(lambda: th(target=lambda: self.addModels(modelComboBox)).start())
+        getModel.clicked.connect(self.addModels)
 
         [_childLayout.addWidget(i) for i in [delUrl, delToken]]
         [__childLayout.addWidget(i) for i in [newUrl, saveUrl, newToken, saveToken, getModel]]
         __childLayout.addStretch()
 
         imageModalTitle = QPlainTextEdit(
-            f"如果为不支持视觉模态的大模型启用,可能会导致崩溃.\n视觉模态: {self._parent.enabledImageModal}\nTrue为启用\nFalse为禁用")
+            f"如果为不支持视觉模态的大模型启用,可能会导致崩溃.\n视觉模态: {self.config.enabledImageModal}\nTrue为启用\nFalse为禁用")
         imageModalTitle.setReadOnly(True)
         enabledImageModal = QPushButton("启用/禁用 视觉模态")
         enabledImageModal.clicked.connect(lambda:self.toggleImageModal(imageModalTitle))
         [__childLayout.addWidget(i) for i in [imageModalTitle, enabledImageModal]]
 
         [toggleModelLayout.addWidget(i) for i in
-         [_lineEdit_toggleAPI, urlComboBox, _lineEdit_toggleTokenAndModel, childWidget, _childWidget, __childWidget]]
+         [_lineEdit_toggleAPI, urlComboBox, _lineEdit_toggleTokenAndModel, childWidget, modelStatus, _childWidget,
+          __childWidget]]
         toggleModelLayout.addStretch()
 
         self.settingContentLayout.addWidget(toggleModelWidget)
+        #  先显示保存的模型列表, 过期的在后台刷新, 刷新完通过信号更新
+        self.modelComboBox = modelComboBox
+        self.modelStatus = modelStatus
+        self.modelDiscovery.refresh(self.config.tokenMap)
 
     def toggleImageModal(self, imageModalTitle: QPlainTextEdit):
-        self._parent.enabledImageModal = not self._parent.enabledImageModal
-        self.config.enabledImageModal = self._parent.enabledImageModal
-        imageModalTitle.setPlainText(f"如果为不支持视觉模态的大模型启用,可能会导致崩溃.\n视觉模态: {self._parent.enabledImageModal}\nTrue为启用\nFalse为禁用")
+        self.config.enabledImageModal = not self.config.enabledImageModal
+        imageModalTitle.setPlainText(f"如果为不支持视觉模态的大模型启用,可能会导致崩溃.\n视觉模态: {self.config.enabledImageModal}\nTrue为启用\nFalse为禁用")
 
-    def addModels(self, modelComboBox):
-        if not self.config.useUrl or not self.config.useToken: return
-        self.changeLock = True
-        models = self.getModelList(self.config.useUrl, self.config.useToken[self.config.useUrl])
-        self.config.models[self.config.useToken[self.config.useUrl]] = models
-        self.loadModels(modelComboBox)
+    def addModels(self):
+        token = self.config.useToken.get(self.config.useUrl)
+        if not self.config.useUrl or not token: return
+        if self.modelStatus is not None:
+            self.modelStatus.setText("正在获取模型列表...")
+        self.modelDiscovery.refresh({self.config.useUrl: [token]}, force=True)
+
+    def isCurrentEndpoint(self, url, token):
+        return url == self.config.useUrl and token == self.config.useToken.get(url)
+
+    def onModelsFailed(self, url, token, message):
+        if self.modelStatus is not None and self.isCurrentEndpoint(url, token):
+            self.modelStatus.setText(f"获取模型列表失败: {message}")
+
+    def onModelsDiscovered(self, url, token, models):
+        if self.modelStatus is not None and self.isCurrentEndpoint(url, token):
+            self.modelStatus.setText(f"获取到 {len(models)} 个模型")
+        if self.config.models.get(token) == models:
+            return
+        self.config.models[token] = models
         self.config.save()
-        QTimer.singleShot(100, self.unlock)
+        if self.modelComboBox is not None and self.isCurrentEndpoint(url, token):
+            self.changeLock = True
+            self.loadModels(self.modelComboBox)
+            QTimer.singleShot(100, self.unlock)
 
     def unlock(self):
         self.changeLock = False
@@ -1456,7 +4122,7 @@ class SettingWindow(QMainWindow):
             print(f"删除失败:{e}\n{tb.format_exc()}")
         self.loadTokens(tokenComboBox)
         self.loadModels(modelComboBox)
-        self.config.save()
+        self.config.notify("useToken")
         self.changeLock = True
 
     def onDelUrl(self, urlComboBox, tokenComboBox, modelComboBox):
@@ -1485,8 +4151,7 @@ class SettingWindow(QMainWindow):
         self.config.useUrl = text
         self.loadTokens(tokenComboBox)
         self.loadModels(modelComboBox)
-        self._parent.ai.connect(self.config.useUrl, self.config.useToken.get(self.config.useUrl))
-        self.config.save()
+        self.config.notify("useToken")
         QTimer.singleShot(100, self.unlock)
 
     def onTokenComboChanged(self, text, modelComboBox):
@@ -1494,8 +4159,7 @@ class SettingWindow(QMainWindow):
         self.changeLock = True
         self.config.useToken[self.config.useUrl] = text
         self.loadModels(modelComboBox)
-        self._parent.ai.connect(self.config.useUrl, self.config.useToken.get(self.config.useUrl))
-        self.config.save()
+        self.config.notify("useToken")
         QTimer.singleShot(100, self.unlock)
 
     def onModelComboChanged(self, text):
@@ -1543,6 +4207,195 @@ class SettingWindow(QMainWindow):
         self.settingContentWidget.setMinimumWidth(int(self.width() * 0.6))
 
 
+class FrameScheduler:
+    """
+    渲染帧率调度
+    ACTIVE: 有动画、打字、流式输出或待执行的命令时,用精确计时器跑满activeFps
+    IDLE: 什么都没发生超过idleDelay秒后,只保留呼吸/眨眼,降到idleFps
+    PAUSED: 窗口隐藏、最小化或被完全遮挡时,不再更新模型和重绘,只低频检查是否重新可见
+    同时按模式统计进程CPU占用,定期写进日志
+    """
+    ACTIVE = "active"
+    IDLE = "idle"
+    PAUSED = "paused"
+
+    def __init__(self, timer: QTimer, activeFps=60, idleFps=10, pausedFps=2, idleDelay=2.0, reportInterval=60.0):
+        self.timer = timer
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.fps = {self.ACTIVE: activeFps, self.IDLE: idleFps, self.PAUSED: pausedFps}
+        self.idleDelay = idleDelay
+        self.mode = None
+        self.lastBusy = time.monotonic()
+
+        self.reportInterval = reportInterval
+        self.cpu = {self.ACTIVE: 0.0, self.IDLE: 0.0, self.PAUSED: 0.0}  # 各模式下消耗的CPU时间
+        self.wall = {self.ACTIVE: 0.0, self.IDLE: 0.0, self.PAUSED: 0.0}  # 各模式持续的时间
+        self.lastSample = (time.monotonic(), time.process_time())
+        self.lastReport = time.monotonic()
+
+    def start(self, mode=ACTIVE):
+        self.__switch(mode)
+
+    def setFps(self, activeFps=None, idleFps=None):
+        if activeFps:
+            self.fps[self.ACTIVE] = activeFps
+        if idleFps:
+            self.fps[self.IDLE] = idleFps
+        if self.mode:
+            self.timer.start(self.__interval(self.mode))
+
+    def wake(self):
+        """有用户操作或新任务时立刻切回ACTIVE"""
+        self.lastBusy = time.monotonic()
+        if self.mode is not None and self.mode != self.ACTIVE:
+            self.__switch(self.ACTIVE)
+
+    def tick(self, now, busy: bool, visible: bool) -> str:
+        if busy:
+            self.lastBusy = now
+        if not visible:
+            mode = self.PAUSED
+        elif busy or now - self.lastBusy < self.idleDelay:
+            mode = self.ACTIVE
+        else:
+            mode = self.IDLE
+        if mode != self.mode:
+            self.__switch(mode, now)
+        if now - self.lastReport >= self.reportInterval:
+            self.report(now)
+        return mode
+
+    def __interval(self, mode):
+        return max(1, round(1000 / self.fps[mode]))
+
+    def __switch(self, mode, now=None):
+        self.__sample(now or time.monotonic())
+        debug(f"帧调度: {self.mode} -> {mode}")
+        self.mode = mode
+        self.timer.start(self.__interval(mode))
+
+    def __sample(self, now):
+        cpuNow = time.process_time()
+        lastWall, lastCpu = self.lastSample
+        if self.mode:
+            self.wall[self.mode] += now - lastWall
+            self.cpu[self.mode] += cpuNow - lastCpu
+        self.lastSample = (now, cpuNow)
+
+    def report(self, now=None):
+        now = now or time.monotonic()
+        self.__sample(now)
+        self.lastReport = now
+        usage = ", ".join(f"{mode} {self.cpu[mode] / self.wall[mode] * 100:.1f}% ({self.wall[mode]:.0f}s)"
+                          for mode in self.wall if self.wall[mode] > 0)
+        info(f"渲染CPU占用: {usage}")
+
+
+class FrameProfiler:
+    """
+    渲染循环的逐帧计时: 每个阶段的开始时间和耗时写进固定大小的环形缓冲(NumPy数组), 只保留最近capacity帧
+    关闭时渲染循环里只多一次布尔判断; 统计(分位数/抖动)只在显示浮层或导出时才计算,
+    export写出的是Chrome trace格式, 可以用 chrome://tracing 或 Perfetto 打开
+    """
+    PHASES = ("schedule", "update", "choreography", "animation", "typewriter", "paint")
+    SCHEDULE, UPDATE, CHOREOGRAPHY, ANIMATION, TYPEWRITER, PAINT = range(len(PHASES))
+
+    def __init__(self, capacity: int = 600):
+        self.enabled = False
+        self.capacity = capacity
+        self.starts = np.full((capacity, len(self.PHASES)), np.nan)
+        self.durations = np.zeros((capacity, len(self.PHASES)))
+        self.frameStarts = np.full(capacity, np.nan)
+        self.frameEnds = np.full(capacity, np.nan)
+        self.count = 0  # 一共记录了多少帧
+        self.row = -1
+        self.last = 0.0
+
+    def setEnabled(self, enabled: bool):
+        if enabled and not self.enabled:
+            self.starts.fill(np.nan)
+            self.durations.fill(0.0)
+            self.frameStarts.fill(np.nan)
+            self.frameEnds.fill(np.nan)
+            self.count = 0
+            self.row = -1
+        self.enabled = enabled
+
+    def begin(self):
+        self.last = time.perf_counter()
+        self.row = row = self.count % self.capacity
+        self.count += 1
+        self.starts[row] = np.nan
+        self.durations[row] = 0.0
+        self.frameStarts[row] = self.last
+
+    def mark(self, phase: int):
+        """记录从上一次mark(或begin)到现在的这一段"""
+        now = time.perf_counter()
+        self.starts[self.row, phase] = self.last
+        self.durations[self.row, phase] = now - self.last
+        self.last = now
+
+    def end(self):
+        self.frameEnds[self.row] = self.last
+
+    def record(self, phase: int, start: float, duration: float):
+        """不在__update里的阶段(paintGL)单独记录, 计入最近一帧"""
+        if self.row >= 0:
+            self.starts[self.row, phase] = start
+            self.durations[self.row, phase] = duration
+
+    def rows(self):
+        """按时间顺序排列的有效行下标"""
+        count = min(self.count, self.capacity)
+        return np.arange(self.count - count, self.count) % self.capacity
+
+    def stats(self) -> dict | None:
+        rows = self.rows()
+        if len(rows) < 2:
+            return None
+        work = self.durations[rows].sum(axis=1) * 1000
+        interval = np.diff(self.frameStarts[rows]) * 1000
+        return {
+            "frames": len(rows),
+            "fps": 1000 / interval.mean() if interval.mean() > 0 else 0.0,
+            "work": np.percentile(work, [50, 95, 99]).tolist() + [float(work.max())],
+            "interval": np.percentile(interval, [50, 95, 99]).tolist() + [float(interval.max())],
+            "jitter": float(interval.std()),
+            "phases": dict(zip(self.PHASES, (self.durations[rows].mean(axis=0) * 1000).tolist())),
+        }
+
+    def summary(self) -> str:
+        stats = self.stats()
+        if stats is None:
+            return "帧耗时统计: 等待数据..."
+        lines = [f"最近 {stats['frames']} 帧  {stats['fps']:.1f} fps  抖动 {stats['jitter']:.2f}ms",
+                 "          p50    p95    p99    max",
+                 "耗时  " + " ".join(f"{i:6.2f}" for i in stats["work"]),
+                 "间隔  " + " ".join(f"{i:6.2f}" for i in stats["interval"]),
+                 "各阶段平均(ms):"]
+        lines += [f"  {name:<13}{value:6.3f}" for name, value in stats["phases"].items()]
+        return "\n".join(lines)
+
+    def export(self, filePath: Path) -> Path:
+        rows = self.rows()
+        origin = np.nanmin(self.frameStarts[rows]) if len(rows) else 0.0
+        events = [{"name": "thread_name", "ph": "M", "pid": 1, "tid": 1, "args": {"name": "渲染循环"}}]
+        for row in rows:
+            frameStart, frameEnd = self.frameStarts[row], self.frameEnds[row]
+            if not np.isnan(frameEnd):
+                events.append({"name": "frame", "ph": "X", "pid": 1, "tid": 1,
+                               "ts": (frameStart - origin) * 1e6, "dur": (frameEnd - frameStart) * 1e6})
+            for phase, name in enumerate(self.PHASES):
+                start = self.starts[row, phase]
+                if not np.isnan(start):
+                    events.append({"name": name, "ph": "X", "pid": 1, "tid": 1,
+                                   "ts": (start - origin) * 1e6, "dur": self.durations[row, phase] * 1e6})
+        filePath.parent.mkdir(parents=True, exist_ok=True)
+        filePath.write_text(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}), encoding="utf-8")
+        return filePath
+
+
 class OpenGlWidget(QOpenGLWidget):
 
     def __init__(self, parent):
@@ -1551,6 +4404,8 @@ class OpenGlWidget(QOpenGLWidget):
         self.live2d: live2d.LAppModel | None = None
         self.backgroundColor = [0, 0, 0, 0]
         self.timer: QTimer = QTimer()
+        self.scheduler: FrameScheduler = FrameScheduler(self.timer)
+        self.profiler: FrameProfiler = FrameProfiler()
         self.isInit = False
         self.timer.timeout.connect(self.__update)
         self.setMinimumWidth(450)
@@ -1558,28 +4413,115 @@ class OpenGlWidget(QOpenGLWidget):
 
         self.setAttribute(Qt.WA_TranslucentBackground)
 
+        #  帧耗时浮层, F3 开关, Shift+F3 导出时间线
+        self.overlay = QLabel(self)
+        self.overlay.setStyleSheet("""
+        background-color:rgba(0,0,0,150);
+        color:white;
+        font-family:Consolas, monospace;
+        padding:4px;
+        """)
+        self.overlay.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.overlay.hide()
+        self.overlayTimer = QTimer(self)
+        self.overlayTimer.timeout.connect(self.refreshOverlay)
+
+    def toggleProfiler(self):
+        enabled = not self.profiler.enabled
+        self.profiler.setEnabled(enabled)
+        self.overlay.setVisible(enabled)
+        if enabled:
+            self.refreshOverlay()
+            self.overlayTimer.start(500)
+        else:
+            self.overlayTimer.stop()
+        info(f"帧耗时统计{'开启' if enabled else '关闭'}")
+
+    def refreshOverlay(self):
+        self.overlay.setText(self.profiler.summary())
+        self.overlay.adjustSize()
+        self.overlay.raise_()
+
+    def exportProfile(self):
+        if not self.profiler.count:
+            warn("没有可以导出的帧耗时数据, 先按F3开启统计")
+            return
+        filePath = self.profiler.export(Path("log") / f"frame-trace-{dt.datetime.now():%Y%m%d-%H%M%S}.json")
+        info(f"帧时间线已导出到 {filePath}, 可以用 chrome://tracing 或 https://ui.perfetto.dev 打开")
+
     def loadModel(self, filePath):
         self.live2d = live2d.LAppModel()
         self._parent.ai.live2d = self.live2d
         self.live2d.LoadModelJson(filePath)
+        parameterRegistry.load(self.live2d, filePath)
+        self._parent.animationController.bind(self.live2d, parameterRegistry)
+        self.setBreath(self._parent.config.autoBreath)
+        self.live2d.SetAutoBlinkEnable(self._parent.config.autoBlink)
+        self._parent.config.subscribe("autoBreath", self.setBreath)
+        self._parent.config.subscribe("autoBlink", lambda value: self.live2d.SetAutoBlinkEnable(value))
         self.live2dResize()
-        self.timer.start(16)
+        self.scheduler.setFps(self._parent.config.frameRate, self._parent.config.idleFrameRate)
+        self._parent.config.subscribe("frameRate", lambda value: self.scheduler.setFps(activeFps=value))
+        self._parent.config.subscribe("idleFrameRate", lambda value: self.scheduler.setFps(idleFps=value))
+        self.scheduler.start()
+
+    def setBreath(self, enabled):
+        """呼吸作为空闲叠加层和补间一起算, 不再交给live2d自己(它会在每次Update里单独再算一遍)"""
+        self.live2d.SetAutoBreathEnable(False)
+        for parameter, offset, amplitude, period in BREATH_LAYERS:
+            self._parent.animationController.addIdleLayer(parameter, amplitude if enabled else 0.0, period,
+                                                          offset=offset)
 
     def paintGL(self):
+        profiling = self.profiler.enabled
+        if profiling:
+            start = time.perf_counter()
         glClearColor(*self.backgroundColor)
         glClear(GL_COLOR_BUFFER_BIT)
         if self.live2d:
             self.live2d.Draw()
+        if profiling:
+            self.profiler.record(FrameProfiler.PAINT, start, time.perf_counter() - start)
+
+    def isBusy(self):
+        """有需要逐帧推进的东西"""
+        return (self._parent.animationController.isActive() or self._parent.typewriter.isTyping()
+                or self._parent.choreographer.isActive()
+                or len(self._parent.commandBus) > 0
+                or self._parent.thinkThread is not None and self._parent.thinkThread.is_alive())
+
+    def isShown(self):
+        window = self._parent.windowHandle()
+        return self._parent.isVisible() and not self._parent.isMinimized() and (window is None or window.isExposed())
 
     def __update(self):
+        profiler = self.profiler if self.profiler.enabled else None
+        if profiler:
+            profiler.begin()
+        now = time.monotonic()
+        mode = self.scheduler.tick(now, self.isBusy(), self.isShown())
+        #  执行其他线程投递过来的界面/模型修改
+        self._parent.commandBus.drain()
+        if profiler:
+            profiler.mark(FrameProfiler.SCHEDULE)
+        if mode == FrameScheduler.PAUSED:
+            if profiler:
+                profiler.end()
+            return
         self.live2d.Update()
         self.update()
-        self._parent.animationController.update()
-        #  加一个检查parent function
-        if self._parent.function:
-            self._parent.function()
-            self._parent.function = None
-        self._parent.config.position = (self._parent.x(), self._parent.y())
+        if profiler:
+            profiler.mark(FrameProfiler.UPDATE)
+        self._parent.choreographer.tick(now)
+        if profiler:
+            profiler.mark(FrameProfiler.CHOREOGRAPHY)
+        self._parent.animationController.update(now)
+        if profiler:
+            profiler.mark(FrameProfiler.ANIMATION)
+        self._parent.typewriter.tick(now)
+        if profiler:
+            profiler.mark(FrameProfiler.TYPEWRITER)
+            profiler.end()
 
         if not self.isInit and self._parent.ai.live2d is not None:
             #  同时也负责检查组件初始化吧
@@ -1685,13 +4627,14 @@ if __name__ == '__main__':
     try:
         live2d.init()
         app = QApplication(sys.argv)
-        window = MainWindow()
-        settingWindow = SettingWindow(window)
-        window.config = settingWindow.config
+        config = Config.load()
+        window = MainWindow(config)
+        settingWindow = SettingWindow(window, config)
         window.settingWindow = settingWindow
         window.init()
         window.show()
         window.setting.clicked.connect(settingWindow.show)
+        app.aboutToQuit.connect(window.config.flush)
         sys.exit(app.exec_())
     except Exception as e:
         print(f"{e}\n{tb.format_exc()}")